@@ -21,21 +21,31 @@ const STORAGE_KEYS = {
   SETTINGS: 'enhancerSettings',
   STATS: 'enhancementStats',
   CREDITS: 'creditsRemaining',
-  VERIFIED: 'isVerified'
+  VERIFIED: 'isVerified',
+  LEASE: 'creditLease'
 };
 
 // Backend configuration
 // Import configuration (for extension, we'll define it inline)
 const CONFIG = {
     API_BASE_URL: 'http://localhost:5000',  // Update this for production
+    // balance_service.py: holds live balance connections without a thread each
+    BALANCE_BASE_URL: 'http://localhost:5001',  // Update this for production
     ENDPOINTS: {
         VERIFY: '/api/verify',
         CHECK_CREDITS: '/api/check_credits',
         USE_CREDIT: '/api/use_credit',
+        LEASE: '/api/lease',
+        SETTLE_LEASE: '/api/lease/settle',
+        BALANCE_STREAM: '/api/balance/stream',
+        BALANCE_POLL: '/api/balance/poll',
         ENHANCE: '/api/enhance'
     },
     getApiUrl: function(endpoint) {
         return this.API_BASE_URL + this.ENDPOINTS[endpoint];
+    },
+    getBalanceUrl: function(endpoint) {
+        return (this.BALANCE_BASE_URL || this.API_BASE_URL) + this.ENDPOINTS[endpoint];
     }
 };
 
@@ -238,35 +248,278 @@ async function checkCreditsFromBackend(redemptionCode) {
   }
 }
 
-// Use credit for enhancement
-async function useCredit(redemptionCode) {
+// Use credit for enhancement.
+// The same Idempotency-Key is sent on every attempt, so retrying after a lost
+// response or a busy server (503) can never spend a second credit.
+const USE_CREDIT_ATTEMPTS = 3;
+
+function newIdempotencyKey() {
+  return crypto.randomUUID();
+}
+
+async function useCredit(redemptionCode, idempotencyKey = newIdempotencyKey()) {
+  let message = 'Server error';
+  for (let attempt = 1; attempt <= USE_CREDIT_ATTEMPTS; attempt++) {
+    let retryAfter = attempt;  // seconds
+    try {
+      const response = await fetch(`${API_BASE_URL}/api/use_credit`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+          'Idempotency-Key': idempotencyKey
+        },
+        body: JSON.stringify({
+          redemption_code: redemptionCode
+        })
+      });
+      
+      if (response.ok) {
+        const result = await response.json();
+        if (result.success) {
+          await updateCredits(result.remaining_credits);
+          return { success: true, remaining: result.remaining_credits, replayed: !!result.replayed };
+        } else {
+          return { success: false, message: result.message };
+        }
+      }
+      if (response.status !== 503) {
+        return { success: false, message: 'Server error' };
+      }
+      message = 'Server busy, please retry shortly';
+      retryAfter = Number(response.headers.get('Retry-After')) || retryAfter;
+    } catch (error) {
+      debugLog('Credit usage failed', error);
+      message = 'Network error';
+    }
+    if (attempt < USE_CREDIT_ATTEMPTS) {
+      debugLog(`Retrying credit usage in ${retryAfter}s (same Idempotency-Key)`);
+      await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+    }
+  }
+  return { success: false, message };
+}
+
+// Credit leases: reserve a block of credits in one call and spend them
+// locally, so most enhancements make no network round trip at all.  The
+// block is settled (spent count reported, the rest returned) in the
+// background once it runs out, or by the next reservation.
+const LEASE_CREDITS = 10;
+const LEASE_MARGIN_MS = 60 * 1000;  // stop using a lease this long before it expires
+
+function getLease() {
+  return new Promise((resolve) => {
+    browserAPI.storage.local.get([STORAGE_KEYS.LEASE], (result) => {
+      resolve(result?.[STORAGE_KEYS.LEASE] || null);
+    });
+  });
+}
+
+function saveLease(lease) {
+  return new Promise((resolve) => {
+    browserAPI.storage.local.set({ [STORAGE_KEYS.LEASE]: lease }, () => resolve(true));
+  });
+}
+
+// Every read-modify-write of the stored lease runs through this chain, one
+// after another: two enhancements at once must not both count the same
+// credit, or both reserve a new block and orphan one of them.
+let leaseQueue = Promise.resolve();
+
+function withLease(fn) {
+  const run = leaseQueue.then(fn, fn);
+  leaseQueue = run.catch(() => {});
+  return run;
+}
+
+async function settleLease(lease) {
+  try {
+    const response = await fetch(CONFIG.getApiUrl('SETTLE_LEASE'), {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ redemption_code: lease.code, lease: lease.token, spent: lease.spent })
+    });
+    if (response.ok) {
+      // Settled (late settlements of an expired lease are still billed) or unknown
+      const result = await response.json();
+      await withLease(async () => {
+        const current = await getLease();
+        if (current?.token === lease.token) {
+          await saveLease(null);
+        }
+      });
+      if (result.success) {
+        await updateCredits(result.remaining_credits);
+      }
+    }
+  } catch (error) {
+    // Kept; the next reservation settles it instead
+    debugLog('Lease settlement failed', error);
+  }
+}
+
+// A partly spent lease left idle is settled just before it lapses.  If the
+// worker is gone by then, the next reservation settles it - late, but the
+// server still bills what was spent.
+function scheduleLeaseSettlement(lease) {
+  const delay = lease.expiresAt * 1000 - LEASE_MARGIN_MS - Date.now();
+  setTimeout(async () => {
+    const current = await getLease();
+    if (current?.token === lease.token) {
+      settleLease(current);
+    }
+  }, Math.max(0, delay));
+}
+
+async function spendCredit(redemptionCode) {
+  const result = await withLease(() => spendLeasedCredit(redemptionCode));
+  // Older server without leases, or busy: one credit at a time
+  return result || useCredit(redemptionCode);
+}
+
+// One credit from the stored lease, reserving a new block when it is used
+// up; null when leasing is unavailable.  Only call it through withLease().
+async function spendLeasedCredit(redemptionCode) {
+  const lease = await getLease();
+  if (lease && lease.code === redemptionCode && lease.spent < lease.credits
+      && Date.now() < lease.expiresAt * 1000 - LEASE_MARGIN_MS) {
+    lease.spent += 1;
+    await saveLease(lease);
+    const remaining = lease.balance + lease.credits - lease.spent;
+    await updateCredits(remaining);
+    if (lease.spent === lease.credits) {
+      settleLease(lease);  // not awaited: the enhancement doesn't wait on it
+    }
+    return { success: true, remaining };
+  }
+
+  // Reserve a new block, settling the previous lease in the same call
+  const previous = lease && lease.code === redemptionCode ? { lease: lease.token, spent: lease.spent } : null;
   try {
-    const response = await fetch(`${API_BASE_URL}/api/use_credit`, {
+    const response = await fetch(CONFIG.getApiUrl('LEASE'), {
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
+        'Idempotency-Key': newIdempotencyKey()
       },
-      body: JSON.stringify({
-        redemption_code: redemptionCode
-      })
+      body: JSON.stringify({ redemption_code: redemptionCode, credits: LEASE_CREDITS, previous })
     });
-    
     if (response.ok) {
       const result = await response.json();
-      if (result.success) {
-        await updateCredits(result.remaining_credits);
-        return { success: true, remaining: result.remaining_credits };
-      } else {
+      await saveLease(null);  // the server has dealt with the previous lease
+      if (!result.success) {
         return { success: false, message: result.message };
       }
+      const newLease = {
+        token: result.lease,
+        code: redemptionCode,
+        credits: result.credits,
+        spent: 1,
+        expiresAt: result.expires_at,
+        balance: result.remaining_credits
+      };
+      await saveLease(newLease);
+      const remaining = newLease.balance + newLease.credits - 1;
+      await updateCredits(remaining);
+      if (newLease.credits === 1) {
+        settleLease(newLease);
+      } else {
+        scheduleLeaseSettlement(newLease);
+      }
+      return { success: true, remaining };
     }
-    return { success: false, message: 'Server error' };
   } catch (error) {
-    debugLog('Credit usage failed', error);
-    return { success: false, message: 'Network error' };
+    debugLog('Credit lease failed', error);
+  }
+  return null;
+}
+
+// Live balance: one server-sent-events connection per redemption code
+// (long polling where EventSource is unavailable or the server is full)
+// pushes every balance change into storage, where the popup and sidebar
+// pick it up.  While it is live, checkCredits needs no request at all.
+const balanceWatch = { code: null, source: null, live: false, generation: 0 };
+
+function applyPushedBalance(code, serverRemaining) {
+  // Credits held by our own lease are not in the server balance
+  return withLease(async () => {
+    const lease = await getLease();
+    if (lease && lease.code === code) {
+      lease.balance = serverRemaining;
+      await saveLease(lease);
+      await updateCredits(serverRemaining + lease.credits - lease.spent);
+    } else {
+      await updateCredits(serverRemaining);
+    }
+  });
+}
+
+async function longPollBalance(code, generation) {
+  let known = null;
+  while (balanceWatch.generation === generation) {
+    try {
+      const params = new URLSearchParams({ redemption_code: code });
+      if (known !== null) {
+        params.set('known', known);
+      }
+      const response = await fetch(`${CONFIG.getBalanceUrl('BALANCE_POLL')}?${params.toString()}`);
+      if (!response.ok) {
+        throw new Error(`HTTP ${response.status}`);
+      }
+      const result = await response.json();
+      known = result.remaining_credits;
+      balanceWatch.live = true;
+      await applyPushedBalance(code, known);
+    } catch (error) {
+      balanceWatch.live = false;
+      debugLog('Balance long poll failed, retrying', error);
+      await new Promise(resolve => setTimeout(resolve, 5000));
+    }
+  }
+}
+
+function watchBalance(code) {
+  if (balanceWatch.code === code) {
+    return;
+  }
+  if (balanceWatch.source) {
+    balanceWatch.source.close();
+  }
+  balanceWatch.code = code;
+  balanceWatch.source = null;
+  balanceWatch.live = false;
+  const generation = ++balanceWatch.generation;  // stops any older long poll loop
+  if (!code) {
+    return;
   }
+
+  if (typeof EventSource === 'undefined') {
+    longPollBalance(code, generation);
+    return;
+  }
+  const params = new URLSearchParams({ redemption_code: code });
+  const source = new EventSource(`${CONFIG.getBalanceUrl('BALANCE_STREAM')}?${params.toString()}`);
+  source.addEventListener('balance', (event) => {
+    balanceWatch.live = true;
+    applyPushedBalance(code, JSON.parse(event.data).remaining_credits);
+  });
+  source.onerror = () => {
+    // EventSource reconnects by itself; until it does, fall back to requests
+    balanceWatch.live = false;
+    if (source.readyState === EventSource.CLOSED && balanceWatch.generation === generation) {
+      balanceWatch.source = null;
+      longPollBalance(code, generation);
+    }
+  };
+  balanceWatch.source = source;
 }
 
+getStoredData().then(data => watchBalance(data.redemptionCode)).catch(() => {});
+browserAPI.storage.onChanged.addListener((changes, area) => {
+  if (area === 'local' && changes[STORAGE_KEYS.REDEMPTION_CODE]) {
+    watchBalance(changes[STORAGE_KEYS.REDEMPTION_CODE].newValue || null);
+  }
+});
+
 function updateStats() {
   return new Promise((resolve) => {
     const today = new Date().toDateString();
@@ -418,7 +671,7 @@ async function enhancePrompt(originalPrompt) {
     }
     
     // Use credit first
-    const creditResult = await useCredit(storedData.redemptionCode);
+    const creditResult = await spendCredit(storedData.redemptionCode);
     if (!creditResult.success) {
       throw new Error(creditResult.message || 'Failed to use credit');
     }
@@ -533,8 +786,9 @@ browserAPI.runtime.onMessage.addListener((request, sender, sendResponse) => {
             const data = await getStoredData();
             let credits = data.credits;
             
-            // Try to refresh from backend if we have a redemption code
-            if (data.redemptionCode) {
+            // Refresh from the backend, unless the balance stream keeps storage current
+            const pushed = balanceWatch.live && balanceWatch.code === data.redemptionCode;
+            if (data.redemptionCode && !pushed) {
               const backendCredits = await checkCreditsFromBackend(data.redemptionCode);
               if (backendCredits !== null) {
                 credits = backendCredits;
@@ -548,6 +802,12 @@ browserAPI.runtime.onMessage.addListener((request, sender, sendResponse) => {
         })();
         break;
 
+      case 'getCredits':
+        getStoredData()
+          .then(data => sendResponse({ success: true, credits: data.credits }))
+          .catch(error => sendResponse({ success: false, error: error.message }));
+        break;
+
       case 'validateCode':
         if (request.code) {
           validateRedemptionCode(request.code)
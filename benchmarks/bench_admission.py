@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Write admission benchmark
+
+Many client threads POST /api/use_credit at the standalone API while a
+"hog" connection keeps grabbing the SQLite write lock (standing in for a
+checkpoint, a retention run or another worker's burst).  Runs once with
+admission control off and once on, and prints the latency tail and how
+requests ended.
+
+Usage: python benchmarks/bench_admission.py [threads] [seconds]
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+# Make the backend modules importable when run from the repo root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'streamlit_backend'))
+
+import database
+import admission
+import ratelimit
+from database import ConnectionPool, open_connection
+from migrations import migrate
+from codes import issue_codes, parse_code
+from usage_log import get_usage_writer
+from api_service import create_app
+
+
+def hog(db_path, stop, hold=0.3, pause=0.1):
+    """Hold the write lock ``hold`` seconds out of every ``hold + pause``"""
+    conn = open_connection(db_path)
+    while not stop.is_set():
+        conn.execute("BEGIN IMMEDIATE")
+        time.sleep(hold)
+        conn.execute("COMMIT")
+        time.sleep(pause)
+    conn.close()
+
+
+def run(label, app, codes, threads, seconds, db_path):
+    latencies = []
+    outcomes = {}
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def client(code):
+        test_client = app.test_client()
+        while not stop.is_set():
+            started = time.perf_counter()
+            response = test_client.post('/api/use_credit', json={"redemption_code": code})
+            elapsed = time.perf_counter() - started
+            body = response.get_json()
+            outcome = response.status_code if response.status_code != 200 else (
+                "ok" if body["success"] else body["message"][:40])
+            with lock:
+                latencies.append(elapsed)
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    hog_thread = threading.Thread(target=hog, args=(db_path, stop))
+    workers = [threading.Thread(target=client, args=(codes[i],)) for i in range(threads)]
+    hog_thread.start()
+    for worker in workers:
+        worker.start()
+    time.sleep(seconds)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    hog_thread.join()
+
+    latencies.sort()
+    pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    print(f"\n{label}: {len(latencies)} requests")
+    print(f"   p50 {pick(0.5):7.0f} ms   p99 {pick(0.99):7.0f} ms   max {latencies[-1] * 1000:7.0f} ms")
+    for outcome, count in sorted(outcomes.items(), key=lambda item: -item[1]):
+        print(f"   {count:6d}  {outcome}")
+    return latencies[-1]
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    print("🚀 Write admission benchmark")
+    print(f"   {threads} client threads, {seconds:g}s per run, write lock held 75% of the time")
+
+    ratelimit.ENABLED = False
+    get_usage_writer()  # start the log writer before timing
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'bench.db')
+        pool = ConnectionPool(db_path=db_path, max_size=8)
+        with pool.connection() as conn:
+            migrate(conn)
+        with pool.transaction() as conn:
+            codes = issue_codes(conn, threads)
+            conn.executemany("INSERT INTO users (name, email, redemption_code, code_id, credits) "
+                             "VALUES (?, ?, ?, ?, 1000000)",
+                             [(f"User {i}", f"user{i}@example.com", code, parse_code(code))
+                              for i, code in enumerate(codes)])
+        database._pool = pool
+
+        admission._controller = admission.AdmissionController(slots=threads * 2, max_queue=0)
+        unbounded = run("Admission off", create_app(), codes, threads, seconds, db_path)
+
+        admission._controller = admission.AdmissionController(slots=2, max_queue=64, max_wait=0.5)
+        bounded = run("Admission on (2 slots, 0.5s max wait)", create_app(), codes, threads, seconds, db_path)
+        print(f"\n   admission: {admission.admission_stats()['admitted']} admitted, "
+              f"{admission.admission_stats()['shed_timeout']} shed")
+        get_usage_writer().flush()
+        pool.close()
+
+    print(f"\n{'✅' if bounded < unbounded else '❌'} worst case {unbounded * 1000:.0f} ms -> {bounded * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Multi-threaded credit debit benchmark
+
+Hammers a throwaway database with concurrent debits against a handful of
+redemption codes and compares the legacy SELECT-then-UPDATE flow with the
+single-statement UPDATE ... RETURNING debit in credits.py.
+
+Checks correctness (no code ever goes below zero, every successful debit is
+accounted for) and reports throughput and lock errors.
+
+Usage: python benchmarks/bench_credit_debit.py [threads] [debits_per_thread]
+"""
+
+import os
+import sys
+import sqlite3
+import tempfile
+import threading
+import time
+
+# Make the backend modules importable when run from the repo root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'streamlit_backend'))
+
+from database import ConnectionPool
+from migrations import migrate
+from credits import debit_credit
+from codes import parse_code
+
+USERS = 5
+CREDITS_PER_USER = 500
+
+
+def seed(pool):
+    """Fresh users with a known balance"""
+    with pool.transaction() as conn:
+        conn.execute("DELETE FROM users")
+        conn.executemany(
+            "INSERT INTO users (name, email, redemption_code, code_id, credits) VALUES (?, ?, ?, ?, ?)",
+            [(f"User {i}", f"user{i}@example.com", f"CODE{i:04d}", parse_code(f"CODE{i:04d}"), CREDITS_PER_USER)
+             for i in range(USERS)]
+        )
+
+
+def legacy_debit(pool, code):
+    """The pre-RETURNING flow: read the balance, check it in Python, then write"""
+    with pool.connection() as conn:
+        conn.execute("BEGIN")
+        try:
+            row = conn.execute("SELECT credits, used_credits FROM users WHERE code_id = ?",
+                               (parse_code(code),)).fetchone()
+            if not row or row[0] - row[1] <= 0:
+                conn.rollback()
+                return False
+            conn.execute("UPDATE users SET used_credits = ? WHERE code_id = ?",
+                         (row[1] + 1, parse_code(code)))
+            conn.commit()
+            return True
+        except sqlite3.OperationalError:
+            conn.rollback()
+            raise
+
+
+def returning_debit(pool, code):
+    """One conditional UPDATE ... RETURNING under BEGIN IMMEDIATE"""
+    with pool.transaction() as conn:
+        return debit_credit(conn, code)["success"]
+
+
+def run(label, debit, pool, threads, per_thread):
+    seed(pool)
+    counters = {"ok": 0, "rejected": 0, "busy": 0}
+    lock = threading.Lock()
+
+    def worker(index):
+        ok = rejected = busy = 0
+        for i in range(per_thread):
+            code = f"CODE{(index + i) % USERS:04d}"
+            try:
+                if debit(pool, code):
+                    ok += 1
+                else:
+                    rejected += 1
+            except sqlite3.OperationalError:
+                busy += 1
+        with lock:
+            counters["ok"] += ok
+            counters["rejected"] += rejected
+            counters["busy"] += busy
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    started = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    with pool.connection() as conn:
+        used, overdrawn = conn.execute(
+            "SELECT SUM(used_credits), SUM(used_credits > credits) FROM users"
+        ).fetchone()
+
+    attempts = threads * per_thread
+    consistent = used == counters["ok"] and not overdrawn
+    print(f"\n{label}")
+    print(f"   {attempts} attempts in {elapsed:.2f}s -> {attempts / elapsed:,.0f} ops/s")
+    print(f"   debited={counters['ok']} rejected={counters['rejected']} lock_errors={counters['busy']}")
+    print(f"   ledger used_credits={used} overdrawn_codes={overdrawn} "
+          f"{'✅ consistent' if consistent else '❌ INCONSISTENT'}")
+    return consistent
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    per_thread = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    print("🚀 Credit debit benchmark")
+    print(f"   {threads} threads x {per_thread} debits, {USERS} codes x {CREDITS_PER_USER} credits")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pool = ConnectionPool(db_path=os.path.join(tmp, 'bench.db'), max_size=threads)
+        with pool.connection() as conn:
+            migrate(conn)
+
+        run("Legacy SELECT + UPDATE", legacy_debit, pool, threads, per_thread)
+        ok = run("UPDATE ... RETURNING", returning_debit, pool, threads, per_thread)
+        pool.close()
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
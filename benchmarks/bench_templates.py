@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Prompt template benchmark
+
+Renders every settings combination with the old per-call builders (kept
+below verbatim) and with the precompiled skeletons in templates.py,
+checks the output is identical, then times both - plus the legacy builder
+behind the output cache, for comparison.
+
+Usage: python benchmarks/bench_templates.py [calls]
+"""
+
+import os
+import sys
+import time
+import itertools
+
+# Make the backend modules importable when run from the repo root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'streamlit_backend'))
+
+import templates
+from templates import render_methodology, render_plain_methodology
+from output_cache import memoized_enhancement
+
+PROMPT = "Explain how SQLite write-ahead logging interacts with checkpoints"
+
+
+def legacy_methodology(original_prompt, settings):
+    """api_generate_enhanced_prompt / api_endpoints.generate_enhanced_prompt as they were"""
+    role = settings.get('role', '')
+    description = settings.get('description', 'detailed')
+    length = settings.get('length', 'medium')
+    format_style = settings.get('format', 'structured')
+    tone = settings.get('tone', 'helpful')
+    
+    # Length mapping
+    length_instructions = {
+        'short': 'Keep the response concise and to the point',
+        'medium': 'Provide a comprehensive but focused response',
+        'long': 'Give a detailed, thorough explanation with examples'
+    }
+    
+    # Format mapping  
+    format_instructions = {
+        'structured': 'Use clear headings, bullet points, and logical organization',
+        'paragraph': 'Write in flowing paragraphs with smooth transitions',
+        'stepbystep': 'Break down into numbered steps or sequential instructions',
+        'creative': 'Use engaging, creative formatting with varied presentation styles'
+    }
+    
+    # Tone mapping
+    tone_instructions = {
+        'helpful': 'Be supportive, encouraging, and solution-focused',
+        'professional': 'Maintain formal, business-appropriate language',
+        'casual': 'Use conversational, friendly, and approachable language',
+        'technical': 'Focus on precision, accuracy, and technical detail'
+    }
+    
+    # Build enhanced prompt using Ben's structure
+    enhanced_sections = []
+    
+    # ROLE section
+    if role:
+        enhanced_sections.append(f"**ROLE**: You are {role}")
+    
+    # GOAL section  
+    enhanced_sections.append(f"**GOAL**: {original_prompt}")
+    
+    # CONTEXT section
+    context_parts = []
+    if description == 'detailed':
+        context_parts.append("Provide comprehensive information with relevant details")
+    elif description == 'summary':
+        context_parts.append("Focus on key points and essential information")
+    elif description == 'creative':
+        context_parts.append("Approach this with creativity and innovative thinking")
+    
+    if context_parts:
+        enhanced_sections.append(f"**CONTEXT**: {' and '.join(context_parts)}")
+    
+    # REQUIREMENTS section
+    requirements = []
+    requirements.append(length_instructions[length])
+    requirements.append(tone_instructions[tone])
+    
+    enhanced_sections.append(f"**REQUIREMENTS**: {' | '.join(requirements)}")
+    
+    # FORMAT section
+    enhanced_sections.append(f"**FORMAT**: {format_instructions[format_style]}")
+    
+    # WARNINGS section
+    enhanced_sections.append("**WARNINGS**: Ensure accuracy, avoid assumptions, and provide actionable insights")
+    
+    return "\n\n".join(enhanced_sections)
+
+
+def legacy_plain_methodology(original_prompt, settings):
+    """api_server.generate_enhanced_prompt as it was"""
+    
+    # Extract settings
+    role = settings.get('role', '').strip()
+    description = settings.get('description', 'detailed')
+    length = settings.get('length', 'medium')
+    format_type = settings.get('format', 'structured')
+    tone = settings.get('tone', 'helpful')
+    
+    # Ben's methodology structure
+    enhanced_parts = []
+    
+    # 1. ROLE (if specified)
+    if role:
+        enhanced_parts.append(f"ROLE: You are {role}.")
+    
+    # 2. GOAL
+    enhanced_parts.append(f"GOAL: {original_prompt}")
+    
+    # 3. CONTEXT
+    context_map = {
+        'brief': "Provide a concise response.",
+        'detailed': "Provide a comprehensive and thorough response with examples where appropriate.",
+        'technical': "Focus on technical accuracy and implementation details.",
+        'beginner': "Explain concepts clearly for someone new to this topic."
+    }
+    enhanced_parts.append(f"CONTEXT: {context_map.get(description, context_map['detailed'])}")
+    
+    # 4. REQUIREMENTS
+    requirements = []
+    
+    # Length requirements
+    length_map = {
+        'short': "Keep response under 200 words",
+        'medium': "Aim for 200-500 words",
+        'long': "Provide a detailed response of 500+ words"
+    }
+    requirements.append(length_map.get(length, length_map['medium']))
+    
+    # Format requirements
+    format_map = {
+        'bullet': "Format as bullet points",
+        'numbered': "Use numbered steps",
+        'structured': "Use clear headings and sections",
+        'paragraph': "Write in paragraph form"
+    }
+    requirements.append(format_map.get(format_type, format_map['structured']))
+    
+    # Tone requirements
+    tone_map = {
+        'helpful': "Use a helpful and supportive tone",
+        'professional': "Maintain a professional tone",
+        'casual': "Use a conversational, casual tone",
+        'technical': "Use precise, technical language"
+    }
+    requirements.append(tone_map.get(tone, tone_map['helpful']))
+    
+    enhanced_parts.append("REQUIREMENTS:\n" + "\n".join(f"- {req}" for req in requirements))
+    
+    # 5. FORMAT
+    enhanced_parts.append("FORMAT: Structure your response clearly with appropriate headings or organization.")
+    
+    # 6. WARNINGS
+    enhanced_parts.append("WARNINGS: Ensure accuracy and provide sources when making factual claims.")
+    
+    return "\n\n".join(enhanced_parts)
+
+
+def combinations(*tables):
+    """Every settings dict over the given value tables, with and without a role"""
+    for role, *values in itertools.product(('', 'a senior database engineer'), *tables):
+        yield dict(zip(('role', 'description', 'length', 'format', 'tone'), (role, *values)))
+
+
+def timed(label, render, settings, calls):
+    started = time.perf_counter()
+    for i in range(calls):
+        render(PROMPT, settings[i % len(settings)])
+    elapsed = time.perf_counter() - started
+    print(f"   {label:<24} {elapsed / calls * 1e9:8.0f} ns/call")
+    return elapsed
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    print("🚀 Prompt template benchmark")
+    ok = True
+    for name, legacy, fast, tables in (
+        ("Markdown methodology", legacy_methodology, render_methodology,
+         ((*templates.DESCRIPTION_CONTEXT, 'other'), templates.LENGTH_INSTRUCTIONS,
+          templates.FORMAT_INSTRUCTIONS, templates.TONE_INSTRUCTIONS)),
+        ("Plain methodology", legacy_plain_methodology, render_plain_methodology,
+         ((*templates.PLAIN_CONTEXT, 'other'), (*templates.PLAIN_LENGTH, 'other'),
+          (*templates.PLAIN_FORMAT, 'other'), (*templates.PLAIN_TONE, 'other'))),
+    ):
+        settings = list(combinations(*tables))
+        same = all(legacy(PROMPT, s) == fast(PROMPT, s) for s in settings)
+        ok = ok and same
+        print(f"\n{name}: {len(settings)} combinations, "
+              f"{'✅ identical output' if same else '❌ OUTPUT DIFFERS'}")
+        before = timed("Per-call build", legacy, settings, calls)
+        after = timed("Precompiled skeleton", fast, settings, calls)
+        timed("Memoized (all hits)", memoized_enhancement(legacy), settings, calls)
+        print(f"   Speedup: {before / after:.1f}x")
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,13 @@ class PopupManager {
     this.initElements();
     this.setupEventListeners();
     this.loadStatus();
+
+    // The background's balance stream writes pushed balances to storage
+    browserAPI.storage.onChanged.addListener((changes, area) => {
+      if (area === 'local' && changes.creditsRemaining) {
+        this.loadStatus();
+      }
+    });
   }
 
   initElements() {
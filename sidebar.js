@@ -29,6 +29,14 @@ class PromptEnhancer {
         this.setupEventListeners();
         this.updateUI();
         this.detectPromptFromPage();
+
+        // Balances pushed by the background's stream land in storage
+        browserAPI.storage.onChanged.addListener((changes, area) => {
+            if (area === 'local' && changes.creditsRemaining) {
+                this.credits = changes.creditsRemaining.newValue || 0;
+                this.updateCreditsDisplay();
+            }
+        });
     }
 
     async loadSettings() {
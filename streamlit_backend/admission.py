@@ -0,0 +1,160 @@
+"""
+Admission control in front of the SQLite writer
+
+SQLite commits one write transaction at a time.  Letting every request
+thread at it at once only turns a burst into busy_timeout waits and
+"database is locked" errors after seconds.  Instead, write endpoints
+take one of a few slots first:
+
+* a free slot is taken at once;
+* otherwise the request queues (at most ``max_queue`` waiters) for up to
+  ``max_wait`` seconds;
+* past that - or with the queue full - it is shed with 503 + Retry-After
+  without touching the database.
+
+So a request either starts its write within max_wait or fails fast, and
+tail latency stays bounded by max_wait plus one transaction.
+
+Queue depth (seen by each arriving request) and admission wait times are
+kept as cumulative histograms.  Everything is per process.
+
+Settings:
+    ADMISSION_SLOTS       concurrent writers admitted (default 4)
+    ADMISSION_MAX_QUEUE   waiters before shedding outright (default 64)
+    ADMISSION_MAX_WAIT    seconds a request may wait (default 2)
+"""
+
+import os
+import math
+import time
+import threading
+
+from metrics import Histogram
+
+SLOTS = int(os.environ.get('ADMISSION_SLOTS', '4'))
+MAX_QUEUE = int(os.environ.get('ADMISSION_MAX_QUEUE', '64'))
+MAX_WAIT = float(os.environ.get('ADMISSION_MAX_WAIT', '2'))
+
+# api_service.py's routes that write (POSTs on these paths go through
+# admission); other apps pass their own set to install_admission_control()
+WRITE_PATHS = {'/api/use_credit', '/api/enhance', '/api/batch', '/api/lease', '/api/lease/settle',
+               '/api/verify'}
+
+WAIT_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+
+
+class AdmissionController:
+    """Bounded slots + bounded, deadline-limited wait queue"""
+
+    def __init__(self, slots=SLOTS, max_queue=MAX_QUEUE, max_wait=MAX_WAIT):
+        self.slots = slots
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.pid = os.getpid()
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+
+        self.admitted = 0
+        self.shed_queue_full = 0
+        self.shed_timeout = 0
+        self.wait_ms = Histogram(WAIT_BUCKETS_MS)
+        self.queue_depth = Histogram(DEPTH_BUCKETS)
+
+    def acquire(self):
+        """Take a slot; False if the request has to be shed"""
+        started = time.monotonic()
+        with self._cond:
+            self.queue_depth.observe(self._waiting)
+            if self._active >= self.slots or self._waiting:
+                if self._waiting >= self.max_queue:
+                    self.shed_queue_full += 1
+                    return False
+                self._waiting += 1
+                deadline = started + self.max_wait
+                try:
+                    while self._active >= self.slots:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.shed_timeout += 1
+                            return False
+                        self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._active += 1
+            self.admitted += 1
+        self.wait_ms.observe((time.monotonic() - started) * 1000)
+        return True
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify()
+
+    def retry_after(self):
+        """Seconds a shed client should back off"""
+        return max(1, math.ceil(self.max_wait))
+
+    def stats(self):
+        with self._cond:
+            active, waiting = self._active, self._waiting
+        return {
+            "slots": self.slots,
+            "active": active,
+            "queued": waiting,
+            "admitted": self.admitted,
+            "shed_queue_full": self.shed_queue_full,
+            "shed_timeout": self.shed_timeout,
+            "wait_ms_p50": self.wait_ms.quantile(0.5),
+            "wait_ms_p99": self.wait_ms.quantile(0.99),
+            "wait_ms": self.wait_ms.snapshot(),
+            "queue_depth": self.queue_depth.snapshot(),
+        }
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_admission_controller():
+    """Process-wide controller, recreated after a fork"""
+    global _controller
+    controller = _controller
+    if controller is None or controller.pid != os.getpid():
+        with _controller_lock:
+            if _controller is None or _controller.pid != os.getpid():
+                _controller = AdmissionController()
+            controller = _controller
+    return controller
+
+
+def admission_stats():
+    """Counters and histograms for the process-wide controller"""
+    return get_admission_controller().stats()
+
+
+def install_admission_control(app, paths=WRITE_PATHS):
+    """Queue ``app``'s write requests for a slot; shed with 503 past the deadline"""
+    from flask import request, jsonify, g
+
+    @app.before_request
+    def _admit():
+        if request.method != 'POST' or request.path not in paths:
+            return None
+        controller = get_admission_controller()
+        if controller.acquire():
+            g.admission_controller = controller
+            return None
+        response = jsonify({"success": False, "message": "Server busy, please retry shortly"})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(controller.retry_after())
+        return response
+
+    @app.teardown_request
+    def _release(exc=None):
+        controller = g.pop('admission_controller', None)
+        if controller is not None:
+            controller.release()
+
+    return app
@@ -9,72 +9,48 @@ import json
 import requests
 import os
 
+from database import transaction, connection, ensure_schema, is_busy_error, after_commit, savepoint
+from credits import debit_credit
+from usage_log import log_usage
+from codes import parse_code
+from lookup_cache import lookup_user
+from templates import render_methodology, LENGTH_INSTRUCTIONS, FORMAT_INSTRUCTIONS, TONE_INSTRUCTIONS, DESCRIPTION_CONTEXT
+from singleflight import coalesce_enhancement
+from balances import balance_changed
+from idempotency import idempotent
+from sessions import start_session, validate_session
+from metrics import timed_action
+from leases import reserve_lease, settle_lease, expire_leases, has_due_leases, DEFAULT_CREDITS as DEFAULT_LEASE_CREDITS, MAX_CREDITS as MAX_LEASE_CREDITS
+
 # Backend URL configuration
 BACKEND_URL = os.environ.get('BACKEND_URL', 'http://localhost:8501')
 
-def init_db():
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    
-    # Waiting list table (for initial registration)
-    c.execute('''CREATE TABLE IF NOT EXISTS waiting_list
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  name TEXT NOT NULL,
-                  email TEXT UNIQUE NOT NULL,
-                  reason TEXT,
-                  status TEXT DEFAULT 'pending',
-                  applied_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  approved_date TIMESTAMP,
-                  admin_notes TEXT)''')
-    
-    # Active users table (approved users)
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  name TEXT NOT NULL,
-                  email TEXT UNIQUE NOT NULL,
-                  redemption_code TEXT UNIQUE NOT NULL,
-                  credits INTEGER DEFAULT 100,
-                  used_credits INTEGER DEFAULT 0,
-                  status TEXT DEFAULT 'active',
-                  created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  last_used TIMESTAMP)''')
-    
-    # Usage logs
-    c.execute('''CREATE TABLE IF NOT EXISTS usage_logs
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_email TEXT,
-                  redemption_code TEXT,
-                  prompt_length INTEGER,
-                  response_length INTEGER,
-                  timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  ip_address TEXT)''')
-    
-    conn.commit()
-    conn.close()
+# Returned when the database is overloaded; HTTP layers answer 503
+BUSY_RESULT = {"success": False, "busy": True, "message": "Server busy, please retry shortly"}
+
+# Returned for a missing, expired, forged or revoked session token; HTTP layers answer 401
+UNAUTHORIZED_RESULT = {"success": False, "unauthorized": True, "message": "Session expired or revoked, verify again"}
 
 # User registration
 def register_user(name, email, reason):
     try:
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        
-        # Check if email already exists in waiting list or users
-        c.execute("SELECT email FROM waiting_list WHERE email = ?", (email,))
-        if c.fetchone():
-            return {"success": False, "message": "Email already registered in waiting list"}
+        with transaction() as conn:
+            c = conn.cursor()
         
-        c.execute("SELECT email FROM users WHERE email = ?", (email,))
-        if c.fetchone():
-            return {"success": False, "message": "Email already has an active account"}
+            # Check if email already exists in waiting list or users
+            c.execute("SELECT email FROM waiting_list WHERE email = ?", (email,))
+            if c.fetchone():
+                return {"success": False, "message": "Email already registered in waiting list"}
         
-        # Add to waiting list
-        c.execute('''INSERT INTO waiting_list (name, email, reason) 
-                     VALUES (?, ?, ?)''', (name, email, reason))
+            c.execute("SELECT email FROM users WHERE email = ?", (email,))
+            if c.fetchone():
+                return {"success": False, "message": "Email already has an active account"}
         
-        conn.commit()
-        conn.close()
+            # Add to waiting list
+            c.execute('''INSERT INTO waiting_list (name, email, reason) 
+                         VALUES (?, ?, ?)''', (name, email, reason))
         
-        return {"success": True, "message": "Registration submitted successfully! You'll receive an email when approved."}
+            return {"success": True, "message": "Registration submitted successfully! You'll receive an email when approved."}
         
     except Exception as e:
         return {"success": False, "message": f"Registration failed: {str(e)}"}
@@ -82,195 +58,256 @@ def register_user(name, email, reason):
 # Code verification
 def verify_code(email, code):
     try:
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
+        # Malformed codes never reach the database
+        code_id = parse_code(code)
+        if code_id is None:
+            return {"success": False, "message": "Invalid email or redemption code"}
         
         # Check if user exists with this email and code
-        c.execute('''SELECT name, credits, used_credits, status 
-                     FROM users 
-                     WHERE email = ? AND redemption_code = ? AND status = 'active' ''', 
-                  (email, code))
-        
-        user = c.fetchone()
-        if not user:
+        user = lookup_user(code_id)
+        if not user or user[1] != email or user[4] != 'active':
             return {"success": False, "message": "Invalid email or redemption code"}
         
-        name, credits, used_credits, status = user
+        name, _, credits, used_credits, status = user
         remaining_credits = credits - used_credits
         
-        # Update last used timestamp
-        c.execute('''UPDATE users 
-                     SET last_used = CURRENT_TIMESTAMP 
-                     WHERE email = ? AND redemption_code = ?''', 
-                  (email, code))
-        
-        conn.commit()
-        conn.close()
+        with transaction() as conn:
+            # Update last used timestamp and issue a session token
+            session = start_session(conn, email, code_id)
+            if session is None:
+                return {"success": False, "message": "Invalid email or redemption code"}
         
-        return {
-            "success": True, 
-            "message": "Verification successful!",
-            "user": {
-                "name": name,
-                "email": email,
-                "credits": remaining_credits,
-                "redemption_code": code
+            return {
+                "success": True, 
+                "message": "Verification successful!",
+                "user": {
+                    "name": name,
+                    "email": email,
+                    "credits": remaining_credits,
+                    "redemption_code": code
+                },
+                **session
             }
-        }
         
     except Exception as e:
         return {"success": False, "message": f"Verification failed: {str(e)}"}
 
-# Check user credits
-def check_credits(redemption_code):
+# Check user credits (by redemption code, or by a session token from verify_code)
+def check_credits(redemption_code=None, session=None):
     try:
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        
-        c.execute('''SELECT name, email, credits, used_credits, status 
-                     FROM users 
-                     WHERE redemption_code = ? AND status = 'active' ''', 
-                  (redemption_code,))
-        
-        user = c.fetchone()
-        if not user:
-            return {"success": False, "message": "Invalid redemption code"}
-        
-        name, email, credits, used_credits, status = user
-        remaining_credits = credits - used_credits
-        
-        return {
-            "success": True,
-            "user": {
-                "name": name,
-                "email": email,
-                "credits": remaining_credits,
-                "used_credits": used_credits,
-                "total_credits": credits
-            }
+        if session is not None:
+            claims = validate_session(session)
+            if claims is None:
+                return dict(UNAUTHORIZED_RESULT)
+            code_id = claims["code_id"]
+        else:
+            code_id = parse_code(redemption_code)
+        return _check_credits(code_id)
+    except Exception as e:
+        if is_busy_error(e):
+            return dict(BUSY_RESULT)
+        return {"success": False, "message": f"Credit check failed: {str(e)}"}
+
+def _check_credits(code_id):
+    if code_id is None:
+        return {"success": False, "message": "Invalid redemption code"}
+    _expire_due_leases(code_id)
+
+    user = lookup_user(code_id)
+    if not user or user[4] != 'active':
+        return {"success": False, "message": "Invalid redemption code"}
+
+    name, email, credits, used_credits, status = user
+    remaining_credits = credits - used_credits
+
+    return {
+        "success": True,
+        "remaining_credits": remaining_credits,
+        "user": {
+            "name": name,
+            "email": email,
+            "credits": remaining_credits,
+            "used_credits": used_credits,
+            "total_credits": credits
         }
-        
+    }
+
+def _expire_due_leases(code_id):
+    """Give back a lapsed lease's credits before the balance is read (writes only if one is due)"""
+    with connection() as conn:
+        due = has_due_leases(conn, code_id)
+    if due:
+        with transaction() as conn:
+            expire_leases(conn)
+            after_commit(balance_changed)
+
+# Who a balance stream / long poll follows, and their balance right now
+def watch_balance(redemption_code=None, session=None):
+    try:
+        if session is not None:
+            claims = validate_session(session)
+            if claims is None:
+                return dict(UNAUTHORIZED_RESULT)
+            code_id = claims["code_id"]
+        else:
+            code_id = parse_code(redemption_code)
+        result = _check_credits(code_id)
     except Exception as e:
+        if is_busy_error(e):
+            return dict(BUSY_RESULT)
         return {"success": False, "message": f"Credit check failed: {str(e)}"}
+    if not result["success"]:
+        return result
+    return {"success": True, "code_id": code_id, "remaining_credits": result["remaining_credits"]}
 
-# Use credit for prompt enhancement
-def use_credit(redemption_code):
+# Template options for the settings UI (session holders only; no database access)
+def list_templates(session):
+    if validate_session(session) is None:
+        return dict(UNAUTHORIZED_RESULT)
+    return {
+        "success": True,
+        "templates": {
+            "description": sorted(DESCRIPTION_CONTEXT),
+            "length": sorted(LENGTH_INSTRUCTIONS),
+            "format": sorted(FORMAT_INSTRUCTIONS),
+            "tone": sorted(TONE_INSTRUCTIONS),
+        }
+    }
+
+# Use credit for prompt enhancement (a retried Idempotency-Key is charged once)
+def use_credit(redemption_code, ip_address=None, idempotency_key=None):
     try:
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        
-        # Check current credits
-        c.execute('''SELECT email, credits, used_credits 
-                     FROM users 
-                     WHERE redemption_code = ? AND status = 'active' ''', 
-                  (redemption_code,))
-        
-        user = c.fetchone()
-        if not user:
-            return {"success": False, "message": "Invalid redemption code"}
-        
-        email, credits, used_credits = user
-        remaining_credits = credits - used_credits
-        
-        if remaining_credits <= 0:
-            return {"success": False, "message": "No credits remaining"}
-        
-        # Deduct one credit
-        c.execute('''UPDATE users 
-                     SET used_credits = used_credits + 1, last_used = CURRENT_TIMESTAMP 
-                     WHERE redemption_code = ?''', 
-                  (redemption_code,))
-        
-        # Log usage
-        c.execute('''INSERT INTO usage_logs (user_email, redemption_code, prompt_length, response_length) 
-                     VALUES (?, ?, ?, ?)''', 
-                  (email, redemption_code, 0, 0))  # Will be updated with actual lengths
+        result = idempotent(parse_code(redemption_code), idempotency_key, 'use_credit', None,
+                            lambda: _use_credit(redemption_code, ip_address))
+        after_commit(balance_changed)  # wake balance subscribers once committed
+        return result
+    except Exception as e:
+        if is_busy_error(e):
+            return dict(BUSY_RESULT)
+        return {"success": False, "message": f"Credit usage failed: {str(e)}"}
+
+def _use_credit(redemption_code, ip_address=None):
+    try:
+        with transaction() as conn:
+            # Check and deduct one credit in a single statement
+            debit = debit_credit(conn, redemption_code)
+            if not debit["success"]:
+                if debit["reason"] == 'no_credits':
+                    return {"success": False, "message": "No credits remaining"}
+                return {"success": False, "message": "Invalid redemption code"}
         
-        conn.commit()
-        conn.close()
+        # Log usage (queued, written in batches off the request path) - once
+        # the debit is committed, which inside a batch is only at its end
+        email = debit["email"]
+        after_commit(lambda: log_usage(email, redemption_code, 0, 0, ip_address=ip_address))
         
         return {
             "success": True, 
             "message": "Credit used successfully",
-            "remaining_credits": remaining_credits - 1
+            "remaining_credits": debit["remaining_credits"]
         }
         
     except Exception as e:
+        if is_busy_error(e):
+            return dict(BUSY_RESULT)
         return {"success": False, "message": f"Credit usage failed: {str(e)}"}
 
 # Enhanced prompt generation using Ben's methodology
 def generate_enhanced_prompt(original_prompt, settings):
     """
-    Generate enhanced prompt using Ben's methodology
+    Generate enhanced prompt using Ben's methodology (precompiled skeletons)
     """
-    role = settings.get('role', '')
-    description = settings.get('description', 'detailed')
-    length = settings.get('length', 'medium')
-    format_style = settings.get('format', 'structured')
-    tone = settings.get('tone', 'helpful')
-    
-    # Length mapping
-    length_instructions = {
-        'short': 'Keep the response concise and to the point',
-        'medium': 'Provide a comprehensive but focused response',
-        'long': 'Give a detailed, thorough explanation with examples'
-    }
-    
-    # Format mapping  
-    format_instructions = {
-        'structured': 'Use clear headings, bullet points, and logical organization',
-        'paragraph': 'Write in flowing paragraphs with smooth transitions',
-        'stepbystep': 'Break down into numbered steps or sequential instructions',
-        'creative': 'Use engaging, creative formatting with varied presentation styles'
-    }
-    
-    # Tone mapping
-    tone_instructions = {
-        'helpful': 'Be supportive, encouraging, and solution-focused',
-        'professional': 'Maintain formal, business-appropriate language',
-        'casual': 'Use conversational, friendly, and approachable language',
-        'technical': 'Focus on precision, accuracy, and technical detail'
-    }
-    
-    # Build enhanced prompt using Ben's structure
-    enhanced_sections = []
-    
-    # ROLE section
-    if role:
-        enhanced_sections.append(f"**ROLE**: You are {role}")
-    
-    # GOAL section  
-    enhanced_sections.append(f"**GOAL**: {original_prompt}")
-    
-    # CONTEXT section
-    context_parts = []
-    if description == 'detailed':
-        context_parts.append("Provide comprehensive information with relevant details")
-    elif description == 'summary':
-        context_parts.append("Focus on key points and essential information")
-    elif description == 'creative':
-        context_parts.append("Approach this with creativity and innovative thinking")
-    
-    if context_parts:
-        enhanced_sections.append(f"**CONTEXT**: {' and '.join(context_parts)}")
-    
-    # REQUIREMENTS section
-    requirements = []
-    requirements.append(length_instructions[length])
-    requirements.append(tone_instructions[tone])
-    
-    enhanced_sections.append(f"**REQUIREMENTS**: {' | '.join(requirements)}")
-    
-    # FORMAT section
-    enhanced_sections.append(f"**FORMAT**: {format_instructions[format_style]}")
-    
-    # WARNINGS section
-    enhanced_sections.append("**WARNINGS**: Ensure accuracy, avoid assumptions, and provide actionable insights")
-    
-    return "\n\n".join(enhanced_sections)
+    return render_methodology(original_prompt, settings)
+
+# Use a credit and enhance (identical concurrent requests share one run,
+# a retried Idempotency-Key is charged once)
+def enhance_prompt(redemption_code, prompt, settings, ip_address=None, idempotency_key=None):
+    def run():
+        result = use_credit(redemption_code, ip_address=ip_address)
+        if result['success']:
+            enhanced = generate_enhanced_prompt(prompt, settings)
+            return {
+                "success": True,
+                "enhanced_prompt": enhanced,
+                "remaining_credits": result['remaining_credits']
+            }
+        return result
+
+    code_id = parse_code(redemption_code)
+    try:
+        result = idempotent(code_id, idempotency_key, 'enhance', {"prompt": prompt, "settings": settings},
+                            lambda: coalesce_enhancement(code_id, prompt, settings, run))
+        after_commit(balance_changed)
+        return result
+    except Exception as e:
+        if is_busy_error(e):
+            return dict(BUSY_RESULT)
+        return {"success": False, "message": f"Enhancement failed: {str(e)}"}
+
+LEASE_FAILURES = {
+    'invalid': "Invalid redemption code or lease",
+    'inactive': "Invalid redemption code",
+    'no_credits': "No credits remaining",
+    'bad_spent': "spent must be between 0 and the credits leased",
+    'settled': "Lease was already settled with a different count",
+}
+
+# Reserve a block of credits to spend locally, settling the previous lease
+# in the same transaction (one round trip per block instead of per prompt)
+def reserve_credits(redemption_code, credits=DEFAULT_LEASE_CREDITS, previous=None,
+                    ip_address=None, idempotency_key=None):
+    if isinstance(credits, bool) or not isinstance(credits, int) or not 0 < credits <= MAX_LEASE_CREDITS:
+        return {"success": False, "message": f"credits must be 1-{MAX_LEASE_CREDITS}"}
+
+    def run():
+        with transaction() as conn:
+            settled = None
+            if previous is not None:
+                settled = _settle(conn, redemption_code, previous.get('lease'), previous.get('spent'),
+                                  ip_address)
+            lease = reserve_lease(conn, redemption_code, credits)
+        if not lease["success"]:
+            return {"success": False, "message": LEASE_FAILURES[lease["reason"]], "settled": settled}
+        del lease["email"]
+        return {**lease, "settled": settled}
+
+    try:
+        result = idempotent(parse_code(redemption_code), idempotency_key, 'lease',
+                            {"credits": credits, "previous": previous}, run)
+        after_commit(balance_changed)
+        return result
+    except Exception as e:
+        if is_busy_error(e):
+            return dict(BUSY_RESULT)
+        return {"success": False, "message": f"Lease failed: {str(e)}"}
+
+# Report how many leased credits were spent; the rest are returned
+def settle_credits(redemption_code, lease, spent, ip_address=None):
+    try:
+        with transaction() as conn:
+            result = _settle(conn, redemption_code, lease, spent, ip_address)
+        after_commit(balance_changed)
+        return result
+    except Exception as e:
+        if is_busy_error(e):
+            return dict(BUSY_RESULT)
+        return {"success": False, "message": f"Settlement failed: {str(e)}"}
+
+def _settle(conn, redemption_code, lease, spent, ip_address=None):
+    result = settle_lease(conn, redemption_code, lease, spent)
+    if not result["success"]:
+        return {"success": False, "message": LEASE_FAILURES[result["reason"]]}
+    email = result.pop("email")
+    if result["spent"] and not result.get("replayed"):
+        # One usage row for the whole block (queued, written after commit)
+        spent = result["spent"]
+        after_commit(lambda: log_usage(email, redemption_code, 0, 0, action='lease', credits_used=spent,
+                                       ip_address=ip_address))
+    return result
 
 # Simple API server simulation (for testing)
-def handle_api_request(endpoint, data):
+@timed_action(('/register', '/verify', '/check-credits', '/use-credit', '/enhance-prompt'))
+def handle_api_request(endpoint, data, ip_address=None):
     """
     Simulate API request handling
     """
@@ -281,20 +318,64 @@ def handle_api_request(endpoint, data):
     elif endpoint == '/check-credits':
         return check_credits(data.get('redemption_code'))
     elif endpoint == '/use-credit':
-        return use_credit(data.get('redemption_code'))
+        return use_credit(data.get('redemption_code'), ip_address=ip_address,
+                          idempotency_key=data.get('idempotency_key'))
     elif endpoint == '/enhance-prompt':
-        result = use_credit(data.get('redemption_code'))
-        if result['success']:
-            enhanced = generate_enhanced_prompt(data.get('prompt'), data.get('settings', {}))
-            return {
-                "success": True,
-                "enhanced_prompt": enhanced,
-                "remaining_credits": result['remaining_credits']
-            }
-        return result
+        return enhance_prompt(data.get('redemption_code'), data.get('prompt'), data.get('settings', {}),
+                              ip_address=ip_address, idempotency_key=data.get('idempotency_key'))
     else:
         return {"success": False, "message": "Unknown endpoint"}
 
+# Batch operations
+MAX_BATCH_OPERATIONS = int(os.environ.get('MAX_BATCH_OPERATIONS', '20'))
+
+BATCH_ENDPOINTS = {
+    'register': '/register',
+    'verify': '/verify',
+    'check_credits': '/check-credits',
+    'use_credit': '/use-credit',
+    'enhance_prompt': '/enhance-prompt',
+}
+
+def handle_batch_request(operations, ip_address=None):
+    """
+    Run an ordered list of operations in one transaction
+
+    Each operation is a dict with an "op" name plus the fields its endpoint
+    takes.  Later operations see earlier ones' writes.  Each runs under its
+    own savepoint, so a failed operation leaves no partial writes behind
+    and the rest still go through.  Usage rows and balance notifications
+    the operations queue are only sent once the whole batch has committed.
+    """
+    if not isinstance(operations, list) or not operations:
+        return {"success": False, "message": "operations must be a non-empty list"}
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        return {"success": False, "message": f"At most {MAX_BATCH_OPERATIONS} operations per batch"}
+
+    results = []
+    try:
+        with transaction():
+            for operation in operations:
+                endpoint = BATCH_ENDPOINTS.get(operation.get('op')) if isinstance(operation, dict) else None
+                if endpoint is None:
+                    results.append({"success": False, "message": "Unknown operation"})
+                    continue
+
+                with savepoint('batch_operation') as rollback:
+                    try:
+                        result = handle_api_request(endpoint, operation, ip_address=ip_address)
+                    except Exception as e:
+                        result = {"success": False, "message": f"Operation failed: {str(e)}"}
+                    if not result.get("success"):
+                        rollback()
+                results.append(result)
+    except Exception as e:
+        if is_busy_error(e):
+            return dict(BUSY_RESULT)
+        return {"success": False, "message": f"Batch failed: {str(e)}"}
+
+    return {"success": True, "results": results}
+
 if __name__ == "__main__":
-    init_db()
+    ensure_schema()
     print("API functions initialized")
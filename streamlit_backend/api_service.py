@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+Standalone HTTP API for the browser extension
+
+Serves the extension's routes (background.js calls check_credits and
+use_credit; enhance is the ENHANCE entry in its config) in its own
+multi-worker server process, independent of the Streamlit admin UI:
+
+    POST /api/verify             {"email": "...", "code": "..."} -> also a session token
+    GET  /api/check_credits?redemption_code=...  (or Authorization: Bearer <session>)
+    GET  /api/balance/stream?redemption_code=...  server-sent "balance" events (or ?session=...)
+    GET  /api/balance/poll?redemption_code=...&known=N  long poll until the balance is not N
+                                 (fallback: these hold a worker thread each and only a
+                                 few fit; balance_service.py serves them at scale)
+    GET  /api/templates          settings options (Authorization: Bearer <session>)
+    POST /api/use_credit         {"redemption_code": "..."}  (+ optional Idempotency-Key header)
+    POST /api/enhance            {"redemption_code": "...", "prompt": "...", "settings": {...}}
+    POST /api/lease              {"redemption_code": "...", "credits": N, "previous": {"lease": "...", "spent": n}}
+    POST /api/lease/settle       {"redemption_code": "...", "lease": "...", "spent": n}
+    POST /api/batch              {"operations": [{"op": "check_credits", ...}, ...]}
+    GET  /api/health             liveness
+    GET  /api/ready              readiness (schema migrated, database answers)
+    GET  /api/stats              this worker's coalescing, rate-limit and admission counters
+    GET  /metrics                this worker's request, action, DB and credit metrics (Prometheus text)
+
+Run:
+    python api_service.py                      # gunicorn, API_WORKERS processes
+    gunicorn -c api_service.py api_service:app # same thing, gunicorn CLI
+
+The schema is migrated once in the master, which then closes its
+connections before workers fork; each worker builds its own connection
+pool (database.get_pool is fork-aware) and every request thread reuses one
+pooled connection for its whole request.
+Without gunicorn installed, it falls back to a single-process threaded
+server.
+
+Settings: API_HOST, API_PORT (5000, background.js default), API_WORKERS,
+API_THREADS, API_READY_FILE (written once the port is bound, removed on exit),
+API_TRUSTED_PROXIES (proxy hops whose X-Forwarded-For is believed; default 0).
+Rate limits (429 before any database work) are described in ratelimit.py,
+write admission (503 past a bounded wait) in admission.py, Idempotency-Key
+retries of use_credit / enhance / lease in idempotency.py, credit leases in
+leases.py, session tokens in sessions.py, balance push in balances.py,
+metrics in metrics.py, opt-in SQL profiling in sqlprofile.py.
+"""
+
+import os
+import sys
+import signal
+import multiprocessing
+
+from flask import Flask, Response, request, jsonify
+from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from database import connection, ensure_schema, close_pools
+from api_endpoints import (verify_code, check_credits, watch_balance, list_templates,
+                           use_credit, enhance_prompt, handle_batch_request, MAX_BATCH_OPERATIONS,
+                           reserve_credits, settle_credits, DEFAULT_LEASE_CREDITS)
+from singleflight import singleflight_stats
+from ratelimit import install_rate_limits, rate_limit_stats
+from admission import install_admission_control, admission_stats, get_admission_controller
+from idempotency import valid_key
+from balances import get_balance_hub, balance_stats
+from metrics import install_metrics
+
+HOST = os.environ.get('API_HOST', '0.0.0.0')
+PORT = int(os.environ.get('API_PORT', '5000'))
+WORKERS = int(os.environ.get('API_WORKERS', str(min(multiprocessing.cpu_count() * 2 + 1, 9))))
+THREADS = int(os.environ.get('API_THREADS', '4'))
+READY_FILE = os.environ.get('API_READY_FILE')
+# Reverse proxies in front of us whose X-Forwarded-For can be trusted
+TRUSTED_PROXIES = int(os.environ.get('API_TRUSTED_PROXIES', '0'))
+
+BAD_IDEMPOTENCY_KEY = {"success": False, "message": "Idempotency-Key must be 1-255 printable characters"}
+
+
+def _respond(result, failure_status=200):
+    """JSON response; overload (result["busy"]) becomes 503 + Retry-After,
+    a reused Idempotency-Key 422, a bad session 401, and a replayed
+    Idempotency-Key says so in a header"""
+    if result.get("busy"):
+        response = jsonify(result)
+        response.status_code = 503
+        response.headers['Retry-After'] = str(get_admission_controller().retry_after())
+        return response
+    if result.get("conflict"):
+        return jsonify(result), 422
+    if result.get("unauthorized"):
+        return jsonify(result), 401
+    response = jsonify(result)
+    if result.get("replayed"):
+        response.headers['Idempotent-Replayed'] = 'true'
+    return response, 200 if result["success"] else failure_status
+
+
+def _bearer_token():
+    """The session token from ``Authorization: Bearer ...``, if any"""
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    return token.strip() if scheme.lower() == 'bearer' and token.strip() else None
+
+
+def _idempotency_key():
+    """The request's Idempotency-Key header: None if absent, False if malformed"""
+    key = request.headers.get('Idempotency-Key')
+    if key is None:
+        return None
+    return key if valid_key(key) else False
+
+
+def create_app():
+    """Flask app with the extension's routes"""
+    app = Flask(__name__)
+    CORS(app, origins=['*'])
+    if TRUSTED_PROXIES:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+    install_metrics(app)
+    install_rate_limits(app)
+    install_admission_control(app)
+
+    @app.route('/api/verify', methods=['POST'])
+    def api_verify():
+        data = request.get_json(silent=True) or {}
+        email = str(data.get('email') or '').strip().lower()
+        code = str(data.get('code') or '').strip().upper()
+        if not email or not code:
+            return jsonify({"success": False, "message": "email and code are required"}), 400
+        return _respond(verify_code(email, code))
+
+    @app.route('/api/check_credits', methods=['GET'])
+    def api_check_credits():
+        session = _bearer_token()
+        if session is not None:
+            return _respond(check_credits(session=session))
+        redemption_code = request.args.get('redemption_code', '').strip()
+        if not redemption_code:
+            return jsonify({"success": False, "message": "redemption_code is required"}), 400
+        return _respond(check_credits(redemption_code))
+
+    def _balance_subject():
+        session = _bearer_token() or request.args.get('session')  # EventSource can't set headers
+        redemption_code = request.args.get('redemption_code', '').strip()
+        if not session and not redemption_code:
+            return None, (jsonify({"success": False, "message": "redemption_code or session is required"}), 400)
+        subject = watch_balance(redemption_code, session=session)
+        if not subject["success"]:
+            return None, _respond(subject, 404)
+        return subject, None
+
+    def _too_many_watchers(message):
+        # Streams and long polls each hold a worker thread; the rest are kept for writes
+        response = jsonify({"success": False, "message": message})
+        response.status_code = 503
+        response.headers['Retry-After'] = '30'
+        return response
+
+    @app.route('/api/balance/stream', methods=['GET'])
+    def api_balance_stream():
+        subject, error = _balance_subject()
+        if error:
+            return error
+        events = get_balance_hub().stream(subject["code_id"], subject["remaining_credits"])
+        if events is None:
+            return _too_many_watchers("Too many open streams, use /api/balance/poll")
+        return Response(events, mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    @app.route('/api/balance/poll', methods=['GET'])
+    def api_balance_poll():
+        subject, error = _balance_subject()
+        if error:
+            return error
+        known = request.args.get('known')
+        timeout = request.args.get('timeout', '25')
+        try:
+            known = int(known) if known is not None else None
+            timeout = min(max(float(timeout), 0.0), 25.0)
+        except ValueError:
+            return jsonify({"success": False, "message": "known and timeout must be numbers"}), 400
+        remaining = get_balance_hub().poll(subject["code_id"], subject["remaining_credits"], known, timeout)
+        if remaining is None:
+            return _too_many_watchers("Too many open balance watches, use /api/check_credits")
+        return jsonify({"success": True, "remaining_credits": remaining})
+
+    @app.route('/api/templates', methods=['GET'])
+    def api_templates():
+        return _respond(list_templates(_bearer_token()))
+
+    @app.route('/api/use_credit', methods=['POST'])
+    def api_use_credit():
+        data = request.get_json(silent=True) or {}
+        redemption_code = str(data.get('redemption_code') or '').strip()
+        if not redemption_code:
+            return jsonify({"success": False, "message": "redemption_code is required"}), 400
+        key = _idempotency_key()
+        if key is False:
+            return jsonify(BAD_IDEMPOTENCY_KEY), 400
+        return _respond(use_credit(redemption_code, ip_address=request.remote_addr, idempotency_key=key))
+
+    @app.route('/api/enhance', methods=['POST'])
+    def api_enhance():
+        data = request.get_json(silent=True) or {}
+        redemption_code = str(data.get('redemption_code') or '').strip()
+        prompt = data.get('prompt')
+        if not redemption_code or not isinstance(prompt, str) or not prompt.strip():
+            return jsonify({"success": False, "message": "redemption_code and prompt are required"}), 400
+        key = _idempotency_key()
+        if key is False:
+            return jsonify(BAD_IDEMPOTENCY_KEY), 400
+        return _respond(enhance_prompt(redemption_code, prompt, data.get('settings') or {},
+                                       ip_address=request.remote_addr, idempotency_key=key))
+
+    @app.route('/api/lease', methods=['POST'])
+    def api_lease():
+        data = request.get_json(silent=True) or {}
+        redemption_code = str(data.get('redemption_code') or '').strip()
+        previous = data.get('previous')
+        if not redemption_code or not isinstance(previous, (dict, type(None))):
+            return jsonify({"success": False, "message": "redemption_code is required"}), 400
+        key = _idempotency_key()
+        if key is False:
+            return jsonify(BAD_IDEMPOTENCY_KEY), 400
+        result = reserve_credits(redemption_code, data.get('credits', DEFAULT_LEASE_CREDITS), previous,
+                                 ip_address=request.remote_addr, idempotency_key=key)
+        return _respond(result)
+
+    @app.route('/api/lease/settle', methods=['POST'])
+    def api_settle_lease():
+        data = request.get_json(silent=True) or {}
+        redemption_code = str(data.get('redemption_code') or '').strip()
+        if not redemption_code or not data.get('lease'):
+            return jsonify({"success": False, "message": "redemption_code and lease are required"}), 400
+        return _respond(settle_credits(redemption_code, data['lease'], data.get('spent'),
+                                       ip_address=request.remote_addr))
+
+    @app.route('/api/batch', methods=['POST'])
+    def api_batch():
+        data = request.get_json(silent=True) or {}
+        operations = data.get('operations')
+        if not isinstance(operations, list) or not 0 < len(operations) <= MAX_BATCH_OPERATIONS:
+            return jsonify({"success": False,
+                            "message": f"operations must be a list of 1-{MAX_BATCH_OPERATIONS} operations"}), 400
+        return _respond(handle_batch_request(operations, ip_address=request.remote_addr), 500)
+
+    @app.route('/api/health', methods=['GET'])
+    def api_health():
+        return jsonify({"status": "healthy", "pid": os.getpid()})
+
+    @app.route('/api/stats', methods=['GET'])
+    def api_stats():
+        # Per worker process: counters are not shared across workers
+        return jsonify({"pid": os.getpid(), "singleflight": singleflight_stats(),
+                        "rate_limits": rate_limit_stats(), "admission": admission_stats(),
+                        "balances": balance_stats()})
+
+    @app.route('/api/ready', methods=['GET'])
+    def api_ready():
+        try:
+            with connection() as conn:
+                conn.execute("SELECT 1 FROM users LIMIT 1").fetchall()
+        except Exception as e:
+            return jsonify({"ready": False, "message": str(e)}), 503
+        return jsonify({"ready": True, "pid": os.getpid()})
+
+    return app
+
+
+def _signal_ready(where):
+    print(f"✅ API ready on {where}")
+    if READY_FILE:
+        with open(READY_FILE, 'w') as f:
+            f.write(f"{os.getpid()}\n")
+
+
+# ---- gunicorn settings (read when run as ``gunicorn -c api_service.py``) ----
+
+bind = f"{HOST}:{PORT}"
+workers = WORKERS
+threads = THREADS
+worker_class = 'gthread'
+preload_app = True
+
+
+def on_starting(server):
+    # Migrate in the master, then let go of its connections before any
+    # worker forks: workers must not inherit an open SQLite handle
+    ensure_schema()
+    close_pools()
+
+
+def when_ready(server):
+    _signal_ready(bind)
+
+
+def on_exit(server):
+    if READY_FILE and os.path.exists(READY_FILE):
+        os.remove(READY_FILE)
+
+
+app = create_app()
+
+
+def main():
+    ensure_schema()
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        from werkzeug.serving import make_server
+
+        print("⚠️ gunicorn not installed - serving from one threaded process")
+        server = make_server(HOST, PORT, app, threaded=True)  # bound on return
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        _signal_ready(f"{HOST}:{PORT}")
+        try:
+            server.serve_forever()
+        finally:
+            on_exit(None)
+        return
+
+    close_pools()  # migrated; workers open their own
+
+    class APIServer(BaseApplication):
+        def load_config(self):
+            for key, value in {
+                'bind': bind, 'workers': workers, 'threads': threads,
+                'worker_class': worker_class, 'preload_app': preload_app,
+                'when_ready': when_ready, 'on_exit': on_exit,
+            }.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    print(f"🚀 Starting API with {workers} workers x {threads} threads")
+    APIServer().run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -12,83 +12,50 @@ from flask_cors import CORS
 import threading
 import time
 
+from database import DB_PATH, connection, transaction, snapshot
+from credits import debit_credit
+from usage_log import log_usage
+from rollups import get_counters, daily_usage
+from approvals import bulk_approve, approved_codes_csv
+from codes import issue_code, parse_code
+from lookup_cache import lookup_user, lookup_cache_stats
+from output_cache import memoized_enhancement, output_cache_stats
+from templates import render_methodology
+from singleflight import coalesce_enhancement, singleflight_stats
+from sessions import start_session, validate_session, get_session_epochs
+from metrics import timed_action
+from sqlprofile import get_sql_profiler, sql_profile_stats, sql_profile_top
+
 # Simple secure password - change this!
 ADMIN_PASSWORD = "admin123"
 
 # Helper function to get absolute database path
 def get_db_path():
     """Get the absolute path to the users.db file."""
-    return os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'users.db')
+    return DB_PATH
 
 # Flask app for API endpoints
 flask_app = Flask(__name__)
 flask_app.secret_key = "your-secret-key-change-this"
 CORS(flask_app, origins=['*'])  # Allow all origins for GitHub Pages
 
-# Initialize database with clean schema
-def init_db():
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    
-    # Waiting list table (for initial registration)
-    c.execute('''CREATE TABLE IF NOT EXISTS waiting_list
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  name TEXT NOT NULL,
-                  email TEXT UNIQUE NOT NULL,
-                  reason TEXT,
-                  status TEXT DEFAULT 'pending',
-                  applied_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  approved_date TIMESTAMP,
-                  admin_notes TEXT)''')
-    
-    # Active users table (approved users)
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  name TEXT NOT NULL,
-                  email TEXT UNIQUE NOT NULL,
-                  redemption_code TEXT UNIQUE NOT NULL,
-                  credits INTEGER DEFAULT 100,
-                  used_credits INTEGER DEFAULT 0,
-                  status TEXT DEFAULT 'active',
-                  created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  last_used TIMESTAMP)''')
-    
-    # Usage logs
-    c.execute('''CREATE TABLE IF NOT EXISTS usage_logs
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_email TEXT,
-                  redemption_code TEXT,
-                  prompt_length INTEGER,
-                  response_length INTEGER,
-                  timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  ip_address TEXT)''')
-    
-    conn.commit()
-    conn.close()
-
-# Generate unique code
-def generate_code():
-    return ''.join(secrets.choice(string.ascii_uppercase + string.digits) for _ in range(8))
-
 # Registration function (for API)
 def register_user(name, email, reason):
     """Add user to waiting list"""
     try:
-        conn = sqlite3.connect(get_db_path())
-        c = conn.cursor()
+        with transaction() as conn:
+            c = conn.cursor()
         
-        # Check if email already exists
-        c.execute("SELECT email FROM waiting_list WHERE email = ?", (email,))
-        if c.fetchone():
-            return {"success": False, "message": "Email already registered"}
+            # Check if email already exists
+            c.execute("SELECT email FROM waiting_list WHERE email = ?", (email,))
+            if c.fetchone():
+                return {"success": False, "message": "Email already registered"}
         
-        # Add to waiting list
-        c.execute("""INSERT INTO waiting_list (name, email, reason) 
-                     VALUES (?, ?, ?)""", (name, email, reason))
-        conn.commit()
-        conn.close()
+            # Add to waiting list
+            c.execute("""INSERT INTO waiting_list (name, email, reason) 
+                         VALUES (?, ?, ?)""", (name, email, reason))
         
-        return {"success": True, "message": "Successfully added to waiting list"}
+            return {"success": True, "message": "Successfully added to waiting list"}
     except Exception as e:
         return {"success": False, "message": f"Registration failed: {str(e)}"}
 
@@ -96,38 +63,30 @@ def register_user(name, email, reason):
 def approve_user(email, admin_notes=""):
     """Approve waiting list user and create active account"""
     try:
-        conn = sqlite3.connect(get_db_path())
-        c = conn.cursor()
-        
-        # Get user from waiting list
-        c.execute("SELECT name, email FROM waiting_list WHERE email = ? AND status = 'pending'", (email,))
-        user = c.fetchone()
+        with transaction() as conn:
+            c = conn.cursor()
         
-        if not user:
-            return {"success": False, "message": "User not found or already processed"}
+            # Get user from waiting list
+            c.execute("SELECT name, email FROM waiting_list WHERE email = ? AND status = 'pending'", (email,))
+            user = c.fetchone()
         
-        name, email = user
+            if not user:
+                return {"success": False, "message": "User not found or already processed"}
         
-        # Generate unique code
-        code = generate_code()
-        while True:
-            c.execute("SELECT redemption_code FROM users WHERE redemption_code = ?", (code,))
-            if not c.fetchone():
-                break
-            code = generate_code()
+            name, email = user
         
-        # Create active user account
-        c.execute("""INSERT INTO users (name, email, redemption_code, credits, status) 
-                     VALUES (?, ?, ?, 100, 'active')""", (name, email, code))
+            # Reserve a unique code
+            code = issue_code(conn)
         
-        # Update waiting list status
-        c.execute("""UPDATE waiting_list SET status = 'approved', approved_date = CURRENT_TIMESTAMP, 
-                     admin_notes = ? WHERE email = ?""", (admin_notes, email))
+            # Create active user account
+            c.execute("""INSERT INTO users (name, email, redemption_code, code_id, credits, status) 
+                         VALUES (?, ?, ?, ?, 100, 'active')""", (name, email, code, parse_code(code)))
         
-        conn.commit()
-        conn.close()
+            # Update waiting list status
+            c.execute("""UPDATE waiting_list SET status = 'approved', approved_date = CURRENT_TIMESTAMP, 
+                         admin_notes = ? WHERE email = ?""", (admin_notes, email))
         
-        return {"success": True, "code": code, "message": "User approved successfully"}
+            return {"success": True, "code": code, "message": "User approved successfully"}
     except Exception as e:
         return {"success": False, "message": f"Approval failed: {str(e)}"}
 
@@ -135,17 +94,15 @@ def approve_user(email, admin_notes=""):
 def verify_code(email, code):
     """Verify redemption code and email combination"""
     try:
-        conn = sqlite3.connect(get_db_path())
-        c = conn.cursor()
-        
-        c.execute("""SELECT name, credits, used_credits, status FROM users 
-                     WHERE email = ? AND redemption_code = ?""", (email, code))
-        user = c.fetchone()
+        code_id = parse_code(code)
+        if code_id is None:
+            return {"success": False, "message": "Invalid code or email"}
         
-        if not user:
+        user = lookup_user(code_id)
+        if not user or user[1] != email:
             return {"success": False, "message": "Invalid code or email"}
         
-        name, credits, used_credits, status = user
+        name, _, credits, used_credits, status = user
         
         if status != 'active':
             return {"success": False, "message": "Account is not active"}
@@ -162,6 +119,7 @@ def verify_code(email, code):
         return {"success": False, "message": f"Verification failed: {str(e)}"}
 
 # Enhanced prompt template with Ben's methodology
+@memoized_enhancement
 def create_enhanced_prompt(original_prompt, settings):
     role = settings.get('role', 'AI Assistant')
     description = settings.get('description', 'detailed')
@@ -226,51 +184,67 @@ Please provide your response following this comprehensive briefing."""
 
 # Use credits and log usage
 def use_credit_and_enhance(email, redemption_code, prompt, settings):
-    """Use one credit and enhance prompt"""
+    """Use one credit and enhance prompt (identical concurrent requests share one run)"""
+    return coalesce_enhancement(parse_code(redemption_code), prompt, settings,
+                                lambda: _use_credit_and_enhance(email, redemption_code, prompt, settings),
+                                email=email)
+
+def _use_credit_and_enhance(email, redemption_code, prompt, settings):
     try:
-        conn = sqlite3.connect(get_db_path())
-        c = conn.cursor()
-        
-        # Verify user and credits
-        c.execute("""SELECT credits, used_credits, status FROM users 
-                     WHERE email = ? AND redemption_code = ?""", (email, redemption_code))
-        user = c.fetchone()
-        
-        if not user:
-            return {"success": False, "message": "Invalid credentials"}
-        
-        credits, used_credits, status = user
-        remaining_credits = credits - used_credits
-        
-        if status != 'active':
-            return {"success": False, "message": "Account not active"}
-        
-        if remaining_credits <= 0:
-            return {"success": False, "message": "No credits remaining"}
-        
-        # Enhance the prompt
+        # Enhance the prompt (pure CPU work, kept outside the write lock)
         enhanced_prompt = create_enhanced_prompt(prompt, settings)
         
-        # Use one credit
-        c.execute("""UPDATE users SET used_credits = used_credits + 1, last_used = CURRENT_TIMESTAMP 
-                     WHERE email = ? AND redemption_code = ?""", (email, redemption_code))
-        
-        # Log usage
-        c.execute("""INSERT INTO usage_logs (user_email, redemption_code, prompt_length, response_length) 
-                     VALUES (?, ?, ?, ?)""", (email, redemption_code, len(prompt), len(enhanced_prompt)))
+        with transaction() as conn:
+            # Check and use one credit in a single statement
+            debit = debit_credit(conn, redemption_code, email=email)
+            if not debit["success"]:
+                return {"success": False, "message": {
+                    'invalid': "Invalid credentials",
+                    'inactive': "Account not active",
+                }.get(debit["reason"], "No credits remaining")}
         
-        conn.commit()
-        conn.close()
+        # Log usage (queued, written in batches off the request path)
+        log_usage(email, redemption_code, len(prompt), len(enhanced_prompt))
         
         return {
             "success": True,
             "enhanced_prompt": enhanced_prompt,
-            "credits_remaining": remaining_credits - 1,
+            "credits_remaining": debit["remaining_credits"],
             "message": "Prompt enhanced successfully"
         }
     except Exception as e:
         return {"success": False, "message": f"Enhancement failed: {str(e)}"}
 
+def load_dashboard_data():
+    """Everything the admin tabs show, read in one consistent snapshot
+
+    The read transaction covers only the queries; rendering happens after it
+    has ended, so a slow render never pins a snapshot or a connection.
+    """
+    with snapshot() as conn:
+        return {
+            "pending": conn.execute("""
+                SELECT id, name, email, reason, applied_date 
+                FROM waiting_list 
+                WHERE status = 'pending' 
+                ORDER BY applied_date DESC
+            """).fetchall(),
+            "users": conn.execute("""
+                SELECT name, email, redemption_code, credits, used_credits, created_date, last_used, status
+                FROM users 
+                ORDER BY created_date DESC
+            """).fetchall(),
+            # Trigger-maintained counters, see rollups.py
+            "counters": get_counters(conn),
+            "daily": daily_usage(conn, days=14),
+            "recent_usage": conn.execute("""
+                SELECT ul.user_email, ul.timestamp, ul.prompt_length, ul.response_length
+                FROM usage_logs ul
+                ORDER BY ul.timestamp DESC
+                LIMIT 10
+            """).fetchall(),
+        }
+
 # Admin Dashboard Interface
 def admin_dashboard():
     """Protected admin interface"""
@@ -303,6 +277,9 @@ def admin_dashboard():
             st.session_state.admin_logged_in = False
             st.rerun()
     
+    # One snapshot per render: every tab sees the same state of the database
+    data = load_dashboard_data()
+    
     # Main dashboard tabs
     tab1, tab2, tab3, tab4 = st.tabs(["📝 Applications", "👥 Active Users", "📊 Analytics", "⚙️ Manual Tools"])
     
@@ -310,14 +287,38 @@ def admin_dashboard():
         st.subheader("📋 Pending Applications")
         
         # Get pending applications
-        conn = sqlite3.connect(get_db_path())
-        pending = conn.execute("""
-            SELECT id, name, email, reason, applied_date 
-            FROM waiting_list 
-            WHERE status = 'pending' 
-            ORDER BY applied_date DESC
-        """).fetchall()
-        conn.close()
+        pending = data["pending"]
+        
+        # Result of the last bulk approval survives the rerun so the CSV stays downloadable
+        bulk_result = st.session_state.get("bulk_result")
+        if bulk_result:
+            st.success(f"✅ {bulk_result['message']} in {bulk_result['elapsed'] * 1000:.0f} ms "
+                       f"({bulk_result['per_second']:,.0f} approvals/s)")
+            st.download_button("📥 Download issued codes (CSV)",
+                               approved_codes_csv(bulk_result["approved"]),
+                               file_name="redemption_codes.csv", mime="text/csv")
+            if st.button("Dismiss", key="dismiss_bulk"):
+                del st.session_state["bulk_result"]
+                st.rerun()
+        
+        if pending:
+            with st.expander(f"⚡ Bulk Approve ({len(pending)} pending)"):
+                scope = st.radio("Approve", ["All pending", "Matching search", "Selected"], horizontal=True)
+                search = selected = None
+                if scope == "Matching search":
+                    search = st.text_input("Name or email contains")
+                elif scope == "Selected":
+                    labels = {app_id: f"{name} ({email})" for app_id, name, email, _, _ in pending}
+                    selected = st.multiselect("Applications", list(labels), format_func=labels.get)
+                
+                ready = scope == "All pending" or (scope == "Matching search" and search) or bool(selected)
+                if st.button("✅ Approve All", disabled=not ready, key="bulk_approve"):
+                    try:
+                        with transaction() as conn:
+                            st.session_state["bulk_result"] = bulk_approve(conn, ids=selected, search=search)
+                        st.rerun()
+                    except sqlite3.Error as e:
+                        st.error(f"Bulk approval failed: {e}")
         
         if pending:
             for app_id, name, email, reason, applied_date in pending:
@@ -342,11 +343,9 @@ def admin_dashboard():
                     
                     with col3:
                         if st.button("❌ Reject", key=f"reject_{app_id}"):
-                            conn = sqlite3.connect(get_db_path())
-                            conn.execute("""UPDATE waiting_list SET status = 'rejected' 
-                                          WHERE id = ?""", (app_id,))
-                            conn.commit()
-                            conn.close()
+                            with transaction() as conn:
+                                conn.execute("""UPDATE waiting_list SET status = 'rejected' 
+                                              WHERE id = ?""", (app_id,))
                             st.success("Application rejected")
                             st.rerun()
                     
@@ -358,13 +357,7 @@ def admin_dashboard():
         st.subheader("👥 Active Users")
         
         # Get active users
-        conn = sqlite3.connect(get_db_path())
-        users = conn.execute("""
-            SELECT name, email, redemption_code, credits, used_credits, created_date, last_used, status
-            FROM users 
-            ORDER BY created_date DESC
-        """).fetchall()
-        conn.close()
+        users = data["users"]
         
         if users:
             for name, email, code, credits, used, created, last_used, status in users:
@@ -392,10 +385,10 @@ def admin_dashboard():
                         
                         if status == "active":
                             if st.button("🚫 Revoke", key=f"revoke_{code}"):
-                                conn = sqlite3.connect(get_db_path())
-                                conn.execute("UPDATE users SET status = 'revoked' WHERE redemption_code = ?", (code,))
-                                conn.commit()
-                                conn.close()
+                                # The status change also bumps the user's session epoch
+                                with transaction() as conn:
+                                    conn.execute("UPDATE users SET status = 'revoked' WHERE code_id = ?", (parse_code(code),))
+                                get_session_epochs().invalidate()
                                 st.success("Access revoked")
                                 st.rerun()
                     
@@ -406,35 +399,83 @@ def admin_dashboard():
     with tab3:
         st.subheader("📊 System Analytics")
         
-        conn = sqlite3.connect(get_db_path())
-        
         # Overall stats
+        counters = data["counters"]
         col1, col2, col3, col4 = st.columns(4)
         
         with col1:
-            total_apps = conn.execute("SELECT COUNT(*) FROM waiting_list").fetchone()[0]
-            st.metric("Total Applications", total_apps)
+            st.metric("Total Applications", counters['waiting_list.total'])
         
         with col2:
-            pending_apps = conn.execute("SELECT COUNT(*) FROM waiting_list WHERE status = 'pending'").fetchone()[0]
-            st.metric("Pending", pending_apps)
+            st.metric("Pending", counters['waiting_list.status.pending'])
         
         with col3:
-            active_users = conn.execute("SELECT COUNT(*) FROM users WHERE status = 'active'").fetchone()[0]
-            st.metric("Active Users", active_users)
+            st.metric("Active Users", counters['users.status.active'])
         
         with col4:
-            total_usage = conn.execute("SELECT COUNT(*) FROM usage_logs").fetchone()[0]
-            st.metric("Total API Calls", total_usage)
-        
+            st.metric("Total API Calls", counters['usage_logs.total'])
+        
+        # Daily usage
+        daily = data["daily"]
+        if daily:
+            st.subheader("📅 Daily Usage")
+            st.bar_chart([{"day": row[0], "calls": row[1]} for row in reversed(daily)],
+                         x="day", y="calls")
+
+        # Code lookup cache
+        with st.expander("⚡ Code Lookup Cache"):
+            cache = lookup_cache_stats()
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Hit Rate", f"{cache['hit_rate']:.1%}")
+            col2.metric("Cached Codes", f"{cache['size']}/{cache['max_entries']}")
+            col3.metric("Invalidations", cache['invalidations'])
+            st.caption(f"{cache['hits']} hits, {cache['misses']} misses, "
+                       f"{cache['evictions']} evicted, {cache['flushes']} full flushes")
+
+        # Enhancement output cache
+        with st.expander("🧠 Enhancement Output Cache"):
+            cache = output_cache_stats()
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Hit Rate", f"{cache['hit_rate']:.1%}")
+            col2.metric("Cached Outputs", cache['entries'])
+            col3.metric("Memory", f"{cache['bytes'] / 1024 / 1024:.1f}/{cache['max_bytes'] / 1024 / 1024:.0f} MB")
+            st.caption(f"{cache['hits']} hits, {cache['misses']} misses, {cache['evictions']} evicted")
+
+        # Duplicate enhancement requests
+        with st.expander("🔁 Duplicate Request Coalescing"):
+            flights = singleflight_stats()
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Processed", flights['leaders'])
+            col2.metric("Shared In-Flight", flights['shared'])
+            col3.metric("Replayed", flights['replayed'])
+            st.caption(f"Replay window {flights['window']:g}s, {flights['in_flight']} in flight now")
+
+        # SQL statement profile (SQL_PROFILE=1)
+        with st.expander("🐢 SQL Statement Profile"):
+            profile = sql_profile_stats()
+            if not profile['enabled']:
+                st.info("Start the app with SQL_PROFILE=1 to time every SQL statement")
+            else:
+                col1, col2, col3 = st.columns(3)
+                col1.metric("Statements", profile['statements'])
+                col2.metric("Calls", profile['calls'])
+                col3.metric(f"Slow (≥ {profile['slow_ms']:g} ms)", profile['slow'])
+                top_n = st.slider("Top statements", 5, 50, 15)
+                order = st.selectbox("Order by", ["total_ms", "p99_ms", "calls", "rows", "vm_ops"])
+                st.dataframe(sql_profile_top(top_n, order), use_container_width=True)
+                slow = list(get_sql_profiler().slow)
+                if slow:
+                    st.caption("Recent slow statements")
+                    st.dataframe([{"when": datetime.fromtimestamp(q['at']).strftime('%H:%M:%S'),
+                                   "ms": round(q['ms'], 1), "rows": q['rows'], "statement": q['statement']}
+                                  for q in reversed(slow)], use_container_width=True)
+                if st.button("Reset SQL profile"):
+                    get_sql_profiler().reset()
+                    st.rerun()
+
         # Recent usage
         st.subheader("🕐 Recent Usage")
-        recent_usage = conn.execute("""
-            SELECT ul.user_email, ul.timestamp, ul.prompt_length, ul.response_length
-            FROM usage_logs ul
-            ORDER BY ul.timestamp DESC
-            LIMIT 10
-        """).fetchall()
+        recent_usage = data["recent_usage"]
         
         if recent_usage:
             for email, timestamp, prompt_len, response_len in recent_usage:
@@ -443,8 +484,6 @@ def admin_dashboard():
                 st.divider()
         else:
             st.info("📊 No usage data yet")
-        
-        conn.close()
     
     with tab4:
         st.subheader("🔧 Manual Tools")
@@ -458,53 +497,40 @@ def admin_dashboard():
             
             if st.form_submit_button("Generate Code"):
                 if manual_name and manual_email:
-                    # Generate code directly
-                    code = generate_code()
-                    conn = sqlite3.connect(get_db_path())
-                    
                     try:
-                        # Ensure unique code
-                        while True:
-                            c = conn.execute("SELECT redemption_code FROM users WHERE redemption_code = ?", (code,))
-                            if not c.fetchone():
-                                break
-                            code = generate_code()
-                        
-                        conn.execute("""INSERT INTO users (name, email, redemption_code, credits) 
-                                       VALUES (?, ?, ?, ?)""", (manual_name, manual_email, code, manual_credits))
-                        conn.commit()
+                        with transaction() as conn:
+                            # Reserve a unique code
+                            code = issue_code(conn)
+                            
+                            conn.execute("""INSERT INTO users (name, email, redemption_code, code_id, credits) 
+                                           VALUES (?, ?, ?, ?, ?)""", (manual_name, manual_email, code, parse_code(code), manual_credits))
                         st.success(f"✅ Code generated successfully!")
                         st.code(f"Redemption Code: {code}")
                         st.info("📧 Send this code to the user")
                     except sqlite3.IntegrityError:
                         st.error("❌ Email already exists")
-                    finally:
-                        conn.close()
 
 # API Functions for frontend integration
 def api_register_user(name, email, reason):
     """Handle user registration from frontend form"""
     try:
-        conn = sqlite3.connect(get_db_path())
-        c = conn.cursor()
-        
-        # Check if email already exists
-        c.execute("SELECT email FROM waiting_list WHERE email = ?", (email,))
-        if c.fetchone():
-            return {"success": False, "message": "Email already registered in waiting list"}
+        with transaction() as conn:
+            c = conn.cursor()
         
-        c.execute("SELECT email FROM users WHERE email = ?", (email,))
-        if c.fetchone():
-            return {"success": False, "message": "Email already has an active account"}
+            # Check if email already exists
+            c.execute("SELECT email FROM waiting_list WHERE email = ?", (email,))
+            if c.fetchone():
+                return {"success": False, "message": "Email already registered in waiting list"}
         
-        # Add to waiting list
-        c.execute('''INSERT INTO waiting_list (name, email, reason) 
-                     VALUES (?, ?, ?)''', (name, email, reason))
+            c.execute("SELECT email FROM users WHERE email = ?", (email,))
+            if c.fetchone():
+                return {"success": False, "message": "Email already has an active account"}
         
-        conn.commit()
-        conn.close()
+            # Add to waiting list
+            c.execute('''INSERT INTO waiting_list (name, email, reason) 
+                         VALUES (?, ?, ?)''', (name, email, reason))
         
-        return {"success": True, "message": "Registration submitted successfully! You'll receive an email when approved."}
+            return {"success": True, "message": "Registration submitted successfully! You'll receive an email when approved."}
         
     except Exception as e:
         return {"success": False, "message": f"Registration failed: {str(e)}"}
@@ -512,57 +538,53 @@ def api_register_user(name, email, reason):
 def api_verify_code(email, code):
     """Verify redemption code and return user info"""
     try:
-        conn = sqlite3.connect(get_db_path())
-        c = conn.cursor()
-        
-        c.execute('''SELECT name, credits, used_credits, status 
-                     FROM users 
-                     WHERE email = ? AND redemption_code = ? AND status = 'active' ''', 
-                  (email, code))
+        code_id = parse_code(code)
+        if code_id is None:
+            return {"success": False, "message": "Invalid email or redemption code"}
         
-        user = c.fetchone()
-        if not user:
+        user = lookup_user(code_id)
+        if not user or user[1] != email or user[4] != 'active':
             return {"success": False, "message": "Invalid email or redemption code"}
         
-        name, credits, used_credits, status = user
+        name, _, credits, used_credits, status = user
         remaining_credits = credits - used_credits
         
-        # Update last used timestamp
-        c.execute('''UPDATE users 
-                     SET last_used = CURRENT_TIMESTAMP 
-                     WHERE email = ? AND redemption_code = ?''', 
-                  (email, code))
+        with transaction() as conn:
+            # Update last used timestamp and issue a session token
+            session = start_session(conn, email, code_id)
+            if session is None:
+                return {"success": False, "message": "Invalid email or redemption code"}
         
-        conn.commit()
-        conn.close()
-        
-        return {
-            "success": True, 
-            "message": "Verification successful!",
-            "user": {
-                "name": name,
-                "email": email,
-                "credits": remaining_credits,
-                "redemption_code": code
+            return {
+                "success": True, 
+                "message": "Verification successful!",
+                "user": {
+                    "name": name,
+                    "email": email,
+                    "credits": remaining_credits,
+                    "redemption_code": code
+                },
+                **session
             }
-        }
         
     except Exception as e:
         return {"success": False, "message": f"Verification failed: {str(e)}"}
 
-def api_check_credits(redemption_code):
-    """Check remaining credits for a user"""
+def api_check_credits(redemption_code=None, session=None):
+    """Check remaining credits for a user (by code, or by a session token from api_verify_code)"""
     try:
-        conn = sqlite3.connect(get_db_path())
-        c = conn.cursor()
-        
-        c.execute('''SELECT name, email, credits, used_credits, status 
-                     FROM users 
-                     WHERE redemption_code = ? AND status = 'active' ''', 
-                  (redemption_code,))
+        if session:
+            claims = validate_session(session)
+            if claims is None:
+                return {"success": False, "message": "Session expired or revoked, verify again"}
+            code_id = claims["code_id"]
+        else:
+            code_id = parse_code(redemption_code)
+        if code_id is None:
+            return {"success": False, "message": "Invalid redemption code"}
         
-        user = c.fetchone()
-        if not user:
+        user = lookup_user(code_id)
+        if not user or user[4] != 'active':
             return {"success": False, "message": "Invalid redemption code"}
         
         name, email, credits, used_credits, status = user
@@ -585,43 +607,21 @@ def api_check_credits(redemption_code):
 def api_use_credit(redemption_code):
     """Use one credit for prompt enhancement"""
     try:
-        conn = sqlite3.connect(get_db_path())
-        c = conn.cursor()
-        
-        # Check current credits
-        c.execute('''SELECT email, credits, used_credits 
-                     FROM users 
-                     WHERE redemption_code = ? AND status = 'active' ''', 
-                  (redemption_code,))
-        
-        user = c.fetchone()
-        if not user:
-            return {"success": False, "message": "Invalid redemption code"}
-        
-        email, credits, used_credits = user
-        remaining_credits = credits - used_credits
-        
-        if remaining_credits <= 0:
-            return {"success": False, "message": "No credits remaining"}
-        
-        # Deduct one credit
-        c.execute('''UPDATE users 
-                     SET used_credits = used_credits + 1, last_used = CURRENT_TIMESTAMP 
-                     WHERE redemption_code = ?''', 
-                  (redemption_code,))
-        
-        # Log usage
-        c.execute('''INSERT INTO usage_logs (user_email, redemption_code, prompt_length, response_length) 
-                     VALUES (?, ?, ?, ?)''', 
-                  (email, redemption_code, 0, 0))
+        with transaction() as conn:
+            # Check and deduct one credit in a single statement
+            debit = debit_credit(conn, redemption_code)
+            if not debit["success"]:
+                if debit["reason"] == 'no_credits':
+                    return {"success": False, "message": "No credits remaining"}
+                return {"success": False, "message": "Invalid redemption code"}
         
-        conn.commit()
-        conn.close()
+        # Log usage (queued, written in batches off the request path)
+        log_usage(debit["email"], redemption_code, 0, 0)
         
         return {
             "success": True, 
             "message": "Credit used successfully",
-            "remaining_credits": remaining_credits - 1
+            "remaining_credits": debit["remaining_credits"]
         }
         
     except Exception as e:
@@ -629,74 +629,11 @@ def api_use_credit(redemption_code):
 
 # Enhanced prompt generation using Ben's methodology
 def api_generate_enhanced_prompt(original_prompt, settings):
-    """Generate enhanced prompt using Ben's methodology"""
-    role = settings.get('role', '')
-    description = settings.get('description', 'detailed')
-    length = settings.get('length', 'medium')
-    format_style = settings.get('format', 'structured')
-    tone = settings.get('tone', 'helpful')
-    
-    # Length mapping
-    length_instructions = {
-        'short': 'Keep the response concise and to the point',
-        'medium': 'Provide a comprehensive but focused response',
-        'long': 'Give a detailed, thorough explanation with examples'
-    }
-    
-    # Format mapping  
-    format_instructions = {
-        'structured': 'Use clear headings, bullet points, and logical organization',
-        'paragraph': 'Write in flowing paragraphs with smooth transitions',
-        'stepbystep': 'Break down into numbered steps or sequential instructions',
-        'creative': 'Use engaging, creative formatting with varied presentation styles'
-    }
-    
-    # Tone mapping
-    tone_instructions = {
-        'helpful': 'Be supportive, encouraging, and solution-focused',
-        'professional': 'Maintain formal, business-appropriate language',
-        'casual': 'Use conversational, friendly, and approachable language',
-        'technical': 'Focus on precision, accuracy, and technical detail'
-    }
-    
-    # Build enhanced prompt using Ben's structure
-    enhanced_sections = []
-    
-    # ROLE section
-    if role:
-        enhanced_sections.append(f"**ROLE**: You are {role}")
-    
-    # GOAL section  
-    enhanced_sections.append(f"**GOAL**: {original_prompt}")
-    
-    # CONTEXT section
-    context_parts = []
-    if description == 'detailed':
-        context_parts.append("Provide comprehensive information with relevant details")
-    elif description == 'summary':
-        context_parts.append("Focus on key points and essential information")
-    elif description == 'creative':
-        context_parts.append("Approach this with creativity and innovative thinking")
-    
-    if context_parts:
-        enhanced_sections.append(f"**CONTEXT**: {' and '.join(context_parts)}")
-    
-    # REQUIREMENTS section
-    requirements = []
-    requirements.append(length_instructions[length])
-    requirements.append(tone_instructions[tone])
-    
-    enhanced_sections.append(f"**REQUIREMENTS**: {' | '.join(requirements)}")
-    
-    # FORMAT section
-    enhanced_sections.append(f"**FORMAT**: {format_instructions[format_style]}")
-    
-    # WARNINGS section
-    enhanced_sections.append("**WARNINGS**: Ensure accuracy, avoid assumptions, and provide actionable insights")
-    
-    return "\n\n".join(enhanced_sections)
+    """Generate enhanced prompt using Ben's methodology (precompiled skeletons)"""
+    return render_methodology(original_prompt, settings)
 
 # Simple API handler for query parameters
+@timed_action(('register', 'verify', 'check_credits', 'use_credit', 'enhance_prompt'))
 def handle_api_request(action, **kwargs):
     """Handle API requests from the frontend"""
     if action == 'register':
@@ -704,19 +641,27 @@ def handle_api_request(action, **kwargs):
     elif action == 'verify':
         return api_verify_code(kwargs.get('email'), kwargs.get('code'))
     elif action == 'check_credits':
-        return api_check_credits(kwargs.get('redemption_code'))
+        return api_check_credits(kwargs.get('redemption_code'), session=kwargs.get('session'))
     elif action == 'use_credit':
         return api_use_credit(kwargs.get('redemption_code'))
     elif action == 'enhance_prompt':
-        credit_result = api_use_credit(kwargs.get('redemption_code'))
-        if credit_result['success']:
-            enhanced = api_generate_enhanced_prompt(kwargs.get('prompt'), kwargs.get('settings', {}))
-            return {
-                "success": True,
-                "enhanced_prompt": enhanced,
-                "remaining_credits": credit_result['remaining_credits']
-            }
-        return credit_result
+        redemption_code = kwargs.get('redemption_code')
+        prompt = kwargs.get('prompt')
+        settings = kwargs.get('settings', {})
+        
+        def enhance():
+            credit_result = api_use_credit(redemption_code)
+            if credit_result['success']:
+                enhanced = api_generate_enhanced_prompt(prompt, settings)
+                return {
+                    "success": True,
+                    "enhanced_prompt": enhanced,
+                    "remaining_credits": credit_result['remaining_credits']
+                }
+            return credit_result
+        
+        # Identical concurrent requests share one credit and one render
+        return coalesce_enhancement(parse_code(redemption_code), prompt, settings, enhance)
     else:
         return {"success": False, "message": "Unknown action"}
 
@@ -733,7 +678,8 @@ if st.query_params:
             code=query.get('code'),
             redemption_code=query.get('redemption_code'),
             prompt=query.get('prompt'),
-            settings=json.loads(query.get('settings', '{}'))
+            settings=json.loads(query.get('settings', '{}')),
+            session=query.get('session')
         )
         st.json(result)
         st.stop()
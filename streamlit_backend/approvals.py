@@ -0,0 +1,83 @@
+"""
+Bulk waiting-list approval
+Approves any number of pending applications in one transaction: the
+pending rows are read once, codes are issued in one batch, and the users
+inserts and waiting_list updates each go through a single executemany.
+"""
+
+import csv
+import io
+import time
+
+from codes import issue_codes, parse_code
+
+DEFAULT_CREDITS = 100
+
+
+def select_pending(conn, ids=None, search=None):
+    """Pending applications to approve: all of them, a set of ids, or a search
+
+    ``search`` matches name or email (case-insensitive substring).  Each row
+    is ``(id, name, email, has_account)``.
+    """
+    sql = '''SELECT w.id, w.name, w.email,
+                    EXISTS (SELECT 1 FROM users u WHERE u.email = w.email)
+             FROM waiting_list w
+             WHERE w.status = 'pending' '''
+    params = []
+    if ids is not None:
+        ids = list(ids)
+        if not ids:
+            return []
+        sql += f" AND w.id IN ({', '.join('?' for _ in ids)})"
+        params.extend(ids)
+    if search:
+        sql += " AND (w.name LIKE ? OR w.email LIKE ?)"
+        params.extend([f"%{search}%"] * 2)
+    sql += " ORDER BY w.applied_date"
+    return conn.execute(sql, params).fetchall()
+
+
+def bulk_approve(conn, ids=None, search=None, admin_notes="Bulk approved by admin",
+                 credits=DEFAULT_CREDITS):
+    """Approve pending applications; run inside ``transaction()``
+
+    Applicants who already have an account are skipped (their application
+    stays pending) instead of failing the whole batch on the UNIQUE email.
+    """
+    started = time.perf_counter()
+
+    rows = select_pending(conn, ids=ids, search=search)
+    to_approve = [(app_id, name, email) for app_id, name, email, has_account in rows if not has_account]
+    skipped = [email for _, _, email, has_account in rows if has_account]
+
+    codes = issue_codes(conn, len(to_approve))
+    approved = [(name, email, code) for (_, name, email), code in zip(to_approve, codes)]
+
+    conn.executemany('''INSERT INTO users (name, email, redemption_code, code_id, credits, status)
+                        VALUES (?, ?, ?, ?, ?, 'active')''',
+                     [(name, email, code, parse_code(code), credits) for name, email, code in approved])
+    conn.executemany('''UPDATE waiting_list
+                        SET status = 'approved', approved_date = CURRENT_TIMESTAMP, admin_notes = ?
+                        WHERE id = ?''',
+                     [(admin_notes, app_id) for app_id, _, _ in to_approve])
+
+    elapsed = time.perf_counter() - started
+    return {
+        "success": True,
+        "approved": approved,
+        "skipped": skipped,
+        "elapsed": elapsed,
+        "per_second": len(approved) / elapsed if elapsed > 0 else float(len(approved)),
+        "message": f"Approved {len(approved)} applications"
+                   + (f", skipped {len(skipped)} with existing accounts" if skipped else ""),
+    }
+
+
+def approved_codes_csv(approved):
+    """CSV (name, email, redemption_code) for mailing the issued codes"""
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["name", "email", "redemption_code"])
+    writer.writerows(approved)
+    return out.getvalue()
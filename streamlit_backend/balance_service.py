@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Balance push service: every live balance stream on one thread
+
+/api/balance/stream and /api/balance/poll keep a connection open for
+minutes.  In api_service.py's gthread workers each one holds a request
+thread, so only a handful fit beside the writes.  This process serves the
+same two routes from a single asyncio event loop instead - an open
+connection costs a socket and a few objects, not a thread - fed by the
+same BalanceHub watcher (balances.py) that rereads subscribed balances
+whenever PRAGMA data_version says another process committed:
+
+    GET /api/balance/stream?redemption_code=...  server-sent "balance" events (or ?session=...)
+    GET /api/balance/poll?redemption_code=...&known=N  long poll until the balance is not N
+    GET /api/health                              liveness
+
+Requests are authenticated exactly like api_service.py's (watch_balance),
+on a small thread pool so the database never blocks the loop.  Put it
+behind the same host as the API with /api/balance/ routed here, or point
+the extension's BALANCE_BASE_URL at it.
+
+Run:
+    python balance_service.py
+
+Settings: BALANCE_HOST, BALANCE_PORT (5001), BALANCE_SERVICE_MAX_CONNECTIONS
+(open streams and polls, default 10000; past that 503), BALANCE_AUTH_THREADS
+(default 4).
+"""
+
+import os
+import json
+import asyncio
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+from database import ensure_schema
+from api_endpoints import watch_balance
+from balances import BalanceHub, HEARTBEAT, STREAM_SECONDS
+
+HOST = os.environ.get('BALANCE_HOST', '0.0.0.0')
+PORT = int(os.environ.get('BALANCE_PORT', '5001'))
+MAX_CONNECTIONS = int(os.environ.get('BALANCE_SERVICE_MAX_CONNECTIONS', '10000'))
+AUTH_THREADS = int(os.environ.get('BALANCE_AUTH_THREADS', '4'))
+MAX_POLL = 25.0
+REQUEST_TIMEOUT = 10  # seconds to send the request head
+MAX_HEAD = 8192
+
+_REASONS = {200: 'OK', 204: 'No Content', 400: 'Bad Request', 401: 'Unauthorized',
+            404: 'Not Found', 405: 'Method Not Allowed', 503: 'Service Unavailable'}
+
+# The extension calls from its own origin, as with api_service's CORS(origins=['*'])
+_CORS = ('Access-Control-Allow-Origin: *\r\n'
+         'Access-Control-Allow-Headers: Authorization\r\n'
+         'Access-Control-Allow-Methods: GET, OPTIONS\r\n')
+
+
+def _head(status, content_type, extra=''):
+    return (f"HTTP/1.1 {status} {_REASONS[status]}\r\nContent-Type: {content_type}\r\n"
+            f"{_CORS}{extra}Connection: close\r\n").encode()
+
+
+def _json_response(status, body, extra=''):
+    payload = json.dumps(body).encode()
+    return _head(status, 'application/json', extra) + f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload
+
+
+class BalanceService:
+    """Streams and long polls for many clients on one event loop
+
+    The hub's listener hands each published change to the loop, which
+    records it per code and wakes that code's open connections.  A code is
+    subscribed in the hub while any connection here follows it.
+    """
+
+    def __init__(self, hub=None, max_connections=MAX_CONNECTIONS, auth_threads=AUTH_THREADS,
+                 heartbeat=HEARTBEAT, stream_seconds=STREAM_SECONDS):
+        self.hub = hub or BalanceHub()
+        self.max_connections = max_connections
+        self.heartbeat = heartbeat
+        self.stream_seconds = stream_seconds
+        self._executor = ThreadPoolExecutor(auth_threads, thread_name_prefix='balance-auth')
+        self._loop = None
+        self._state = {}     # code_id -> (version, remaining)
+        self._waiters = {}   # code_id -> set of asyncio.Event
+        self._open = 0
+
+        self.served = 0
+        self.rejected = 0
+
+    async def start(self, host=HOST, port=PORT):
+        """Bind and start serving; returns the asyncio server"""
+        self._loop = asyncio.get_running_loop()
+        self.hub.listen(lambda *change: self._loop.call_soon_threadsafe(self._publish, *change))
+        return await asyncio.start_server(self._handle, host, port)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    # ---- per-code state (loop thread only) ----
+
+    def _publish(self, code_id, version, remaining):
+        if code_id not in self._waiters or version <= self._state[code_id][0]:
+            return
+        self._state[code_id] = (version, remaining)
+        for event in self._waiters[code_id]:
+            event.set()
+
+    def _follow(self, code_id, remaining):
+        event = asyncio.Event()
+        if code_id not in self._waiters:
+            self.hub.subscribe(code_id, remaining)
+            self._waiters[code_id] = set()
+            self._state[code_id] = self.hub.current(code_id)
+        self._waiters[code_id].add(event)
+        return event
+
+    def _unfollow(self, code_id, event):
+        waiters = self._waiters[code_id]
+        waiters.discard(event)
+        if not waiters:
+            del self._waiters[code_id]
+            del self._state[code_id]
+            self.hub.unsubscribe(code_id)
+
+    async def _changed(self, code_id, event, version, timeout):
+        """``(version, remaining)`` once newer than ``version``, or the current state at timeout"""
+        if self._state[code_id][0] <= version:
+            event.clear()
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._state[code_id]
+
+    # ---- HTTP ----
+
+    async def _handle(self, reader, writer):
+        try:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), REQUEST_TIMEOUT)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                return
+            if len(head) > MAX_HEAD:
+                return
+            await self._route(head.decode('latin-1'), writer)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, head, writer):
+        request_line, *header_lines = head.split('\r\n')
+        method, _, target = request_line.partition(' ')
+        target = target.rpartition(' ')[0] or target
+        url = urlsplit(target)
+        headers = {}
+        for line in header_lines:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if method == 'OPTIONS':
+            writer.write(_head(204, 'text/plain') + b"Content-Length: 0\r\n\r\n")
+            return
+        if method != 'GET':
+            writer.write(_json_response(405, {"success": False, "message": "GET only"}))
+            return
+        if url.path == '/api/health':
+            writer.write(_json_response(200, {"status": "ok", "connections": self._open}))
+            return
+        if url.path not in ('/api/balance/stream', '/api/balance/poll'):
+            writer.write(_json_response(404, {"success": False, "message": "Not found"}))
+            return
+
+        if self._open >= self.max_connections:
+            self.rejected += 1
+            writer.write(_json_response(503, {"success": False, "message": "Too many open balance watches, "
+                                                                          "use /api/check_credits"},
+                                        'Retry-After: 30\r\n'))
+            return
+        self._open += 1
+        try:
+            await self._watch(url, headers, writer)
+        finally:
+            self._open -= 1
+
+    async def _watch(self, url, headers, writer):
+        args = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        scheme, _, token = headers.get('authorization', '').partition(' ')
+        session = (token.strip() if scheme.lower() == 'bearer' and token.strip() else None) or args.get('session')
+        redemption_code = args.get('redemption_code', '').strip()
+        if not session and not redemption_code:
+            writer.write(_json_response(400, {"success": False, "message": "redemption_code or session is required"}))
+            return
+
+        known, timeout = args.get('known'), args.get('timeout', '25')
+        try:
+            known = int(known) if known is not None else None
+            timeout = min(max(float(timeout), 0.0), MAX_POLL)
+        except ValueError:
+            writer.write(_json_response(400, {"success": False, "message": "known and timeout must be numbers"}))
+            return
+
+        subject = await self._loop.run_in_executor(self._executor, watch_balance, redemption_code, session)
+        if not subject["success"]:
+            status = 503 if subject.get("busy") else 401 if subject.get("unauthorized") else 404
+            writer.write(_json_response(status, subject, 'Retry-After: 1\r\n' if status == 503 else ''))
+            return
+
+        self.served += 1
+        code_id = subject["code_id"]
+        event = self._follow(code_id, subject["remaining_credits"])
+        try:
+            if url.path == '/api/balance/poll':
+                await self._poll(code_id, event, known, timeout, writer)
+            else:
+                await self._stream(code_id, event, writer)
+        finally:
+            self._unfollow(code_id, event)
+
+    async def _poll(self, code_id, event, known, timeout, writer):
+        version, remaining = self._state[code_id]
+        if known is not None and remaining == known:
+            version, remaining = await self._changed(code_id, event, version, timeout)
+        writer.write(_json_response(200, {"success": True, "remaining_credits": remaining}))
+
+    async def _stream(self, code_id, event, writer):
+        writer.write(_head(200, 'text/event-stream', 'Cache-Control: no-cache\r\nX-Accel-Buffering: no\r\n')
+                     + b"\r\nretry: 5000\n\n")
+        version = 0
+        ends = self._loop.time() + self.stream_seconds
+        while (left := ends - self._loop.time()) > 0:
+            new_version, balance = await self._changed(code_id, event, version, min(self.heartbeat, left))
+            if new_version == version:
+                writer.write(b": keep-alive\n\n")
+            else:
+                version = new_version
+                data = json.dumps({'remaining_credits': balance})
+                writer.write(f"event: balance\nid: {version}\ndata: {data}\n\n".encode())
+            await writer.drain()  # a gone client raises here
+
+    def stats(self):
+        return {"connections": self._open, "codes": len(self._waiters),
+                "served": self.served, "rejected": self.rejected}
+
+
+async def serve(host=HOST, port=PORT):
+    service = BalanceService()
+    server = await service.start(host, port)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    print(f"✅ Balance service on {host}:{port}")
+    async with server:
+        await stop.wait()
+    service.close()
+
+
+def main():
+    ensure_schema()
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
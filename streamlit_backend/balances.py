@@ -0,0 +1,334 @@
+"""
+Credit balance push: in-process pub/sub for /api/balance/stream and /poll
+
+Clients that want to show a live balance subscribe to their redemption
+code instead of polling /api/check_credits.  Each process has one hub:
+
+* a topic per subscribed code_id holding the last balance seen and a
+  version that increments whenever it changes;
+* one watcher thread that, while anyone is subscribed, rereads the
+  subscribed balances (one IN query) whenever PRAGMA data_version says a
+  commit happened - in this process or any other - and publishes the ones
+  that moved;
+* the debit paths call balance_changed() after they commit, which wakes
+  the watcher at once instead of at its next POLL_INTERVAL tick.
+
+Balances are only ever read after commit, by a single thread, so
+subscribers never see a rolled-back debit or values out of order.  With
+no subscribers the watcher sleeps and touches nothing.
+
+Live clients are meant to be served by balance_service.py: one asyncio
+process that holds every stream and long poll on a single thread, fed by
+this hub through listen().  api_service.py keeps the same two routes as a
+fallback, but there each open stream or poll holds one of the worker's
+API_THREADS threads for its whole life, so the hub caps them together well
+below that count and the remaining threads stay free for debits.  The slot
+is taken under the same lock that checks the cap, so a burst of connects
+cannot overshoot it.
+
+Settings:
+    BALANCE_POLL_INTERVAL   seconds between data_version checks (default 0.5)
+    BALANCE_MAX_STREAMS     thread-holding streams plus long polls open at
+                            once per api_service worker (default API_THREADS
+                            - 2); past that both answer 503 and clients fall
+                            back to plain credit checks
+"""
+
+import os
+import json
+import time
+import threading
+
+from database import get_pool, open_connection
+
+POLL_INTERVAL = float(os.environ.get('BALANCE_POLL_INTERVAL', '0.5'))
+MAX_STREAMS = int(os.environ.get('BALANCE_MAX_STREAMS',
+                                 str(max(0, int(os.environ.get('API_THREADS', '4')) - 2))))
+MIN_SCAN_INTERVAL = 0.05  # a burst of debits is rescanned at most 20x a second
+HEARTBEAT = 15  # seconds between SSE keep-alive comments
+STREAM_SECONDS = 300  # streams end after this; EventSource reconnects on its own
+
+# SQLite's default bound-parameter limit is 999 on older builds
+_CHUNK = 500
+
+
+class _Topic:
+    __slots__ = ('version', 'remaining', 'subscribers')
+
+    def __init__(self, version, remaining):
+        self.version = version
+        self.remaining = remaining
+        self.subscribers = 0
+
+
+class _Stream:
+    """SSE body that holds its hub slot from hand-out until close()
+
+    The WSGI server closes the body whether or not it was ever iterated,
+    so the slot is released even for a response that was never sent.
+    """
+
+    def __init__(self, hub, events):
+        self._hub = hub
+        self._events = events
+        self._open = True
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._events)
+
+    def close(self):
+        self._events.close()
+        if self._open:
+            self._open = False
+            self._hub._release('streams')
+
+
+class BalanceHub:
+    """Latest balance per subscribed code, pushed to waiting subscribers
+
+    Versions come from one hub-wide counter, so a topic that was dropped
+    and recreated still compares newer than anything a client saw before.
+    """
+
+    def __init__(self, poll_interval=POLL_INTERVAL, max_streams=MAX_STREAMS, pool=None):
+        self.poll_interval = poll_interval
+        self.max_streams = max_streams
+        self.pool = pool
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._topics = {}
+        self._version = 0
+        self._wake = threading.Event()
+        self._watcher = None
+        self._thread = None
+        self._held = {'streams': 0, 'polls': 0}
+        self._listeners = []
+
+        self.published = 0
+        self.scans = 0
+        self.rejected = {'streams': 0, 'polls': 0}
+
+    # ---- watcher ----
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='balance-hub', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        data_version = None
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            with self._lock:
+                code_ids = [code_id for code_id, topic in self._topics.items() if topic.subscribers]
+            if not code_ids:
+                continue
+            try:
+                if self._watcher is None:
+                    self._watcher = open_connection((self.pool or get_pool()).db_path, read_only=True)
+                version = self._watcher.execute("PRAGMA data_version").fetchone()[0]
+                if version != data_version:
+                    data_version = version
+                    self._scan(code_ids)
+            except Exception:
+                # A bad moment for the database, or a broken connection:
+                # reopen it and try again next tick
+                if self._watcher is not None:
+                    try:
+                        self._watcher.close()
+                    except Exception:
+                        pass
+                    self._watcher = None
+                data_version = None  # per connection: rescan on the new one
+                time.sleep(self.poll_interval)
+            time.sleep(MIN_SCAN_INTERVAL)
+
+    def _scan(self, code_ids):
+        self.scans += 1
+        for start in range(0, len(code_ids), _CHUNK):
+            chunk = code_ids[start:start + _CHUNK]
+            rows = self._watcher.execute(
+                f"SELECT code_id, credits - used_credits FROM users WHERE code_id IN ({','.join('?' * len(chunk))})",
+                chunk).fetchall()
+            for code_id, remaining in rows:
+                self.publish(code_id, remaining)
+
+    def poke(self):
+        """Something committed a balance change: rescan now"""
+        self._wake.set()
+
+    # ---- thread budget ----
+
+    def _reserve(self, kind):
+        """Take a stream / poll slot if the shared cap allows; False if full"""
+        with self._lock:
+            if sum(self._held.values()) >= self.max_streams:
+                self.rejected[kind] += 1
+                return False
+            self._held[kind] += 1
+            return True
+
+    def _release(self, kind):
+        with self._lock:
+            self._held[kind] -= 1
+
+    # ---- pub/sub ----
+
+    def subscribe(self, code_id, remaining):
+        """Start following a code; ``remaining`` is its balance as just read"""
+        self._ensure_started()
+        with self._lock:
+            topic = self._topics.get(code_id)
+            if topic is None:
+                self._version += 1
+                topic = self._topics[code_id] = _Topic(self._version, remaining)
+            topic.subscribers += 1
+
+    def unsubscribe(self, code_id):
+        with self._lock:
+            topic = self._topics[code_id]
+            topic.subscribers -= 1
+            if not topic.subscribers:
+                del self._topics[code_id]
+
+    def publish(self, code_id, remaining):
+        """Record a balance; wakes the code's subscribers if it changed"""
+        with self._lock:
+            topic = self._topics.get(code_id)
+            if topic is None or topic.remaining == remaining:
+                return
+            self._version += 1
+            topic.version = self._version
+            topic.remaining = remaining
+            self.published += 1
+            self._changed.notify_all()
+            for listener in self._listeners:
+                listener(code_id, topic.version, remaining)
+
+    def listen(self, listener):
+        """Call ``listener(code_id, version, remaining)`` on every change
+
+        It runs on the watcher thread with the hub's lock held, so it must
+        only hand the change off (balance_service.py schedules it onto its
+        event loop).
+        """
+        with self._lock:
+            self._listeners.append(listener)
+
+    def current(self, code_id):
+        """``(version, remaining)`` of a subscribed code"""
+        with self._lock:
+            topic = self._topics[code_id]
+            return topic.version, topic.remaining
+
+    def wait(self, code_id, version=0, timeout=25.0):
+        """``(version, remaining)`` once a subscribed code is newer than ``version``
+
+        Returns the current state when ``timeout`` runs out first.
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            topic = self._topics[code_id]
+            while topic.version <= version:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self._changed.wait(left)
+            return topic.version, topic.remaining
+
+    def poll(self, code_id, remaining, known=None, timeout=25.0):
+        """Long poll: the balance once it differs from ``known`` (or at timeout)
+
+        None if the streams and polls already open use up the thread budget.
+        """
+        if known is not None and remaining != known:
+            return remaining  # already behind: answer without waiting
+        if not self._reserve('polls'):
+            return None
+        try:
+            self.subscribe(code_id, remaining)
+            try:
+                with self._lock:
+                    topic = self._topics[code_id]
+                    version, current = topic.version, topic.remaining
+                if known is None or current != known:
+                    return current
+                return self.wait(code_id, version, timeout)[1]
+            finally:
+                self.unsubscribe(code_id)
+        finally:
+            self._release('polls')
+
+    def stream(self, code_id, remaining, seconds=STREAM_SECONDS, heartbeat=HEARTBEAT):
+        """Server-sent events for one code, or None if too many are open"""
+        if not self._reserve('streams'):
+            return None
+
+        def events():
+            # Subscribing waits for the first iteration: a response that
+            # is never sent never subscribes (its slot goes back on close)
+            self.subscribe(code_id, remaining)
+            try:
+                yield "retry: 5000\n\n"
+                version = 0
+                ends = time.monotonic() + seconds
+                while time.monotonic() < ends:
+                    new_version, balance = self.wait(code_id, version,
+                                                     min(heartbeat, max(0.0, ends - time.monotonic())))
+                    if new_version == version:
+                        yield ": keep-alive\n\n"
+                        continue
+                    version = new_version
+                    yield f"event: balance\nid: {version}\ndata: {json.dumps({'remaining_credits': balance})}\n\n"
+            finally:
+                self.unsubscribe(code_id)
+
+        return _Stream(self, events())
+
+    def stats(self):
+        with self._lock:
+            return {
+                "topics": len(self._topics),
+                "subscribers": sum(topic.subscribers for topic in self._topics.values()),
+                "streams": self._held['streams'],
+                "polls": self._held['polls'],
+                "published": self.published,
+                "scans": self.scans,
+                "rejected_streams": self.rejected['streams'],
+                "rejected_polls": self.rejected['polls'],
+            }
+
+
+_hub = None
+_hub_lock = threading.Lock()
+
+
+def get_balance_hub():
+    """Process-wide hub, recreated after a fork"""
+    global _hub
+    hub = _hub
+    if hub is None or hub.pid != os.getpid():
+        with _hub_lock:
+            if _hub is None or _hub.pid != os.getpid():
+                _hub = BalanceHub()
+            hub = _hub
+    return hub
+
+
+def balance_changed():
+    """Called by debit paths once their transaction has committed"""
+    hub = _hub
+    if hub is not None and hub.pid == os.getpid():
+        hub.poke()
+
+
+def balance_stats():
+    """Counters for the process-wide hub"""
+    return get_balance_hub().stats()
@@ -0,0 +1,179 @@
+"""
+Redemption codes: codec and issuance
+
+A code is a 64-bit integer (users.code_id, the lookup key) written in base
+36.  Current codes are 8 payload characters plus a Luhn mod 36 check
+character; codes issued before the check character existed are 8 bare
+characters and keep working.  parse_code() rejects anything malformed
+before it reaches the database.
+
+    legacy    ABCD1234   -> code_id = int('ABCD1234', 36)
+    current   ABCD1234K  -> code_id = 36**8 + int('ABCD1234', 36)
+
+Codes come from a reserved pool (code_pool, topped up off the request path)
+and, when it runs dry, are generated in memory in batches: each batch of
+candidates is checked against users and code_pool with one IN query per
+chunk instead of one SELECT per attempt.  Generating is the slow part
+(about 10 us a code, see benchmarks/bench_code_issue.py); popping the pool
+is five times faster, so keep it topped up.
+
+Top up the reserve with:  python codes.py --refill [N]
+"""
+
+import os
+import re
+import sys
+import secrets
+import string
+
+# Digit order matches int(code, 36), so a code is just a number in base 36
+CODE_ALPHABET = string.digits + string.ascii_uppercase
+CODE_LENGTH = 8
+_CODE_SPACE = len(CODE_ALPHABET) ** CODE_LENGTH
+_CODE_RE = re.compile(r'[0-9A-Z]{8,9}')
+POOL_TARGET = int(os.environ.get('CODE_POOL_SIZE', '10000'))
+
+# SQLite's default bound-parameter limit is 999 on older builds
+_CHUNK = 500
+
+# Oldest reserved codes first, straight off the rowid
+_POP = '''DELETE FROM code_pool
+          WHERE id IN (SELECT id FROM code_pool ORDER BY id LIMIT ?)
+          RETURNING code'''
+
+
+def _base36(n, width=CODE_LENGTH):
+    chars = []
+    for _ in range(width):
+        n, digit = divmod(n, 36)
+        chars.append(CODE_ALPHABET[digit])
+    return ''.join(reversed(chars))
+
+
+def check_char(payload):
+    """Luhn mod 36 check character: catches every single-character typo and
+    every swap of two adjacent characters except 0 <-> Z"""
+    total = 0
+    factor = 2
+    for char in reversed(payload):
+        addend = factor * CODE_ALPHABET.index(char)
+        total += addend // 36 + addend % 36
+        factor = 1 if factor == 2 else 2
+    return CODE_ALPHABET[(36 - total % 36) % 36]
+
+
+def encode_code(code_id):
+    """Redemption code string for a code_id"""
+    if code_id < _CODE_SPACE:
+        return _base36(code_id)  # legacy, no check character
+    payload = _base36(code_id - _CODE_SPACE)
+    return payload + check_char(payload)
+
+
+def parse_code(code):
+    """code_id for a redemption code, or None if it is malformed
+
+    Case and surrounding whitespace are forgiven; anything else (wrong
+    length or alphabet, bad check character) is rejected without a query.
+    """
+    if not isinstance(code, str):
+        return None
+    code = code.strip().upper()
+    if not _CODE_RE.fullmatch(code):
+        return None
+    if len(code) == CODE_LENGTH:
+        return int(code, 36)
+    payload = code[:CODE_LENGTH]
+    if code[-1] != check_char(payload):
+        return None
+    return _CODE_SPACE + int(payload, 36)
+
+
+def normalize_code(code):
+    """Canonical spelling of a valid code (uppercase, trimmed), else None"""
+    code_id = parse_code(code)
+    return None if code_id is None else encode_code(code_id)
+
+
+def generate_code():
+    """One random checked code (not checked for uniqueness)"""
+    return encode_code(_CODE_SPACE + secrets.randbelow(_CODE_SPACE))
+
+
+def _taken(conn, candidates):
+    """Which of ``candidates`` are already issued or reserved"""
+    taken = set()
+    for start in range(0, len(candidates), _CHUNK):
+        chunk = candidates[start:start + _CHUNK]
+        placeholders = ', '.join('?' for _ in chunk)
+        taken.update(row[0] for row in conn.execute(
+            f'''SELECT redemption_code FROM users WHERE code_id IN ({placeholders})
+                UNION ALL
+                SELECT code FROM code_pool WHERE code IN ({placeholders})''',
+            [parse_code(code) for code in chunk] + chunk))
+    return taken
+
+
+def generate_unique_codes(conn, count, exclude=()):
+    """``count`` fresh codes unused in users and code_pool (and not in ``exclude``)"""
+    codes = []
+    seen = set(exclude)
+    while len(codes) < count:
+        candidates = []
+        while len(candidates) < count - len(codes):
+            code = generate_code()
+            if code not in seen:
+                seen.add(code)
+                candidates.append(code)
+        taken = _taken(conn, candidates)
+        codes.extend(code for code in candidates if code not in taken)
+    return codes
+
+
+def issue_codes(conn, count):
+    """Reserve ``count`` unique codes; run inside the transaction that uses them
+
+    Pops from the reserved pool first (the popped rows are gone once the
+    caller commits, and come back if it rolls back), then generates the rest.
+    """
+    if count <= 0:
+        return []
+    codes = [row[0] for row in conn.execute(_POP, (count,)).fetchall()]
+    if len(codes) < count:
+        codes.extend(generate_unique_codes(conn, count - len(codes), exclude=codes))
+    return codes
+
+
+def issue_code(conn):
+    """Reserve a single unique code"""
+    return issue_codes(conn, 1)[0]
+
+
+def refill_pool(conn, target=POOL_TARGET):
+    """Top code_pool up to ``target`` reserved codes; returns how many were added"""
+    have = conn.execute("SELECT COUNT(*) FROM code_pool").fetchone()[0]
+    missing = target - have
+    if missing <= 0:
+        return 0
+    conn.executemany("INSERT INTO code_pool (code) VALUES (?)",
+                     [(code,) for code in generate_unique_codes(conn, missing)])
+    return missing
+
+
+def pool_size(conn):
+    """Reserved codes left"""
+    return conn.execute("SELECT COUNT(*) FROM code_pool").fetchone()[0]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "--refill":
+        print("Usage: python codes.py --refill [N]")
+        sys.exit(1)
+
+    from database import transaction
+
+    target = int(sys.argv[2]) if len(sys.argv) > 2 else POOL_TARGET
+    with transaction() as conn:
+        added = refill_pool(conn, target)
+        left = pool_size(conn)
+    print(f"✅ Added {added} codes, {left} reserved")
@@ -0,0 +1,52 @@
+"""
+Shared test fixtures: a migrated database in a fresh temporary directory
+
+Tests that need more than the ``pool`` fixture build on the helpers,
+imported by module name like everything else here:
+
+    from conftest import migrated_pool, add_user
+"""
+
+import os
+import tempfile
+
+import pytest
+
+from database import ConnectionPool
+from migrations import migrate
+from codes import parse_code
+
+
+def migrated_pool(db_path, **kwargs):
+    """A ConnectionPool on ``db_path`` with the schema migrated"""
+    pool = ConnectionPool(db_path=db_path, **kwargs)
+    with pool.connection() as conn:
+        migrate(conn)
+    return pool
+
+
+def add_user(pool, code='CODE0001', credits=10, email='a@example.com', name='A'):
+    """Insert an active user; returns their code_id"""
+    code_id = parse_code(code)
+    with pool.transaction() as conn:
+        conn.execute("INSERT INTO users (name, email, redemption_code, code_id, credits) "
+                     "VALUES (?, ?, ?, ?, ?)", (name, email, code, code_id, credits))
+    return code_id
+
+
+@pytest.fixture
+def tmp():
+    with tempfile.TemporaryDirectory() as tmp:
+        yield tmp
+
+
+@pytest.fixture
+def db_path(tmp):
+    return os.path.join(tmp, 'test.db')
+
+
+@pytest.fixture
+def pool(db_path):
+    pool = migrated_pool(db_path, max_size=4)
+    yield pool
+    pool.close()
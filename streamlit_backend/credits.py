@@ -0,0 +1,79 @@
+"""
+Credit accounting for redemption codes
+A debit is one conditional UPDATE ... RETURNING: the balance check and the
+decrement happen in a single statement under a single write lock, so
+concurrent requests can never spend the same credit twice.
+"""
+
+from codes import parse_code
+from metrics import counter
+
+# Debit attempts by result ('ok' or a failure reason); a debit later rolled
+# back with its transaction still counts
+DEBITS = counter('credit_debits_total', 'Credit debit attempts by result', ('result',))
+
+# remaining = credits - used_credits; only used_credits ever moves on a debit
+_DEBIT_BY_CODE = '''UPDATE users
+                    SET used_credits = used_credits + ?, last_used = CURRENT_TIMESTAMP
+                    WHERE code_id = ? AND status = 'active'
+                      AND credits - used_credits >= ?
+                    RETURNING id, email, credits, used_credits'''
+
+_DEBIT_BY_EMAIL_AND_CODE = '''UPDATE users
+                              SET used_credits = used_credits + ?, last_used = CURRENT_TIMESTAMP
+                              WHERE email = ? AND code_id = ? AND status = 'active'
+                                AND credits - used_credits >= ?
+                              RETURNING id, email, credits, used_credits'''
+
+
+def debit_credit(conn, redemption_code, email=None, amount=1):
+    """Spend ``amount`` credits for a redemption code (optionally bound to an email)
+
+    Returns ``{"success": True, "user_id", "email", "credits", "used_credits",
+    "remaining_credits"}`` or ``{"success": False, "reason": ...}`` where reason
+    is ``'invalid'``, ``'inactive'`` or ``'no_credits'``.  Only the failure
+    path issues a second (read-only) query to tell those apart, and a
+    malformed code is rejected without touching the database.
+    """
+    code_id = parse_code(redemption_code)
+    if code_id is None:
+        DEBITS.inc('invalid')
+        return {"success": False, "reason": 'invalid'}
+
+    if email is None:
+        rows = conn.execute(_DEBIT_BY_CODE, (amount, code_id, amount)).fetchall()
+    else:
+        rows = conn.execute(_DEBIT_BY_EMAIL_AND_CODE,
+                            (amount, email, code_id, amount)).fetchall()
+
+    if rows:
+        user_id, user_email, credits, used_credits = rows[0]
+        DEBITS.inc('ok')
+        return {
+            "success": True,
+            "user_id": user_id,
+            "email": user_email,
+            "credits": credits,
+            "used_credits": used_credits,
+            "remaining_credits": credits - used_credits,
+        }
+
+    reason = _debit_failure_reason(conn, code_id, email)
+    DEBITS.inc(reason)
+    return {"success": False, "reason": reason}
+
+
+def _debit_failure_reason(conn, code_id, email=None):
+    """Why a debit matched no row"""
+    if email is None:
+        row = conn.execute("SELECT status FROM users WHERE code_id = ?",
+                           (code_id,)).fetchone()
+    else:
+        row = conn.execute("SELECT status FROM users WHERE email = ? AND code_id = ?",
+                           (email, code_id)).fetchone()
+
+    if not row:
+        return 'invalid'
+    if row[0] != 'active':
+        return 'inactive'
+    return 'no_credits'
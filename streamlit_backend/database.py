@@ -0,0 +1,458 @@
+"""
+Shared SQLite data-access layer for the AI Prompt Enhancer backend
+Every module borrows its connections from one bounded, thread-aware pool
+instead of opening (and sometimes forgetting to close) its own.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import logging
+from contextlib import contextmanager
+from urllib.request import pathname2url
+
+from migrations import migrate
+from metrics import histogram
+from sqlprofile import connection_factory
+
+logger = logging.getLogger(__name__)
+
+# Single database file shared by the API and the admin dashboard
+DB_PATH = os.environ.get(
+    'DATABASE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'users.db')
+)
+
+# Pool tuning
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '8'))
+ACQUIRE_TIMEOUT = float(os.environ.get('DB_ACQUIRE_TIMEOUT', '10'))
+BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', '5000'))
+LEAK_TIMEOUT = float(os.environ.get('DB_LEAK_TIMEOUT', '30'))
+SNAPSHOT_POOL_SIZE = int(os.environ.get('DB_SNAPSHOT_POOL_SIZE', '2'))
+
+# Time spent inside outermost transactions (lock wait included) and waiting
+# for a pooled connection; served at /metrics
+DB_SECONDS = histogram('db_transaction_duration_seconds', 'Outermost transaction time by kind', ('kind',))
+DB_POOL_WAIT = histogram('db_pool_wait_seconds', 'Time to check a connection out of the pool')
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection frees up within the acquire timeout"""
+
+
+def is_busy_error(error):
+    """True for overload (no free connection, or the write lock stayed taken)"""
+    if isinstance(error, PoolTimeout):
+        return True
+    message = str(error)
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in message or 'busy' in message)
+
+
+def _open_connection(db_path, read_only=False):
+    """Open a connection with the settings every pooled connection shares"""
+    if read_only:
+        # mode=ro: the file is never written through this handle, and under
+        # WAL its read transactions never block (or wait for) the writers
+        conn = sqlite3.connect(
+            f"file:{pathname2url(os.path.abspath(db_path))}?mode=ro",
+            uri=True,
+            timeout=BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            isolation_level=None,
+            factory=connection_factory(),
+        )
+        conn.execute("PRAGMA query_only=ON")
+        conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        return conn
+
+    conn = sqlite3.connect(
+        db_path,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,
+        isolation_level=None,  # transactions are explicit, see transaction()
+        factory=connection_factory(),  # sqlprofile.py when SQL_PROFILE is on
+    )
+    # Only takes effect on a brand-new file (before WAL writes the header);
+    # lets retention.py hand freed pages back without a full VACUUM
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    return conn
+
+
+def open_connection(db_path=DB_PATH, read_only=False):
+    """A standalone (unpooled) connection with the pool's settings"""
+    return _open_connection(db_path, read_only=read_only)
+
+
+class ConnectionPool:
+    """Bounded pool of SQLite connections
+
+    Connections are handed out LIFO so the hottest one (warm page cache,
+    prepared statement cache) is reused first.  A thread that already holds
+    a connection gets the same one back on nested calls, so helpers can call
+    each other without exhausting the pool or deadlocking on it.
+    """
+
+    def __init__(self, db_path=DB_PATH, max_size=POOL_SIZE,
+                 acquire_timeout=ACQUIRE_TIMEOUT, leak_timeout=LEAK_TIMEOUT, read_only=False):
+        self.db_path = db_path
+        self.read_only = read_only
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.leak_timeout = leak_timeout
+        self.pid = os.getpid()
+
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._idle = []
+        self._checked_out = {}
+        self._local = threading.local()
+        self._closed = False
+
+        self.opened = 0
+        self.reused = 0
+        self.leaks_reclaimed = 0
+
+    # ---- checkout / checkin ----
+
+    def acquire(self):
+        """Check a connection out of the pool, opening one if none is idle"""
+        if self._closed:
+            raise PoolTimeout("Connection pool is closed")
+
+        started = time.perf_counter()
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            # Every slot is taken: reclaim anything held by dead threads
+            # before giving up.
+            if not (self.reclaim_leaks() and self._slots.acquire(blocking=False)):
+                raise PoolTimeout(
+                    f"No database connection available after {self.acquire_timeout}s "
+                    f"({len(self._checked_out)} checked out)"
+                )
+
+        try:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                conn = _open_connection(self.db_path, read_only=self.read_only)
+                self.opened += 1
+            else:
+                self.reused += 1
+        except Exception:
+            self._slots.release()
+            raise
+        DB_POOL_WAIT.observe(time.perf_counter() - started)
+
+        with self._lock:
+            self._checked_out[id(conn)] = (
+                conn,
+                threading.current_thread(),
+                time.monotonic(),
+                traceback.extract_stack(limit=8)[:-1],
+            )
+        return conn
+
+    def release(self, conn):
+        """Return a connection to the pool, rolling back anything left open"""
+        with self._lock:
+            entry = self._checked_out.pop(id(conn), None)
+        if entry is None:
+            # Already reclaimed as a leak, nothing to give back
+            return
+
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            if self._closed:
+                conn.close()
+            else:
+                with self._lock:
+                    self._idle.append(conn)
+        except sqlite3.Error:
+            conn.close()
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of a ``with`` block"""
+        held = getattr(self._local, 'conn', None)
+        if held is not None:
+            self._local.depth += 1
+            try:
+                yield held
+            finally:
+                self._local.depth -= 1
+            return
+
+        conn = self.acquire()
+        self._local.conn = conn
+        self._local.depth = 1
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            self._local.depth = 0
+            self.release(conn)
+
+    @contextmanager
+    def transaction(self, immediate=True):
+        """Run a ``with`` block inside one transaction
+
+        ``immediate`` takes the write lock up front (BEGIN IMMEDIATE) so a
+        read-then-write block never fails on a lock upgrade.  Nested calls on
+        the same thread join the outer transaction.
+        """
+        with self.connection() as conn:
+            if conn.in_transaction:
+                yield conn
+                return
+
+            started = time.perf_counter()
+            conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            self._local.after_commit = pending = []
+            try:
+                yield conn
+            except BaseException:
+                if conn.in_transaction:
+                    conn.rollback()
+                raise
+            else:
+                if conn.in_transaction:
+                    conn.commit()
+            finally:
+                self._local.after_commit = None
+                DB_SECONDS.observe(time.perf_counter() - started, 'write' if immediate else 'read')
+
+            # Committed: only now may the outside world hear about it
+            for fn in pending:
+                try:
+                    fn()
+                except Exception:
+                    logger.exception("after_commit callback failed")
+
+    def in_transaction(self):
+        """Whether this thread's borrowed connection has a transaction open"""
+        held = getattr(self._local, 'conn', None)
+        return held is not None and held.in_transaction
+
+    def after_commit(self, fn):
+        """Call ``fn()`` once this thread's transaction commits; never if it rolls back
+
+        Outside a transaction ``fn`` runs at once.  Side effects of a write
+        (usage log rows, balance notifications) go through here, so an outer
+        transaction that joins the write - a batch - defers them until it
+        has actually committed.
+        """
+        pending = getattr(self._local, 'after_commit', None)
+        if pending is None or not self.in_transaction():
+            fn()
+        else:
+            pending.append(fn)
+
+    @contextmanager
+    def savepoint(self, name):
+        """Nested rollback point inside this thread's open transaction
+
+        ``with pool.savepoint('op') as rollback:`` - calling ``rollback()``
+        (or raising) undoes the block's writes and drops the after_commit
+        callbacks it queued; the transaction itself carries on.
+        """
+        conn = self._local.conn
+        pending = self._local.after_commit
+        mark = len(pending)
+        conn.execute(f"SAVEPOINT {name}")
+
+        def rollback():
+            conn.execute(f"ROLLBACK TO {name}")
+            del pending[mark:]
+
+        try:
+            yield rollback
+        except BaseException:
+            rollback()
+            raise
+        finally:
+            conn.execute(f"RELEASE {name}")
+
+    @contextmanager
+    def snapshot(self):
+        """Run a ``with`` block inside one read transaction
+
+        Every query in the block sees the database as of its first read.
+        Under WAL the writers carry on meanwhile, so keep the block to the
+        queries themselves (load, then render).  Nested calls on the same
+        thread share the outer snapshot.
+        """
+        with self.connection() as conn:
+            if conn.in_transaction:
+                yield conn
+                return
+
+            started = time.perf_counter()
+            conn.execute("BEGIN")
+            try:
+                yield conn
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                DB_SECONDS.observe(time.perf_counter() - started, 'snapshot')
+
+    # ---- leak detection ----
+
+    def find_leaks(self):
+        """List connections held past ``leak_timeout`` or by a dead thread"""
+        now = time.monotonic()
+        with self._lock:
+            entries = list(self._checked_out.values())
+        return [
+            entry for entry in entries
+            if not entry[1].is_alive() or now - entry[2] > self.leak_timeout
+        ]
+
+    def reclaim_leaks(self):
+        """Log leaked connections and take back the ones whose owner is gone
+
+        Connections still held by a live thread are only reported; closing
+        them underneath a running request would be worse than the leak.
+        """
+        reclaimed = 0
+        for conn, thread, checked_out_at, stack in self.find_leaks():
+            held_for = time.monotonic() - checked_out_at
+            logger.warning(
+                "Leaked database connection held %.1fs by %s (alive=%s), checked out at:\n%s",
+                held_for, thread.name, thread.is_alive(), ''.join(traceback.format_list(stack))
+            )
+            if thread.is_alive():
+                continue
+
+            with self._lock:
+                entry = self._checked_out.pop(id(conn), None)
+            if entry is None:
+                continue
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+            self._slots.release()
+            self.leaks_reclaimed += 1
+            reclaimed += 1
+        return reclaimed
+
+    # ---- housekeeping ----
+
+    def stats(self):
+        """Snapshot of pool counters"""
+        with self._lock:
+            return {
+                "max_size": self.max_size,
+                "idle": len(self._idle),
+                "checked_out": len(self._checked_out),
+                "opened": self.opened,
+                "reused": self.reused,
+                "leaks_reclaimed": self.leaks_reclaimed,
+            }
+
+    def close(self):
+        """Close idle connections; busy ones are closed when released"""
+        self._closed = True
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Process-wide pool, recreated after a fork so workers never share handles
+
+    Creating the pool brings the schema up to date, so migrations run once
+    per process and never on the request path.
+    """
+    global _pool
+    pool = _pool
+    if pool is None or pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                pool = ConnectionPool()
+                with pool.connection() as conn:
+                    migrate(conn)
+                _pool = pool
+            pool = _pool
+    return pool
+
+
+_snapshot_pool = None
+
+
+def get_snapshot_pool():
+    """Process-wide read-only pool for admin/analytics reads
+
+    Kept apart from the read-write pool so a slow dashboard render can never
+    hold a connection the credit-debit path is waiting for.
+    """
+    global _snapshot_pool
+    pool = _snapshot_pool
+    if pool is None or pool.pid != os.getpid():
+        get_pool()  # the file, its schema and the WAL index must exist first
+        with _pool_lock:
+            if _snapshot_pool is None or _snapshot_pool.pid != os.getpid():
+                _snapshot_pool = ConnectionPool(max_size=SNAPSHOT_POOL_SIZE, read_only=True)
+            pool = _snapshot_pool
+    return pool
+
+
+def ensure_schema():
+    """Make sure the schema is migrated; a no-op after the first call"""
+    get_pool()
+
+
+def close_pools():
+    """Close this process's pools; the next use opens fresh ones
+
+    Call it in a parent before forking workers: a child must never use, or
+    even close, a SQLite connection it inherited.
+    """
+    global _pool, _snapshot_pool
+    with _pool_lock:
+        pools, _pool, _snapshot_pool = (_pool, _snapshot_pool), None, None
+    for pool in pools:
+        if pool is not None:
+            pool.close()
+
+
+def connection():
+    """Borrow a pooled connection: ``with connection() as conn: ...``"""
+    return get_pool().connection()
+
+
+def transaction(immediate=True):
+    """Run a block in one pooled transaction: ``with transaction() as conn: ...``"""
+    return get_pool().transaction(immediate=immediate)
+
+
+def after_commit(fn):
+    """Run ``fn()`` after this thread's pooled transaction commits (now if none is open)"""
+    get_pool().after_commit(fn)
+
+
+def savepoint(name):
+    """Rollback point inside the open pooled transaction: ``with savepoint('op') as rollback: ...``"""
+    return get_pool().savepoint(name)
+
+
+def snapshot():
+    """One consistent read-only view: ``with snapshot() as conn: ...``"""
+    return get_snapshot_pool().snapshot()
+
+
+def pool_stats():
+    """Counters for the process-wide pool"""
+    return get_pool().stats()
@@ -0,0 +1,105 @@
+"""
+Idempotency keys for credit-consuming requests
+
+A client that loses the response to a debit cannot tell whether the credit
+was spent.  If it sends an ``Idempotency-Key`` header (any unique string,
+one per logical attempt), it can simply retry with the same key:
+
+* the first request runs and its successful response is stored in the
+  same transaction as the debit - both commit or neither does;
+* a retry with the same key gets the stored response back, marked
+  ``"replayed": True``, without touching the users row;
+* reusing a key for a different request is refused (``"conflict"``).
+
+Only successes are stored.  A failure (no credits, bad code, server busy)
+changed nothing, so retrying it for real is already safe and may succeed
+once the cause is fixed.
+
+Keys are scoped to the redemption code and kept for IDEMPOTENCY_TTL
+seconds (default 24h); expired rows are purged every PURGE_EVERY stores.
+The table lives in SQLite, so every worker process sees every key.
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+from database import connection, transaction
+
+TTL = float(os.environ.get('IDEMPOTENCY_TTL', str(24 * 3600)))
+MAX_KEY_LENGTH = 255
+PURGE_EVERY = 256
+
+CONFLICT_RESULT = {"success": False, "conflict": True,
+                   "message": "Idempotency-Key was already used for a different request"}
+
+_stores = 0
+_stores_lock = threading.Lock()
+
+
+def valid_key(key):
+    """Keys are 1-255 printable ASCII characters"""
+    return (isinstance(key, str) and 0 < len(key) <= MAX_KEY_LENGTH
+            and key.isascii() and key.isprintable())
+
+
+def request_hash(endpoint, data):
+    """Fingerprint of what a key was first used for"""
+    body = json.dumps([endpoint, data], sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.blake2b(body.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def _stored(conn, code_id, key, fingerprint):
+    row = conn.execute("SELECT request_hash, response FROM idempotency_keys "
+                       "WHERE code_id = ? AND key = ? AND created_at > ?",
+                       (code_id, key, time.time() - TTL)).fetchone()
+    if row is None:
+        return None
+    if row[0] != fingerprint:
+        return dict(CONFLICT_RESULT)
+    return {**json.loads(row[1]), "replayed": True}
+
+
+def purge_expired(conn, ttl=TTL):
+    """Drop keys past their TTL; returns how many went"""
+    return conn.execute("DELETE FROM idempotency_keys WHERE created_at <= ?",
+                        (time.time() - ttl,)).rowcount
+
+
+def idempotent(code_id, key, endpoint, data, fn):
+    """Run ``fn()`` once per (code_id, key); retries get the stored result
+
+    ``fn`` returns the usual result dict and does its writes through
+    database.transaction(), so they join the transaction the response is
+    stored in.  Without a key or a parsable code it just runs ``fn``.
+    """
+    global _stores
+    if key is None or code_id is None:
+        return fn()
+
+    fingerprint = request_hash(endpoint, data)
+    # Plain retries are answered from a read, without the write lock
+    with connection() as conn:
+        replay = _stored(conn, code_id, key, fingerprint)
+    if replay is not None:
+        return replay
+
+    with transaction() as conn:
+        # A concurrent request with the same key may have committed meanwhile
+        replay = _stored(conn, code_id, key, fingerprint)
+        if replay is not None:
+            return replay
+
+        result = fn()
+        if result.get("success"):
+            conn.execute("INSERT OR REPLACE INTO idempotency_keys "
+                         "(code_id, key, request_hash, response, created_at) VALUES (?, ?, ?, ?, ?)",
+                         (code_id, key, fingerprint, json.dumps(result), time.time()))
+            with _stores_lock:
+                _stores += 1
+                purge = _stores % PURGE_EVERY == 0
+            if purge:
+                purge_expired(conn)
+        return result
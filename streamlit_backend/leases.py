@@ -0,0 +1,175 @@
+"""
+Credit reservation leases
+
+Instead of one /api/use_credit round trip per enhancement, a client can
+reserve a block of credits, spend them locally and report back once:
+
+    reserve   N credits move into an open lease (debited from the user
+              up front, so they can never be spent twice) and the client
+              gets a signed token valid for LEASE_TTL seconds
+    settle    the client reports how many it spent; the rest go back to
+              the user and the lease is closed
+    expire    open leases past their expiry give back everything not
+              reported as spent; a settlement arriving after that still
+              bills what the client reports having spent
+
+The ledger invariant is that users.used_credits always counts every
+debited credit plus every credit still held by an open lease.  Settling is
+final and idempotent: repeating it with the same count returns the same
+answer.  The expiry sweep runs on every reserve, settle and credit check,
+so a lapsed lease never holds a user's credits for long.
+
+The token is ``<lease id>.<expires at>.<signature>``; the signature covers
+the redemption code too, so a forged or mismatched token is refused before
+any database work.
+
+Settings: LEASE_TTL (seconds, default 900), LEASE_CREDITS (default block,
+10), LEASE_MAX_CREDITS (largest block, 50).
+"""
+
+import os
+import time
+
+from codes import parse_code
+from credits import debit_credit
+from signing import sign, verify
+
+LEASE_TTL = int(os.environ.get('LEASE_TTL', '900'))
+DEFAULT_CREDITS = int(os.environ.get('LEASE_CREDITS', '10'))
+MAX_CREDITS = int(os.environ.get('LEASE_MAX_CREDITS', '50'))
+
+_EXPIRE = '''UPDATE credit_leases SET status = 'expired', settled_at = ?
+             WHERE status = 'open' AND expires_at <= ?
+             RETURNING code_id, reserved - spent'''
+
+_DUE = '''SELECT 1 FROM credit_leases
+          WHERE status = 'open' AND expires_at <= ? AND code_id = ? LIMIT 1'''
+
+# Never below zero, even if an admin reset used_credits while a lease was open
+_REFUND = '''UPDATE users SET used_credits = MAX(0, used_credits - ?)
+             WHERE code_id = ?
+             RETURNING email, credits - used_credits'''
+
+# Late settlement of an expired lease: never past the user's total
+_CHARGE = '''UPDATE users SET used_credits = MIN(credits, used_credits + ?)
+             WHERE code_id = ?
+             RETURNING email, credits - used_credits'''
+
+
+def lease_token(lease_id, code_id, expires_at):
+    return f"{lease_id}.{expires_at}.{sign('lease', lease_id, code_id, expires_at)}"
+
+
+def parse_lease_token(token, code_id):
+    """Lease id of a token signed for ``code_id``, else None"""
+    if not isinstance(token, str) or code_id is None:
+        return None
+    parts = token.split('.')
+    if len(parts) != 3 or not parts[0].isdigit() or not parts[1].isdigit():
+        return None
+    lease_id, expires_at = int(parts[0]), int(parts[1])
+    if not verify(parts[2], 'lease', lease_id, code_id, expires_at):
+        return None
+    return lease_id
+
+
+def expire_leases(conn, now=None):
+    """Close every open lease past its expiry and refund it; returns how many"""
+    now = time.time() if now is None else now
+    expired = conn.execute(_EXPIRE, (now, now)).fetchall()
+    refunds = {}
+    for code_id, unspent in expired:
+        refunds[code_id] = refunds.get(code_id, 0) + unspent
+    for code_id, unspent in refunds.items():
+        if unspent:
+            conn.execute(_REFUND, (unspent, code_id)).fetchall()
+    return len(expired)
+
+
+def has_due_leases(conn, code_id, now=None):
+    """Whether ``code_id`` holds an open lease past its expiry (a cheap read)"""
+    now = time.time() if now is None else now
+    return conn.execute(_DUE, (now, code_id)).fetchone() is not None
+
+
+def reserve_lease(conn, redemption_code, credits=DEFAULT_CREDITS, now=None):
+    """Move up to ``credits`` credits into a new lease
+
+    Grants what the balance allows (at least one).  Returns ``{"success":
+    True, "lease", "lease_id", "credits", "expires_at", "email",
+    "remaining_credits"}`` or ``{"success": False, "reason": ...}`` with
+    debit_credit()'s reasons.  Run it inside a write transaction.
+    """
+    code_id = parse_code(redemption_code)
+    if code_id is None:
+        return {"success": False, "reason": 'invalid'}
+    now = time.time() if now is None else now
+    expire_leases(conn, now)
+
+    row = conn.execute("SELECT credits - used_credits FROM users WHERE code_id = ? AND status = 'active'",
+                       (code_id,)).fetchone()
+    if row is not None:
+        # An empty balance still asks for one, so the debit reports no_credits
+        credits = min(credits, max(row[0], 1))
+    debit = debit_credit(conn, redemption_code, amount=credits)
+    if not debit["success"]:
+        return debit
+
+    expires_at = int(now) + LEASE_TTL
+    lease_id = conn.execute("INSERT INTO credit_leases (code_id, reserved, created_at, expires_at) "
+                            "VALUES (?, ?, ?, ?)", (code_id, credits, now, expires_at)).lastrowid
+    return {
+        "success": True,
+        "lease": lease_token(lease_id, code_id, expires_at),
+        "lease_id": lease_id,
+        "credits": credits,
+        "expires_at": expires_at,
+        "email": debit["email"],
+        "remaining_credits": debit["remaining_credits"],
+    }
+
+
+def settle_lease(conn, redemption_code, token, spent, now=None):
+    """Close a lease, charging ``spent`` credits and refunding the rest
+
+    Returns ``{"success": True, "spent", "refunded", "email",
+    "remaining_credits"}`` (plus ``"replayed": True`` for a repeat of an
+    earlier settlement, ``"late": True`` for a lease that had already
+    expired) or ``{"success": False, "reason": ...}`` where reason is
+    ``'invalid'``, ``'bad_spent'`` or ``'settled'`` (already settled with
+    another count).
+
+    An expired lease gave all its credits back, so settling it late
+    charges ``spent`` afresh instead of refunding the rest.
+    """
+    code_id = parse_code(redemption_code)
+    lease_id = parse_lease_token(token, code_id)
+    if lease_id is None:
+        return {"success": False, "reason": 'invalid'}
+    now = time.time() if now is None else now
+    expire_leases(conn, now)
+    row = conn.execute("SELECT reserved, spent, status FROM credit_leases WHERE id = ? AND code_id = ?",
+                       (lease_id, code_id)).fetchone()
+    if row is None:
+        return {"success": False, "reason": 'invalid'}
+
+    reserved, recorded, status = row
+    if isinstance(spent, bool) or not isinstance(spent, int) or not 0 <= spent <= reserved:
+        return {"success": False, "reason": 'bad_spent'}
+    if status == 'settled':
+        if spent != recorded:
+            return {"success": False, "reason": 'settled'}
+        email, remaining = conn.execute("SELECT email, credits - used_credits FROM users WHERE code_id = ?",
+                                        (code_id,)).fetchone()
+        return {"success": True, "replayed": True, "spent": spent, "refunded": reserved - spent,
+                "email": email, "remaining_credits": remaining}
+
+    conn.execute("UPDATE credit_leases SET spent = ?, status = 'settled', settled_at = ? WHERE id = ?",
+                 (spent, now, lease_id))
+    if status == 'expired':
+        email, remaining = conn.execute(_CHARGE, (spent, code_id)).fetchone()
+        return {"success": True, "late": True, "spent": spent, "refunded": reserved - spent,
+                "email": email, "remaining_credits": remaining}
+    email, remaining = conn.execute(_REFUND, (reserved - spent, code_id)).fetchone()
+    return {"success": True, "spent": spent, "refunded": reserved - spent,
+            "email": email, "remaining_credits": remaining}
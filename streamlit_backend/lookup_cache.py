@@ -0,0 +1,195 @@
+"""
+In-process cache for redemption code lookups (verify / check_credits)
+
+Entries are bounded in number (LRU) and in age (TTL), and are dropped the
+moment the row behind them changes - by a debit, revoke or approval in
+this process or in any other one sharing users.db:
+
+* ``PRAGMA data_version`` on a private connection changes whenever any
+  other connection commits.  Checking it costs no I/O, so it is done on
+  every lookup.
+* Only then is the user_changes log (filled by triggers, migration 7) read
+  past the last seen seq, and exactly those code_ids are evicted.  Commits
+  that never touch users (the usage log writer) cost one tiny query.
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from database import get_pool, open_connection
+
+CACHE_SIZE = int(os.environ.get('LOOKUP_CACHE_SIZE', '10000'))
+CACHE_TTL = float(os.environ.get('LOOKUP_CACHE_TTL', '30'))
+
+_SELECT_USER = '''SELECT name, email, credits, used_credits, status
+                  FROM users WHERE code_id = ?'''
+
+
+class UserLookupCache:
+    """LRU + TTL cache of users rows keyed by code_id
+
+    Only rows that exist are cached, so an approval can never be hidden by
+    a cached "invalid code"; the change log still evicts on insert in case
+    a code is re-issued.
+    """
+
+    def __init__(self, max_entries=CACHE_SIZE, ttl=CACHE_TTL, pool=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.pool = pool
+        self.pid = os.getpid()
+
+        self._entries = OrderedDict()  # code_id -> (expires_at, row)
+        self._lock = threading.Lock()
+        self._watcher = None
+        self._data_version = None
+        self._last_seq = 0
+        self._generation = 0  # bumped whenever entries may have gone stale
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.flushes = 0
+
+    # ---- cross-connection invalidation ----
+
+    def _sync(self):
+        """Evict whatever other connections changed since the last look (lock held)"""
+        if self._watcher is None:
+            # Getting the pool first also makes sure user_changes exists
+            pool = self.pool or get_pool()
+            self._watcher = open_connection(pool.db_path, read_only=True)
+            self._data_version = self._watcher.execute("PRAGMA data_version").fetchone()[0]
+            self._last_seq = self._watcher.execute(
+                "SELECT COALESCE(MAX(seq), 0) FROM user_changes").fetchone()[0]
+            return
+
+        version = self._watcher.execute("PRAGMA data_version").fetchone()[0]
+        if version == self._data_version:
+            return
+        self._data_version = version
+
+        changes = self._watcher.execute(
+            "SELECT seq, code_id FROM user_changes WHERE seq > ? ORDER BY seq", (self._last_seq,)
+        ).fetchall()
+        if not changes:
+            if self._watcher.execute("SELECT COALESCE(MAX(seq), 0) FROM user_changes"
+                                     ).fetchone()[0] < self._last_seq:
+                # Log restarted (database reset): nothing cached can be trusted
+                self._flush()
+            return
+
+        self._generation += 1
+        if changes[0][0] != self._last_seq + 1:
+            # Fell further behind than the trimmed log reaches
+            self._flush()
+        else:
+            for _, code_id in changes:
+                if self._entries.pop(code_id, None) is not None:
+                    self.invalidations += 1
+        self._last_seq = changes[-1][0]
+
+    def _flush(self):
+        self._generation += 1
+        self._entries.clear()
+        self.flushes += 1
+        self._last_seq = self._watcher.execute(
+            "SELECT COALESCE(MAX(seq), 0) FROM user_changes").fetchone()[0]
+
+    # ---- lookups ----
+
+    def get(self, code_id):
+        """``(name, email, credits, used_credits, status)`` or None
+
+        Inside a transaction the row is read straight from its connection
+        (it may hold uncommitted changes) and nothing is cached.
+        """
+        pool = self.pool or get_pool()
+        if pool.in_transaction():
+            with pool.connection() as conn:
+                return conn.execute(_SELECT_USER, (code_id,)).fetchone()
+
+        now = time.monotonic()
+        with self._lock:
+            self._sync()
+            entry = self._entries.get(code_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(code_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation
+
+        with pool.connection() as conn:
+            row = conn.execute(_SELECT_USER, (code_id,)).fetchone()
+
+        if row is not None:
+            with self._lock:
+                if self._generation != generation:
+                    # Changes were consumed while we read: the row may
+                    # predate one of them, and no later _sync() would
+                    # evict it, so don't keep it
+                    return row
+                self._entries[code_id] = (now + self.ttl, row)
+                self._entries.move_to_end(code_id)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return row
+
+    def invalidate(self, code_id):
+        """Drop one code right away (this process's own writes)"""
+        with self._lock:
+            self._generation += 1
+            if self._entries.pop(code_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        """Hit/miss counters and current size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "flushes": self.flushes,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_user_cache():
+    """Process-wide cache, recreated after a fork"""
+    global _cache
+    cache = _cache
+    if cache is None or cache.pid != os.getpid():
+        with _cache_lock:
+            if _cache is None or _cache.pid != os.getpid():
+                _cache = UserLookupCache()
+            cache = _cache
+    return cache
+
+
+def lookup_user(code_id):
+    """Cached ``(name, email, credits, used_credits, status)`` for a code_id"""
+    return get_user_cache().get(code_id)
+
+
+def lookup_cache_stats():
+    """Counters for the process-wide cache"""
+    return get_user_cache().stats()
@@ -0,0 +1,315 @@
+"""
+In-process metrics, served as Prometheus text at /metrics
+
+Counters and histograms live in this process and are updated inline by the
+code they describe (one lock and a dict lookup each, about a microsecond
+per update):
+
+    http_requests_total{route, method, status}
+    http_request_duration_seconds{route, method}     install_metrics()
+    api_actions_total{action, outcome}
+    api_action_duration_seconds{action}              timed_action()
+    db_transaction_duration_seconds{kind}            database.py (write / read / snapshot)
+    db_pool_wait_seconds                             database.py
+    credit_debits_total{result}                      credits.py (ok / invalid / inactive / no_credits)
+
+Routes are labelled by their URL rule, never the raw path, so label sets
+stay bounded.  At scrape time render() adds the counters the caches, rate
+limiter, admission control, usage log, pool and balance hub already keep
+(STATS_EXPORTS), including cache hit rates.
+
+Like /api/stats everything is per process: under gunicorn each scrape
+answers for the worker that served it.
+"""
+
+import math
+import time
+import bisect
+import functools
+import importlib
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Counters the other modules already keep, read at scrape time:
+# (metric prefix, module, stats function, counter keys, gauge keys)
+STATS_EXPORTS = (
+    ('lookup_cache', 'lookup_cache', 'lookup_cache_stats',
+     ('hits', 'misses', 'evictions', 'invalidations'), ('size', 'hit_rate')),
+    ('output_cache', 'output_cache', 'output_cache_stats',
+     ('hits', 'misses', 'evictions'), ('entries', 'bytes', 'hit_rate')),
+    ('singleflight', 'singleflight', 'singleflight_stats',
+     ('leaders', 'shared', 'replayed'), ('in_flight',)),
+    ('admission', 'admission', 'admission_stats',
+     ('admitted', 'shed_queue_full', 'shed_timeout'), ('active', 'queued')),
+    ('usage_log', 'usage_log', 'usage_log_stats',
+     ('enqueued', 'written', 'dropped', 'batches', 'errors'), ('queue_depth',)),
+    ('db_pool', 'database', 'pool_stats',
+     ('opened', 'reused', 'leaks_reclaimed'), ('idle', 'checked_out')),
+    ('balance', 'balances', 'balance_stats',
+     ('published', 'scans', 'rejected_streams', 'rejected_polls'), ('subscribers', 'streams', 'polls')),
+)
+
+
+class Histogram:
+    """Cumulative histogram with fixed upper bounds (Prometheus style)"""
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self._counts = [0] * (len(self.bounds) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.bounds, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        """``{"buckets": [(le, cumulative count), ...], "count", "sum"}``"""
+        with self._lock:
+            counts = list(self._counts)
+            count, total = self.count, self.sum
+        cumulative = 0
+        buckets = []
+        for bound, n in zip(self.bounds + (math.inf,), counts):
+            cumulative += n
+            buckets.append((bound, cumulative))
+        return {"buckets": buckets, "count": count, "sum": total}
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile (None if empty)"""
+        snap = self.snapshot()
+        if not snap["count"]:
+            return None
+        rank = q * snap["count"]
+        for bound, cumulative in snap["buckets"]:
+            if cumulative >= rank:
+                return bound
+        return math.inf
+
+
+class Counter:
+    """Monotonic count per combination of label values"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *values, amount=1):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def value(self, *values):
+        return self._values.get(values, 0)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name, dict(zip(self.labels, values)), n) for values, n in items]
+
+
+class LabeledHistogram:
+    """One Histogram per combination of label values"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), bounds=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.bounds = tuple(bounds)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def child(self, *values):
+        histogram = self._children.get(values)
+        if histogram is None:
+            with self._lock:
+                histogram = self._children.setdefault(values, Histogram(self.bounds))
+        return histogram
+
+    def observe(self, value, *values):
+        self.child(*values).observe(value)
+
+    def samples(self):
+        with self._lock:
+            children = list(self._children.items())
+        samples = []
+        for values, histogram in children:
+            samples += _histogram_samples(self.name, dict(zip(self.labels, values)), histogram.snapshot())
+        return samples
+
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def _register(cls, name, *args, **kwargs):
+    with _metrics_lock:
+        metric = _metrics.get(name)
+        if metric is None:
+            metric = _metrics[name] = cls(name, *args, **kwargs)
+        return metric
+
+
+def counter(name, help, labels=()):
+    """The process-wide counter called ``name`` (created on first use)"""
+    return _register(Counter, name, help, labels)
+
+
+def histogram(name, help, labels=(), bounds=LATENCY_BUCKETS):
+    """The process-wide histogram called ``name`` (created on first use)"""
+    return _register(LabeledHistogram, name, help, labels, bounds)
+
+
+HTTP_REQUESTS = counter('http_requests_total', 'HTTP requests by route, method and status',
+                        ('route', 'method', 'status'))
+HTTP_SECONDS = histogram('http_request_duration_seconds', 'HTTP request latency by route and method',
+                         ('route', 'method'))
+ACTIONS = counter('api_actions_total', 'handle_api_request calls by action and outcome',
+                  ('action', 'outcome'))
+ACTION_SECONDS = histogram('api_action_duration_seconds', 'handle_api_request latency by action',
+                           ('action',))
+
+
+def timed_action(actions):
+    """Decorator: count and time ``fn(action, ...)`` per action
+
+    Actions outside ``actions`` are labelled 'unknown' so a client cannot
+    mint new series.
+    """
+    actions = frozenset(actions)
+
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(action, *args, **kwargs):
+            label = action if action in actions else 'unknown'
+            outcome = 'error'
+            started = time.perf_counter()
+            try:
+                result = fn(action, *args, **kwargs)
+                outcome = 'success' if isinstance(result, dict) and result.get("success") else 'failure'
+                return result
+            finally:
+                ACTION_SECONDS.observe(time.perf_counter() - started, label)
+                ACTIONS.inc(label, outcome)
+
+        return wrapper
+
+    return decorate
+
+
+# ---- exposition ----
+
+def _histogram_samples(name, labels, snap, scale=1):
+    samples = [(name + '_bucket', dict(labels, le=bound * scale), cumulative)
+               for bound, cumulative in snap["buckets"]]
+    samples.append((name + '_sum', labels, snap["sum"] * scale))
+    samples.append((name + '_count', labels, snap["count"]))
+    return samples
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_sample(name, labels, value):
+    if not labels:
+        return f"{name} {_format_value(value)}"
+    pairs = ','.join(f'{key}="{_escape(_format_value(val) if key == "le" else val)}"'
+                     for key, val in labels.items())
+    return f"{name}{{{pairs}}} {_format_value(value)}"
+
+
+def _exported_families():
+    """(name, kind, help, samples) for every STATS_EXPORTS entry that answers"""
+    families = []
+    for prefix, module, function, counters, gauges in STATS_EXPORTS:
+        try:
+            stats = getattr(importlib.import_module(module), function)()
+        except Exception:
+            continue  # one broken subsystem must not take /metrics down
+        for key in counters:
+            families.append((f"{prefix}_{key}_total", 'counter', f"{module}.{function}() {key}",
+                             [(f"{prefix}_{key}_total", {}, stats[key])]))
+        for key in gauges:
+            families.append((f"{prefix}_{key}", 'gauge', f"{module}.{function}() {key}",
+                             [(f"{prefix}_{key}", {}, stats[key])]))
+        if module == 'admission':
+            families.append(('admission_wait_seconds', 'histogram', 'Write admission wait',
+                             _histogram_samples('admission_wait_seconds', {}, stats["wait_ms"], scale=0.001)))
+
+    try:
+        from ratelimit import rate_limit_stats
+        limits = rate_limit_stats()  # {"ip": {...}, "code": {...}}
+    except Exception:
+        return families
+    for key in ('allowed', 'rejected'):
+        families.append((f"rate_limit_{key}_total", 'counter', f"ratelimit.rate_limit_stats() {key}",
+                         [(f"rate_limit_{key}_total", {"limit": limit}, stats[key])
+                          for limit, stats in limits.items()]))
+    return families
+
+
+def render():
+    """Every metric in the Prometheus text exposition format"""
+    with _metrics_lock:
+        metrics = list(_metrics.values())
+    families = [(metric.name, metric.kind, metric.help, metric.samples()) for metric in metrics]
+    families += _exported_families()
+
+    lines = []
+    for name, kind, help, samples in families:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(_format_sample(*sample) for sample in samples)
+    return '\n'.join(lines) + '\n'
+
+
+def install_metrics(app, path='/metrics'):
+    """Count and time ``app``'s requests per route; serve render() at ``path``
+
+    Install it before the rate limiter and admission control so the
+    requests they turn away (429 / 503) are counted too.
+    """
+    from flask import request, g, Response
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _observe(response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            rule = request.url_rule
+            route = rule.rule if rule is not None else 'unmatched'
+            HTTP_SECONDS.observe(time.perf_counter() - started, route, request.method)
+            HTTP_REQUESTS.inc(route, request.method, str(response.status_code))
+        return response
+
+    def metrics():
+        return Response(render(), content_type=CONTENT_TYPE)
+
+    app.add_url_rule(path, 'metrics', metrics, methods=['GET'])
+    return app
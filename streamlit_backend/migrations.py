@@ -0,0 +1,358 @@
+"""
+Versioned schema migrations for the AI Prompt Enhancer database
+Applied once per process by database.get_pool(); request handlers never run DDL.
+"""
+
+import sqlite3
+
+from rollups import create_rollup_tables, recompute_rollups
+from codes import parse_code
+
+
+class MigrationError(sqlite3.DatabaseError):
+    """The data in the database stops a migration; it was rolled back"""
+
+
+def _create_base_tables(conn):
+    """Tables every deployment has had since the first release"""
+    # Waiting list table (for initial registration)
+    conn.execute('''CREATE TABLE IF NOT EXISTS waiting_list
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     name TEXT NOT NULL,
+                     email TEXT UNIQUE NOT NULL,
+                     reason TEXT,
+                     status TEXT DEFAULT 'pending',
+                     applied_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                     approved_date TIMESTAMP,
+                     admin_notes TEXT)''')
+
+    # Active users table (approved users)
+    conn.execute('''CREATE TABLE IF NOT EXISTS users
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     name TEXT NOT NULL,
+                     email TEXT UNIQUE NOT NULL,
+                     redemption_code TEXT UNIQUE NOT NULL,
+                     credits INTEGER DEFAULT 100,
+                     used_credits INTEGER DEFAULT 0,
+                     status TEXT DEFAULT 'active',
+                     created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                     last_used TIMESTAMP)''')
+
+    # Usage logs (the app.py layout; migration 2 reconciles the others)
+    conn.execute('''CREATE TABLE IF NOT EXISTS usage_logs
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     user_email TEXT,
+                     redemption_code TEXT,
+                     prompt_length INTEGER,
+                     response_length INTEGER,
+                     timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                     ip_address TEXT)''')
+
+
+def _unify_usage_logs(conn):
+    """Merge the three historical usage_logs layouts into one
+
+    app.py / streamlit_app.py wrote user_email/redemption_code/response_length,
+    streamlit_with_api.py wrote email/action/credits_used.  The unified table
+    keeps every column from both.
+    """
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(usage_logs)")}
+
+    if 'email' in columns:
+        # Flask layout: rebuild, since SQLite cannot rename and add in one go
+        conn.execute('''CREATE TABLE usage_logs_unified
+                        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                         user_email TEXT,
+                         redemption_code TEXT,
+                         prompt_length INTEGER,
+                         response_length INTEGER,
+                         timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                         ip_address TEXT,
+                         action TEXT DEFAULT 'enhance_prompt',
+                         credits_used INTEGER DEFAULT 1)''')
+        conn.execute('''INSERT INTO usage_logs_unified
+                            (id, user_email, prompt_length, timestamp, action, credits_used)
+                        SELECT id, email, prompt_length, timestamp, action, credits_used
+                        FROM usage_logs''')
+        conn.execute("DROP TABLE usage_logs")
+        conn.execute("ALTER TABLE usage_logs_unified RENAME TO usage_logs")
+        return
+
+    if 'action' not in columns:
+        conn.execute("ALTER TABLE usage_logs ADD COLUMN action TEXT DEFAULT 'enhance_prompt'")
+    if 'credits_used' not in columns:
+        conn.execute("ALTER TABLE usage_logs ADD COLUMN credits_used INTEGER DEFAULT 1")
+
+
+def _add_hot_path_indexes(conn):
+    """Indexes behind the admin lists and analytics counts
+
+    Lookups by email / redemption_code already use the UNIQUE autoindexes.
+    test_query_plans.py keeps every hot query off full scans and temp sorts.
+    """
+    # Pending applications list and pending count (covering for the count)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_waiting_list_status_applied "
+                 "ON waiting_list(status, applied_date)")
+    # Active-user count (covering)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_status ON users(status)")
+    # Active Users tab, newest first
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_created_date ON users(created_date)")
+    # Recent Usage: ORDER BY timestamp DESC LIMIT 10 reads ten index entries
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_usage_logs_timestamp ON usage_logs(timestamp)")
+
+
+def _add_usage_rollups(conn):
+    """Trigger-maintained rollups so dashboard metrics stop counting whole tables
+
+    Existing rows are folded in once here; afterwards the triggers keep the
+    rollups current.  The active-user count now reads stat_counters, so its
+    index is only write overhead.
+    """
+    create_rollup_tables(conn)
+    recompute_rollups(conn)
+    conn.execute("DROP INDEX IF EXISTS idx_users_status")
+
+
+def _add_code_pool(conn):
+    """Pre-generated redemption codes, popped by codes.issue_codes()"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS code_pool
+                    (id INTEGER PRIMARY KEY,
+                     code TEXT UNIQUE NOT NULL)''')
+
+
+def _integer_code_keys(conn):
+    """users.code_id: the 64-bit integer every code lookup now goes through
+
+    users is rebuilt so the TEXT UNIQUE index on redemption_code (a second,
+    wider copy of the same key) disappears; redemption_code stays as the
+    display form.  code_id goes last so ``SELECT *`` positions are unchanged.
+    Rebuilding drops the users triggers and indexes, so they are recreated
+    here.
+
+    Every existing code must parse to a distinct code_id.  A malformed code
+    would get no key (its user locked out) and two codes differing only in
+    case would share one, so either stops the migration with the user ids
+    to reissue codes for.
+    """
+    code_ids, malformed, owners = [], [], {}
+    for user_id, code in conn.execute("SELECT id, redemption_code FROM users ORDER BY id"):
+        code_id = parse_code(code)
+        if code_id is None:
+            malformed.append(user_id)
+        else:
+            owners.setdefault(code_id, []).append(user_id)
+            code_ids.append((code_id, user_id))
+    clashes = [user_ids for user_ids in owners.values() if len(user_ids) > 1]
+    if malformed or clashes:
+        problems = []
+        if malformed:
+            problems.append(f"malformed redemption codes for user ids {malformed}")
+        if clashes:
+            problems.append(f"redemption codes differing only in case for user ids {clashes}")
+        raise MigrationError(f"Can't key users by code_id: {'; '.join(problems)}. "
+                             "Reissue their codes, then start again.")
+
+    conn.execute('''CREATE TABLE users_rebuilt
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     name TEXT NOT NULL,
+                     email TEXT UNIQUE NOT NULL,
+                     redemption_code TEXT NOT NULL,
+                     credits INTEGER DEFAULT 100,
+                     used_credits INTEGER DEFAULT 0,
+                     status TEXT DEFAULT 'active',
+                     created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                     last_used TIMESTAMP,
+                     code_id INTEGER)''')
+    conn.execute('''INSERT INTO users_rebuilt
+                        (id, name, email, redemption_code, credits, used_credits,
+                         status, created_date, last_used)
+                    SELECT id, name, email, redemption_code, credits, used_credits,
+                           status, created_date, last_used
+                    FROM users''')
+    conn.executemany("UPDATE users_rebuilt SET code_id = ? WHERE id = ?", code_ids)
+    conn.execute("DROP TABLE users")
+    conn.execute("ALTER TABLE users_rebuilt RENAME TO users")
+
+    conn.execute("CREATE UNIQUE INDEX idx_users_code_id ON users(code_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_created_date ON users(created_date)")
+    create_rollup_tables(conn)
+
+
+def _add_user_change_log(conn):
+    """Append-only log of users rows whose lookup result changed
+
+    lookup_cache.py reads it (only when PRAGMA data_version says another
+    connection committed) to drop exactly the cached codes that changed,
+    in this process or any other.  last_used is deliberately not tracked.
+    Every 1000th entry trims the log to its last 10000.
+    """
+    conn.execute('''CREATE TABLE IF NOT EXISTS user_changes
+                    (seq INTEGER PRIMARY KEY,
+                     code_id INTEGER)''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_user_changes_insert
+                    AFTER INSERT ON users
+                    BEGIN
+                        INSERT INTO user_changes (code_id) VALUES (NEW.code_id);
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_user_changes_delete
+                    AFTER DELETE ON users
+                    BEGIN
+                        INSERT INTO user_changes (code_id) VALUES (OLD.code_id);
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_user_changes_update
+                    AFTER UPDATE OF name, email, credits, used_credits, status, code_id ON users
+                    BEGIN
+                        INSERT INTO user_changes (code_id) VALUES (OLD.code_id);
+                        INSERT INTO user_changes (code_id)
+                        SELECT NEW.code_id WHERE NEW.code_id IS NOT OLD.code_id;
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_user_changes_trim
+                    AFTER INSERT ON user_changes
+                    WHEN NEW.seq % 1000 = 0
+                    BEGIN
+                        DELETE FROM user_changes WHERE seq <= NEW.seq - 10000;
+                    END''')
+
+
+def _add_idempotency_keys(conn):
+    """Stored responses for Idempotency-Key retries (idempotency.py)
+
+    Keyed by the redemption code's code_id plus the client's key, so two
+    clients can never collide.  created_at is epoch seconds for the TTL.
+    """
+    conn.execute('''CREATE TABLE IF NOT EXISTS idempotency_keys
+                    (code_id INTEGER NOT NULL,
+                     key TEXT NOT NULL,
+                     request_hash TEXT NOT NULL,
+                     response TEXT NOT NULL,
+                     created_at REAL NOT NULL,
+                     PRIMARY KEY (code_id, key)) WITHOUT ROWID''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys(created_at)")
+
+
+def _add_signing_secret(conn):
+    """A random HMAC key shared by every worker (signing.py)
+
+    Generated by the database itself on first migration, so multi-worker
+    deployments agree on it without any configuration; API_SIGNING_KEY
+    overrides it.
+    """
+    conn.execute('''CREATE TABLE IF NOT EXISTS server_secrets
+                    (name TEXT PRIMARY KEY,
+                     value BLOB NOT NULL) WITHOUT ROWID''')
+    conn.execute("INSERT OR IGNORE INTO server_secrets (name, value) VALUES ('signing', randomblob(32))")
+
+
+def _add_credit_leases(conn):
+    """Blocks of credits reserved by a client and spent locally (leases.py)
+
+    The reserved credits are already counted in users.used_credits; settling
+    or expiring a lease gives back ``reserved - spent``.  The partial index
+    only holds open leases, so the expiry sweep never walks settled ones.
+    """
+    conn.execute('''CREATE TABLE IF NOT EXISTS credit_leases
+                    (id INTEGER PRIMARY KEY,
+                     code_id INTEGER NOT NULL,
+                     reserved INTEGER NOT NULL,
+                     spent INTEGER NOT NULL DEFAULT 0,
+                     status TEXT NOT NULL DEFAULT 'open',
+                     created_at REAL NOT NULL,
+                     expires_at REAL NOT NULL,
+                     settled_at REAL)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_credit_leases_open "
+                 "ON credit_leases(expires_at) WHERE status = 'open'")
+
+
+def _add_session_epochs(conn):
+    """Per-user session epoch, bumped to revoke signed session tokens (sessions.py)
+
+    Only users whose sessions were ever revoked have a row (epoch 0 is
+    implied), so every process can keep the whole table in memory.  Any
+    status change or deletion of a user bumps it.
+    """
+    conn.execute('''CREATE TABLE IF NOT EXISTS session_epochs
+                    (user_id INTEGER PRIMARY KEY,
+                     epoch INTEGER NOT NULL) WITHOUT ROWID''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_session_epochs_status
+                    AFTER UPDATE OF status ON users
+                    WHEN NEW.status IS NOT OLD.status
+                    BEGIN
+                        INSERT INTO session_epochs (user_id, epoch) VALUES (NEW.id, 1)
+                        ON CONFLICT (user_id) DO UPDATE SET epoch = epoch + 1;
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_session_epochs_delete
+                    AFTER DELETE ON users
+                    BEGIN
+                        INSERT INTO session_epochs (user_id, epoch) VALUES (OLD.id, 1)
+                        ON CONFLICT (user_id) DO UPDATE SET epoch = epoch + 1;
+                    END''')
+
+
+# (version, description, function) - append only, never edit a released entry
+MIGRATIONS = [
+    (1, "base tables", _create_base_tables),
+    (2, "unified usage_logs schema", _unify_usage_logs),
+    (3, "hot path indexes", _add_hot_path_indexes),
+    (4, "usage rollups and stat counters", _add_usage_rollups),
+    (5, "reserved redemption code pool", _add_code_pool),
+    (6, "integer redemption code keys", _integer_code_keys),
+    (7, "user change log for lookup caches", _add_user_change_log),
+    (8, "idempotency keys for credit debits", _add_idempotency_keys),
+    (9, "shared signing secret", _add_signing_secret),
+    (10, "credit reservation leases", _add_credit_leases),
+    (11, "session epochs for signed session tokens", _add_session_epochs),
+]
+
+
+def current_version(conn):
+    """Highest migration applied to this database (0 for a fresh file)"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version
+                    (version INTEGER PRIMARY KEY,
+                     description TEXT,
+                     applied_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def migrate(conn):
+    """Apply every pending migration, each in its own transaction
+
+    ``conn`` must be in autocommit mode (isolation_level=None) like the pooled
+    connections.  The version is re-read under the write lock, so several
+    processes starting at once apply each migration exactly once.
+    """
+    applied = []
+    if current_version(conn) >= MIGRATIONS[-1][0]:
+        return applied
+
+    for version, description, apply in MIGRATIONS:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if current_version(conn) >= version:
+                conn.rollback()
+                continue
+            apply(conn)
+            conn.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                         (version, description))
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        applied.append(version)
+    return applied
+
+
+def rebuild_schema(conn):
+    """Drop every table and migrate a blank schema (admin "Reset Database")"""
+    tables = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+    )]
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for table in tables:
+            conn.execute(f'DROP TABLE IF EXISTS "{table}"')
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return migrate(conn)
@@ -0,0 +1,205 @@
+"""
+Memoized enhancement output
+
+The prompt generators are pure functions of (prompt, settings), and the
+same prompts arrive again and again (retries, the context-menu
+enhanceSelection resubmit).  @memoized_enhancement keeps their output in a
+byte-bounded LRU keyed by:
+
+    (generator, blake2b(prompt), canonical settings JSON)
+
+The generator part is a hash of the function's compiled code, so editing a
+template can never serve output rendered by the old one - not even from
+the on-disk copy.
+
+Generators built on templates.py's precompiled skeletons render faster
+than a cache lookup costs and are left unwrapped.
+
+Only the rendering is cached: callers debit credits before or after calling
+the generator exactly as before, hit or miss.
+
+Settings:
+    ENHANCE_CACHE_BYTES   memory budget (default 32 MB)
+    ENHANCE_CACHE_PATH    if set, loaded at startup and saved at exit
+"""
+
+import os
+import gzip
+import json
+import atexit
+import marshal
+import hashlib
+import logging
+import tempfile
+import threading
+import functools
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+CACHE_BYTES = int(os.environ.get('ENHANCE_CACHE_BYTES', str(32 * 1024 * 1024)))
+CACHE_PATH = os.environ.get('ENHANCE_CACHE_PATH') or None
+
+# Rough per-entry bookkeeping (key tuple, OrderedDict node) on top of the text
+_ENTRY_OVERHEAD = 200
+
+
+def prompt_digest(prompt):
+    """128-bit blake2b of the prompt text"""
+    return hashlib.blake2b(prompt.encode('utf-8', 'surrogatepass'), digest_size=16).hexdigest()
+
+
+def settings_key(settings):
+    """Canonical form of a settings dict: key order and spacing don't matter"""
+    return json.dumps(settings or {}, sort_keys=True, separators=(',', ':'), default=str)
+
+
+def _entry_size(key, value):
+    return len(value.encode('utf-8', 'surrogatepass')) + len(key[2]) + _ENTRY_OVERHEAD
+
+
+class OutputCache:
+    """LRU of rendered prompts, bounded by (approximate) bytes"""
+
+    def __init__(self, max_bytes=CACHE_BYTES, path=None):
+        self.max_bytes = max_bytes
+        self.path = path
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if path:
+            self.load()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = _entry_size(key, value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Hit/miss counters and memory use"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+    # ---- persistence ----
+
+    def save(self, path=None):
+        """Write every entry (oldest first) to a gzip JSON lines file"""
+        path = path or self.path
+        if not path:
+            return 0
+        with self._lock:
+            items = [(key, value) for key, (value, _) in self._entries.items()]
+        # Each worker saves at exit: a private temp file per process, so
+        # workers exiting together never write into each other's copy
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                   dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, 'wb') as raw, gzip.open(raw, 'wt', encoding='utf-8') as f:
+                for key, value in items:
+                    f.write(json.dumps({"k": list(key), "v": value}) + "\n")
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        return len(items)
+
+    def load(self, path=None):
+        """Read entries written by save(); a missing or damaged file is skipped"""
+        path = path or self.path
+        if not path or not os.path.exists(path):
+            return 0
+        loaded = 0
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    record = json.loads(line)
+                    self.put(tuple(record["k"]), record["v"])
+                    loaded += 1
+        except (OSError, EOFError, ValueError, KeyError, TypeError) as e:
+            logger.warning("Enhancement cache %s not fully loaded: %s", path, e)
+        return loaded
+
+
+def _generator_id(fn):
+    """Name plus a hash of the compiled body, so a changed template gets new keys"""
+    code_hash = hashlib.blake2b(marshal.dumps(fn.__code__), digest_size=8).hexdigest()
+    return f"{fn.__qualname__}:{code_hash}"
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_output_cache():
+    """Process-wide cache, loaded from and saved to ENHANCE_CACHE_PATH if set"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = OutputCache(path=CACHE_PATH)
+                if CACHE_PATH:
+                    atexit.register(_cache.save)
+    return _cache
+
+
+def output_cache_stats():
+    """Counters for the process-wide cache"""
+    return get_output_cache().stats()
+
+
+def memoized_enhancement(fn):
+    """Cache ``fn(original_prompt, settings)`` by prompt hash and canonical settings"""
+    generator = _generator_id(fn)
+
+    @functools.wraps(fn)
+    def wrapper(original_prompt, settings):
+        if not isinstance(original_prompt, str) or not isinstance(settings, dict):
+            return fn(original_prompt, settings)
+        cache = get_output_cache()
+        key = (generator, prompt_digest(original_prompt), settings_key(settings))
+        enhanced = cache.get(key)
+        if enhanced is None:
+            enhanced = fn(original_prompt, settings)
+            cache.put(key, enhanced)
+        return enhanced
+
+    return wrapper
@@ -0,0 +1,184 @@
+"""
+In-memory token-bucket rate limiting, per client IP and per redemption code
+
+Every bucket holds up to ``burst`` tokens and refills at ``rate`` tokens a
+second; a request spends one token (a batch spends one per operation).
+Buckets live in lock-striped shards - the key's hash picks the shard - so
+request threads only contend when they hash to the same stripe.  Each
+shard keeps at most ``max_keys`` buckets, dropping the least recently used
+(a dropped bucket simply starts full again).
+
+install_rate_limits(app) checks both limits in a Flask before_request
+hook, so an over-limit request gets 429 + Retry-After before any database
+work.  Limits are per process; with N workers a client can get up to N
+times the configured rate in the worst case.
+
+Settings (requests per second / bucket size):
+    RATE_LIMIT_IP_RATE, RATE_LIMIT_IP_BURST        default 5 / 30
+    RATE_LIMIT_CODE_RATE, RATE_LIMIT_CODE_BURST    default 2 / 10
+    RATE_LIMIT_SHARDS                              default 16
+    RATE_LIMIT_ENABLED=0                           turns limiting off
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from codes import parse_code
+
+ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') != '0'
+IP_RATE = float(os.environ.get('RATE_LIMIT_IP_RATE', '5'))
+IP_BURST = float(os.environ.get('RATE_LIMIT_IP_BURST', '30'))
+CODE_RATE = float(os.environ.get('RATE_LIMIT_CODE_RATE', '2'))
+CODE_BURST = float(os.environ.get('RATE_LIMIT_CODE_BURST', '10'))
+SHARDS = int(os.environ.get('RATE_LIMIT_SHARDS', '16'))
+MAX_KEYS_PER_SHARD = 4096
+
+# Probes and monitoring are never limited
+UNLIMITED_PATHS = {'/api/health', '/api/ready', '/api/stats', '/metrics'}
+
+
+class _Shard:
+    __slots__ = ('lock', 'buckets')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()  # key -> [tokens, last refill (monotonic)]
+
+
+class TokenBucketLimiter:
+    """Token buckets keyed by any hashable, striped over ``shards`` locks"""
+
+    def __init__(self, rate, burst, shards=SHARDS, max_keys=MAX_KEYS_PER_SHARD):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._shards = [_Shard() for _ in range(shards)]
+
+        self.allowed = 0
+        self.rejected = 0
+
+    def acquire(self, key, cost=1):
+        """Spend ``cost`` tokens; returns 0 if allowed, else seconds to wait"""
+        cost = min(cost, self.burst)  # a full bucket always admits one request
+        shard = self._shards[hash(key) % len(self._shards)]
+        now = time.monotonic()
+        with shard.lock:
+            bucket = shard.buckets.get(key)
+            if bucket is None:
+                bucket = shard.buckets[key] = [self.burst, now]
+                if len(shard.buckets) > self.max_keys:
+                    shard.buckets.popitem(last=False)
+            else:
+                shard.buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                self.allowed += 1
+                return 0
+            self.rejected += 1
+            return (cost - bucket[0]) / self.rate if self.rate > 0 else float('inf')
+
+    def stats(self):
+        return {
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+            "keys": sum(len(shard.buckets) for shard in self._shards),
+            "rate": self.rate,
+            "burst": self.burst,
+        }
+
+
+class RateLimiter:
+    """The per-IP and per-code limits, checked together"""
+
+    def __init__(self, ip_rate=IP_RATE, ip_burst=IP_BURST, code_rate=CODE_RATE, code_burst=CODE_BURST,
+                 shards=SHARDS):
+        self.pid = os.getpid()
+        self.by_ip = TokenBucketLimiter(ip_rate, ip_burst, shards)
+        self.by_code = TokenBucketLimiter(code_rate, code_burst, shards)
+
+    def check(self, ip_address, code_ids=(), cost=1):
+        """0 if the request may proceed, else the Retry-After in seconds
+
+        ``code_ids`` maps each code_id to the tokens it spends.  The IP is
+        charged first; a code over its limit does not refund it, so a
+        client cycling through codes is still held to its IP rate.
+        """
+        wait = self.by_ip.acquire(ip_address, cost)
+        if wait:
+            return wait
+        for code_id, code_cost in dict(code_ids).items():
+            wait = self.by_code.acquire(code_id, code_cost)
+            if wait:
+                return wait
+        return 0
+
+    def stats(self):
+        return {"ip": self.by_ip.stats(), "code": self.by_code.stats()}
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Process-wide limiter, recreated after a fork"""
+    global _limiter
+    limiter = _limiter
+    if limiter is None or limiter.pid != os.getpid():
+        with _limiter_lock:
+            if _limiter is None or _limiter.pid != os.getpid():
+                _limiter = RateLimiter()
+            limiter = _limiter
+    return limiter
+
+
+def rate_limit_stats():
+    """Counters for the process-wide limiter"""
+    return get_rate_limiter().stats()
+
+
+def request_codes(data, args=None):
+    """``{code_id: count}`` for every well-formed code a request names"""
+    codes = {}
+    sources = [args or {}]
+    if isinstance(data, dict):
+        sources.append(data)
+        operations = data.get('operations')
+        if isinstance(operations, list):
+            sources.extend(op for op in operations if isinstance(op, dict))
+    for source in sources:
+        for field in ('redemption_code', 'code'):
+            code_id = parse_code(source.get(field))
+            if code_id is not None:
+                codes[code_id] = codes.get(code_id, 0) + 1
+                break
+    return codes
+
+
+def install_rate_limits(app):
+    """Reject over-limit /api/ requests on ``app`` with 429 before they run"""
+    from flask import request, jsonify
+
+    @app.before_request
+    def _check_rate_limits():
+        if not ENABLED or not request.path.startswith('/api/') or request.path in UNLIMITED_PATHS:
+            return None
+        data = request.get_json(silent=True) if request.is_json else None
+        operations = data.get('operations') if isinstance(data, dict) else None
+        cost = max(1, len(operations)) if isinstance(operations, list) else 1
+
+        wait = get_rate_limiter().check(request.remote_addr, request_codes(data, request.args), cost)
+        if not wait:
+            return None
+        response = jsonify({"success": False, "message": "Too many requests, slow down",
+                            "retry_after": round(wait, 2)})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(max(1, int(wait + 0.999)))
+        return response
+
+    return app
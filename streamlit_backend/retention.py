@@ -0,0 +1,187 @@
+"""
+Usage log retention
+Moves usage_logs rows older than the retention horizon into gzip JSONL
+archives partitioned by day, deletes them in small primary-key batches and
+hands the freed pages back to the filesystem with incremental VACUUM.
+
+Each batch is read without the write lock, archived (and fsynced), and only
+then deleted in a short BEGIN IMMEDIATE, so request handlers and the usage
+log writer never wait more than a few milliseconds.  A crash between the
+archive write and the delete re-archives that batch on the next run; every
+archived row carries its id so readers can de-duplicate.
+
+The dashboard rollups (rollups.py) are not touched: archived usage still
+counts towards usage_daily / user_usage_totals.
+
+Usage: python retention.py [--days N] [--dry-run] [--enable-incremental-vacuum]
+"""
+
+import os
+import gzip
+import json
+import time
+import logging
+import argparse
+from datetime import datetime, timedelta, timezone
+
+from database import get_pool
+
+logger = logging.getLogger(__name__)
+
+RETENTION_DAYS = int(os.environ.get('USAGE_LOG_RETENTION_DAYS', '90'))
+ARCHIVE_DIR = os.environ.get(
+    'USAGE_LOG_ARCHIVE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive')
+)
+BATCH_SIZE = int(os.environ.get('RETENTION_BATCH_SIZE', '500'))
+VACUUM_PAGES = int(os.environ.get('RETENTION_VACUUM_PAGES', '256'))
+
+_COLUMNS = ('id', 'user_email', 'redemption_code', 'prompt_length', 'response_length',
+            'timestamp', 'ip_address', 'action', 'credits_used')
+
+# Oldest first straight off idx_usage_logs_timestamp; deleted rows drop out,
+# so every batch starts from the front again.
+_SELECT_EXPIRED = f'''SELECT {', '.join(_COLUMNS)} FROM usage_logs
+                      WHERE timestamp < ? ORDER BY timestamp LIMIT ?'''
+
+
+def cutoff_timestamp(days=RETENTION_DAYS, now=None):
+    """Rows strictly older than this (CURRENT_TIMESTAMP format, UTC) expire"""
+    now = now or datetime.now(timezone.utc)
+    return (now - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def archive_path(day, archive_dir=ARCHIVE_DIR):
+    """archive/usage_logs/YYYY/MM/usage_logs-YYYY-MM-DD.jsonl.gz"""
+    year, month, _ = day.split('-')
+    return os.path.join(archive_dir, 'usage_logs', year, month, f'usage_logs-{day}.jsonl.gz')
+
+
+def _write_archive(rows, archive_dir):
+    """Append rows to their per-day archives and fsync; returns files touched
+
+    Appending to a .gz adds a gzip member, which gzip.open() reads back as
+    one continuous stream.
+    """
+    by_day = {}
+    for row in rows:
+        by_day.setdefault(str(row[5])[:10], []).append(row)
+
+    for day, day_rows in by_day.items():
+        path = archive_path(day, archive_dir)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'ab') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='ab') as archive:
+                for row in day_rows:
+                    archive.write(json.dumps(dict(zip(_COLUMNS, row))).encode('utf-8') + b'\n')
+            raw.flush()
+            os.fsync(raw.fileno())
+    return set(by_day)
+
+
+def auto_vacuum_mode(conn):
+    """0 = NONE, 1 = FULL, 2 = INCREMENTAL"""
+    return conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+
+
+def enable_incremental_vacuum(conn):
+    """Switch an existing database to auto_vacuum=INCREMENTAL
+
+    The mode only changes on a full VACUUM, which rewrites the whole file and
+    holds the write lock throughout: run it once, off-peak.  New databases
+    are created in incremental mode by database._open_connection().
+    """
+    if auto_vacuum_mode(conn) == 2:
+        return False
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+    return True
+
+
+def reclaim_space(conn, max_pages=VACUUM_PAGES):
+    """Release free pages a slice at a time; returns pages released"""
+    if auto_vacuum_mode(conn) != 2:
+        return 0
+    released = 0
+    while True:
+        free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if not free_pages:
+            return released
+        step = min(free_pages, max_pages)
+        conn.execute(f"PRAGMA incremental_vacuum({step})").fetchall()
+        released += step
+
+
+def archive_usage_logs(days=RETENTION_DAYS, archive_dir=ARCHIVE_DIR, batch_size=BATCH_SIZE,
+                       dry_run=False, pool=None):
+    """Archive and delete usage_logs rows older than ``days`` days"""
+    pool = pool or get_pool()
+    cutoff = cutoff_timestamp(days)
+    archived = batches = 0
+    days_touched = set()
+    max_lock_ms = 0.0
+
+    with pool.connection() as conn:
+        if dry_run:
+            expired = conn.execute("SELECT COUNT(*) FROM usage_logs WHERE timestamp < ?",
+                                   (cutoff,)).fetchone()[0]
+            return {"success": True, "dry_run": True, "cutoff": cutoff, "expired": expired}
+
+        while True:
+            # Read outside any write transaction (WAL readers never block writers)
+            rows = conn.execute(_SELECT_EXPIRED, (cutoff, batch_size)).fetchall()
+            if not rows:
+                break
+
+            days_touched |= _write_archive(rows, archive_dir)
+
+            started = time.perf_counter()
+            with pool.transaction() as tx:
+                tx.executemany("DELETE FROM usage_logs WHERE id = ?", [(row[0],) for row in rows])
+            max_lock_ms = max(max_lock_ms, (time.perf_counter() - started) * 1000)
+
+            archived += len(rows)
+            batches += 1
+            reclaim_space(conn)
+
+        if auto_vacuum_mode(conn) != 2 and archived:
+            logger.warning("auto_vacuum is not INCREMENTAL; freed pages stay in users.db "
+                           "until `python retention.py --enable-incremental-vacuum`")
+
+    return {
+        "success": True,
+        "cutoff": cutoff,
+        "archived": archived,
+        "batches": batches,
+        "days": sorted(days_touched),
+        "max_lock_ms": round(max_lock_ms, 2),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive and purge old usage logs")
+    parser.add_argument('--days', type=int, default=RETENTION_DAYS,
+                        help=f"retention horizon in days (default {RETENTION_DAYS})")
+    parser.add_argument('--archive-dir', default=ARCHIVE_DIR)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--dry-run', action='store_true', help="only count expired rows")
+    parser.add_argument('--enable-incremental-vacuum', action='store_true',
+                        help="one-off full VACUUM to switch an existing database to incremental mode")
+    args = parser.parse_args()
+
+    if args.enable_incremental_vacuum:
+        with get_pool().connection() as conn:
+            if enable_incremental_vacuum(conn):
+                print("✅ auto_vacuum switched to INCREMENTAL")
+            else:
+                print("ℹ️ auto_vacuum already INCREMENTAL")
+
+    result = archive_usage_logs(days=args.days, archive_dir=args.archive_dir,
+                                batch_size=args.batch_size, dry_run=args.dry_run)
+    if result.get("dry_run"):
+        print(f"🔍 {result['expired']} usage log rows older than {result['cutoff']}")
+    else:
+        print(f"✅ Archived {result['archived']} rows in {result['batches']} batches "
+              f"(longest write lock {result['max_lock_ms']} ms)")
+        for day in result["days"]:
+            print(f"   📦 {archive_path(day, args.archive_dir)}")
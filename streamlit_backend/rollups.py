@@ -0,0 +1,202 @@
+"""
+Usage rollups for the admin dashboards
+Triggers (migration 4) keep usage_daily, user_usage_totals and stat_counters
+current as rows are written, so dashboard metrics are a handful of
+primary-key reads no matter how large usage_logs grows.
+
+Rebuild from the base tables with:  python rollups.py --backfill
+"""
+
+import sys
+
+# stat_counters keys maintained by the triggers in migrations.py
+COUNTER_NAMES = (
+    'waiting_list.total',
+    'waiting_list.status.pending',
+    'users.total',
+    'users.status.active',
+    'users.credits',
+    'users.used_credits',
+    'usage_logs.total',
+)
+
+
+def create_rollup_tables(conn):
+    """Rollup tables plus the triggers that maintain them"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS usage_daily
+                    (day TEXT PRIMARY KEY,
+                     calls INTEGER NOT NULL DEFAULT 0,
+                     credits_used INTEGER NOT NULL DEFAULT 0,
+                     prompt_chars INTEGER NOT NULL DEFAULT 0,
+                     response_chars INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS user_usage_totals
+                    (user_email TEXT PRIMARY KEY,
+                     calls INTEGER NOT NULL DEFAULT 0,
+                     credits_used INTEGER NOT NULL DEFAULT 0,
+                     prompt_chars INTEGER NOT NULL DEFAULT 0,
+                     response_chars INTEGER NOT NULL DEFAULT 0,
+                     last_used TIMESTAMP) WITHOUT ROWID''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS stat_counters
+                    (name TEXT PRIMARY KEY,
+                     value INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID''')
+
+    # ---- usage_logs: append-only, so only INSERT is tracked ----
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_usage_logs_rollup
+                    AFTER INSERT ON usage_logs
+                    BEGIN
+                        INSERT INTO usage_daily (day, calls, credits_used, prompt_chars, response_chars)
+                        VALUES (date(NEW.timestamp), 1, COALESCE(NEW.credits_used, 1),
+                                COALESCE(NEW.prompt_length, 0), COALESCE(NEW.response_length, 0))
+                        ON CONFLICT(day) DO UPDATE SET
+                            calls = calls + 1,
+                            credits_used = credits_used + excluded.credits_used,
+                            prompt_chars = prompt_chars + excluded.prompt_chars,
+                            response_chars = response_chars + excluded.response_chars;
+
+                        INSERT INTO user_usage_totals
+                            (user_email, calls, credits_used, prompt_chars, response_chars, last_used)
+                        VALUES (COALESCE(NEW.user_email, ''), 1, COALESCE(NEW.credits_used, 1),
+                                COALESCE(NEW.prompt_length, 0), COALESCE(NEW.response_length, 0),
+                                NEW.timestamp)
+                        ON CONFLICT(user_email) DO UPDATE SET
+                            calls = calls + 1,
+                            credits_used = credits_used + excluded.credits_used,
+                            prompt_chars = prompt_chars + excluded.prompt_chars,
+                            response_chars = response_chars + excluded.response_chars,
+                            last_used = MAX(COALESCE(last_used, ''), excluded.last_used);
+
+                        INSERT INTO stat_counters (name, value) VALUES ('usage_logs.total', 1)
+                        ON CONFLICT(name) DO UPDATE SET value = value + 1;
+                    END''')
+
+    # ---- waiting_list ----
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_waiting_list_insert_counts
+                    AFTER INSERT ON waiting_list
+                    BEGIN
+                        INSERT INTO stat_counters (name, value) VALUES ('waiting_list.total', 1)
+                        ON CONFLICT(name) DO UPDATE SET value = value + 1;
+                        INSERT INTO stat_counters (name, value) VALUES ('waiting_list.status.' || NEW.status, 1)
+                        ON CONFLICT(name) DO UPDATE SET value = value + 1;
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_waiting_list_delete_counts
+                    AFTER DELETE ON waiting_list
+                    BEGIN
+                        UPDATE stat_counters SET value = value - 1 WHERE name = 'waiting_list.total';
+                        UPDATE stat_counters SET value = value - 1 WHERE name = 'waiting_list.status.' || OLD.status;
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_waiting_list_status_counts
+                    AFTER UPDATE OF status ON waiting_list
+                    WHEN OLD.status IS NOT NEW.status
+                    BEGIN
+                        UPDATE stat_counters SET value = value - 1 WHERE name = 'waiting_list.status.' || OLD.status;
+                        INSERT INTO stat_counters (name, value) VALUES ('waiting_list.status.' || NEW.status, 1)
+                        ON CONFLICT(name) DO UPDATE SET value = value + 1;
+                    END''')
+
+    # ---- users ----
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_users_insert_counts
+                    AFTER INSERT ON users
+                    BEGIN
+                        INSERT INTO stat_counters (name, value) VALUES ('users.total', 1)
+                        ON CONFLICT(name) DO UPDATE SET value = value + 1;
+                        INSERT INTO stat_counters (name, value) VALUES ('users.status.' || NEW.status, 1)
+                        ON CONFLICT(name) DO UPDATE SET value = value + 1;
+                        INSERT INTO stat_counters (name, value) VALUES ('users.credits', NEW.credits)
+                        ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+                        INSERT INTO stat_counters (name, value) VALUES ('users.used_credits', NEW.used_credits)
+                        ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_users_delete_counts
+                    AFTER DELETE ON users
+                    BEGIN
+                        UPDATE stat_counters SET value = value - 1 WHERE name = 'users.total';
+                        UPDATE stat_counters SET value = value - 1 WHERE name = 'users.status.' || OLD.status;
+                        UPDATE stat_counters SET value = value - OLD.credits WHERE name = 'users.credits';
+                        UPDATE stat_counters SET value = value - OLD.used_credits WHERE name = 'users.used_credits';
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_users_status_counts
+                    AFTER UPDATE OF status ON users
+                    WHEN OLD.status IS NOT NEW.status
+                    BEGIN
+                        UPDATE stat_counters SET value = value - 1 WHERE name = 'users.status.' || OLD.status;
+                        INSERT INTO stat_counters (name, value) VALUES ('users.status.' || NEW.status, 1)
+                        ON CONFLICT(name) DO UPDATE SET value = value + 1;
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_users_credit_counts
+                    AFTER UPDATE OF credits, used_credits ON users
+                    WHEN OLD.credits IS NOT NEW.credits OR OLD.used_credits IS NOT NEW.used_credits
+                    BEGIN
+                        UPDATE stat_counters SET value = value + NEW.credits - OLD.credits
+                        WHERE name = 'users.credits';
+                        UPDATE stat_counters SET value = value + NEW.used_credits - OLD.used_credits
+                        WHERE name = 'users.used_credits';
+                    END''')
+
+
+def recompute_rollups(conn):
+    """Rebuild every rollup from the base tables (caller owns the transaction)
+
+    Usage rollups are rebuilt from the rows still in usage_logs, so run this
+    before archiving old logs, not after.
+    """
+    conn.execute("DELETE FROM usage_daily")
+    conn.execute('''INSERT INTO usage_daily (day, calls, credits_used, prompt_chars, response_chars)
+                    SELECT date(timestamp), COUNT(*), SUM(COALESCE(credits_used, 1)),
+                           SUM(COALESCE(prompt_length, 0)), SUM(COALESCE(response_length, 0))
+                    FROM usage_logs GROUP BY date(timestamp)''')
+
+    conn.execute("DELETE FROM user_usage_totals")
+    conn.execute('''INSERT INTO user_usage_totals
+                        (user_email, calls, credits_used, prompt_chars, response_chars, last_used)
+                    SELECT COALESCE(user_email, ''), COUNT(*), SUM(COALESCE(credits_used, 1)),
+                           SUM(COALESCE(prompt_length, 0)), SUM(COALESCE(response_length, 0)),
+                           MAX(timestamp)
+                    FROM usage_logs GROUP BY COALESCE(user_email, '')''')
+
+    conn.execute("DELETE FROM stat_counters")
+    conn.execute('''INSERT INTO stat_counters (name, value)
+                    SELECT 'waiting_list.total', COUNT(*) FROM waiting_list
+                    UNION ALL
+                    SELECT 'waiting_list.status.' || status, COUNT(*) FROM waiting_list GROUP BY status
+                    UNION ALL
+                    SELECT 'users.total', COUNT(*) FROM users
+                    UNION ALL
+                    SELECT 'users.status.' || status, COUNT(*) FROM users GROUP BY status
+                    UNION ALL
+                    SELECT 'users.credits', COALESCE(SUM(credits), 0) FROM users
+                    UNION ALL
+                    SELECT 'users.used_credits', COALESCE(SUM(used_credits), 0) FROM users
+                    UNION ALL
+                    SELECT 'usage_logs.total', COUNT(*) FROM usage_logs''')
+
+
+def get_counters(conn, names=COUNTER_NAMES):
+    """Read stat counters by primary key; missing counters read as 0"""
+    placeholders = ', '.join('?' for _ in names)
+    values = dict(conn.execute(
+        f"SELECT name, value FROM stat_counters WHERE name IN ({placeholders})", tuple(names)
+    ).fetchall())
+    return {name: values.get(name, 0) for name in names}
+
+
+def daily_usage(conn, days=30):
+    """Per-day usage rows for the most recent ``days`` days, newest first"""
+    return conn.execute('''SELECT day, calls, credits_used, prompt_chars, response_chars
+                           FROM usage_daily ORDER BY day DESC LIMIT ?''', (days,)).fetchall()
+
+
+if __name__ == "__main__":
+    if "--backfill" not in sys.argv:
+        print("Usage: python rollups.py --backfill")
+        sys.exit(1)
+
+    from database import transaction
+
+    with transaction() as conn:
+        recompute_rollups(conn)
+        counters = get_counters(conn)
+    print("✅ Rollups rebuilt")
+    for name, value in counters.items():
+        print(f"   {name}: {value}")
@@ -0,0 +1,195 @@
+"""
+Stateless signed session tokens
+
+A successful verification (email + redemption code) returns a session
+token good for SESSION_TTL seconds:
+
+    <user id>.<epoch>.<expires at>.<signature>
+
+Read-only calls (credit checks, template lists) can send it as
+``Authorization: Bearer <token>`` instead of re-authenticating.
+validate_session() checks the HMAC (signing.py) and the expiry without
+touching the database, then compares the epoch with the user's current
+one from an in-memory copy of session_epochs.
+
+The token names no redemption code (it ends up in URLs and access logs
+as ``?session=``); the code_id a session acts for is looked up from the
+user id, once per user, and kept alongside the epochs.
+
+Revoking a user (any status change, a deletion, or revoke_sessions())
+bumps their epoch, so their outstanding tokens stop validating.  Each
+process rereads the epochs when PRAGMA data_version says another
+connection committed, checked at most every SESSION_EPOCH_REFRESH seconds
+(default 1): a revocation takes effect at once in the process that made
+it and within that interval everywhere else.
+
+Settings: SESSION_TTL (seconds, default 900), SESSION_EPOCH_REFRESH,
+SESSION_CODE_CACHE (user ids whose code_id is kept, default 10000).
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from database import get_pool, open_connection
+from signing import sign, verify
+
+SESSION_TTL = int(os.environ.get('SESSION_TTL', '900'))
+EPOCH_REFRESH = float(os.environ.get('SESSION_EPOCH_REFRESH', '1'))
+CODE_CACHE_SIZE = int(os.environ.get('SESSION_CODE_CACHE', '10000'))
+
+# The last_used write verification always made, now also returning the id
+# and epoch the token needs - still one statement
+_START = '''UPDATE users SET last_used = CURRENT_TIMESTAMP
+            WHERE email = ? AND code_id = ? AND status = 'active'
+            RETURNING id, COALESCE((SELECT epoch FROM session_epochs
+                                    WHERE user_id = users.id), 0)'''
+
+_BUMP = '''INSERT INTO session_epochs (user_id, epoch) VALUES (?, 1)
+           ON CONFLICT (user_id) DO UPDATE SET epoch = epoch + 1'''
+
+
+class SessionEpochs:
+    """In-memory copy of session_epochs, reread when the database changed
+
+    Also remembers each session user's code_id (LRU).  A user's code never
+    changes, and anything that could hand their id to someone else (a
+    deletion) bumps an epoch, which drops the remembered codes.
+    """
+
+    def __init__(self, refresh=EPOCH_REFRESH, pool=None, max_codes=CODE_CACHE_SIZE):
+        self.refresh = refresh
+        self.pool = pool
+        self.max_codes = max_codes
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._epochs = {}
+        self._code_ids = OrderedDict()  # user_id -> code_id
+        self._watcher = None
+        self._data_version = None
+        self._checked_at = None
+
+        self.reloads = 0
+
+    def _reload(self):
+        epochs = dict(self._watcher.execute("SELECT user_id, epoch FROM session_epochs"))
+        if epochs != self._epochs:
+            self._code_ids.clear()
+        self._epochs = epochs
+        self.reloads += 1
+
+    def _refresh(self):
+        """Reread the epochs if the database changed since the last look (lock held)"""
+        now = time.monotonic()
+        if self._watcher is None:
+            pool = self.pool or get_pool()  # makes sure session_epochs exists
+            self._watcher = open_connection(pool.db_path, read_only=True)
+            self._data_version = self._watcher.execute("PRAGMA data_version").fetchone()[0]
+            self._reload()
+            self._checked_at = now
+        elif self._checked_at is None or now - self._checked_at >= self.refresh:
+            self._checked_at = now
+            version = self._watcher.execute("PRAGMA data_version").fetchone()[0]
+            if version != self._data_version:
+                self._data_version = version
+                self._reload()
+
+    def epoch(self, user_id):
+        """The user's current epoch (0 if never revoked)"""
+        with self._lock:
+            self._refresh()
+            return self._epochs.get(user_id, 0)
+
+    def lookup(self, user_id):
+        """``(epoch, code_id)`` of a user; code_id is None if there is no such user"""
+        with self._lock:
+            self._refresh()
+            epoch = self._epochs.get(user_id, 0)
+            code_id = self._code_ids.get(user_id)
+            if code_id is not None:
+                self._code_ids.move_to_end(user_id)
+                return epoch, code_id
+            row = self._watcher.execute("SELECT code_id FROM users WHERE id = ?", (user_id,)).fetchone()
+            if row is None:
+                return epoch, None
+            self._code_ids[user_id] = row[0]
+            if len(self._code_ids) > self.max_codes:
+                self._code_ids.popitem(last=False)
+            return epoch, row[0]
+
+    def invalidate(self):
+        """Recheck on the next lookup (call after revoking in this process)"""
+        with self._lock:
+            self._checked_at = None
+
+    def stats(self):
+        with self._lock:
+            return {"revoked_users": len(self._epochs), "known_codes": len(self._code_ids),
+                    "reloads": self.reloads, "refresh": self.refresh}
+
+
+_epochs = None
+_epochs_lock = threading.Lock()
+
+
+def get_session_epochs():
+    """Process-wide epoch table, recreated after a fork"""
+    global _epochs
+    epochs = _epochs
+    if epochs is None or epochs.pid != os.getpid():
+        with _epochs_lock:
+            if _epochs is None or _epochs.pid != os.getpid():
+                _epochs = SessionEpochs()
+            epochs = _epochs
+    return epochs
+
+
+def session_token(user_id, epoch, expires_at):
+    return f"{user_id}.{epoch}.{expires_at}.{sign('session', user_id, epoch, expires_at)}"
+
+
+def start_session(conn, email, code_id, now=None):
+    """Mark the user as seen and issue a token; None unless email, code and status match
+
+    Returns ``{"session": token, "session_expires_at": epoch seconds}``.
+    Run it inside a write transaction.
+    """
+    row = conn.execute(_START, (email, code_id)).fetchone()
+    if row is None:
+        return None
+    user_id, epoch = row
+    expires_at = int(time.time() if now is None else now) + SESSION_TTL
+    return {"session": session_token(user_id, epoch, expires_at), "session_expires_at": expires_at}
+
+
+def validate_session(token, now=None):
+    """``{"user_id", "code_id", "epoch", "expires_at"}`` for a live token, else None"""
+    if not isinstance(token, str):
+        return None
+    parts = token.split('.')
+    if len(parts) != 4 or not all(part.isdigit() for part in parts[:3]):
+        return None
+    user_id, epoch, expires_at = (int(part) for part in parts[:3])
+    if expires_at <= (time.time() if now is None else now):
+        return None
+    if not verify(parts[3], 'session', user_id, epoch, expires_at):
+        return None
+    current, code_id = get_session_epochs().lookup(user_id)
+    if current != epoch or code_id is None:
+        return None
+    return {"user_id": user_id, "code_id": code_id, "epoch": epoch, "expires_at": expires_at}
+
+
+def revoke_sessions(conn, user_id):
+    """Invalidate every outstanding token of a user without touching their status
+
+    Call get_session_epochs().invalidate() once the transaction commits to
+    make it take effect in this process at once.
+    """
+    conn.execute(_BUMP, (user_id,))
+
+
+def session_stats():
+    """Counters for the process-wide epoch table"""
+    return get_session_epochs().stats()
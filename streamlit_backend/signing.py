@@ -0,0 +1,45 @@
+"""
+HMAC signatures for tokens handed to clients (credit leases, sessions)
+
+The key is API_SIGNING_KEY when set, otherwise the random secret migration
+9 stored in server_secrets - the same for every worker and every restart
+on one database file.  Signatures are truncated HMAC-SHA256 (128 bits),
+hex encoded.
+"""
+
+import os
+import hmac
+import hashlib
+import threading
+
+from database import get_pool
+
+ENV_KEY = os.environ.get('API_SIGNING_KEY')
+
+_keys = {}  # db_path -> key
+_keys_lock = threading.Lock()
+
+
+def signing_key():
+    """This database's signing key, read once per process"""
+    if ENV_KEY:
+        return ENV_KEY.encode('utf-8')
+    pool = get_pool()
+    key = _keys.get(pool.db_path)
+    if key is None:
+        with pool.connection() as conn:
+            key = bytes(conn.execute("SELECT value FROM server_secrets WHERE name = 'signing'").fetchone()[0])
+        with _keys_lock:
+            _keys[pool.db_path] = key
+    return key
+
+
+def sign(*parts):
+    """Signature over ``parts`` (joined with '|')"""
+    message = '|'.join(str(part) for part in parts).encode('utf-8')
+    return hmac.new(signing_key(), message, hashlib.sha256).hexdigest()[:32]
+
+
+def verify(signature, *parts):
+    """Whether ``signature`` was made by sign(*parts), in constant time"""
+    return isinstance(signature, str) and hmac.compare_digest(signature, sign(*parts))
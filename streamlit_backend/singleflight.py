@@ -0,0 +1,152 @@
+"""
+Singleflight: identical concurrent requests share one computation
+
+Several tabs or a double-click can fire the same enhancement at once.
+The first caller for a key (the leader) runs it - one credit, one
+transaction - and everyone who asks for the same key while it is in flight
+waits and gets the leader's result.  A successful result is also replayed
+for WINDOW seconds after it completes, which catches a double-click that
+lands just after the first request finished.
+
+Replayed and shared results come back as copies marked ``"coalesced":
+True`` so clients can tell a suppressed duplicate from a fresh run.
+
+Settings: SINGLEFLIGHT_WINDOW (seconds, default 2; 0 disables replay).
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from database import get_pool
+from output_cache import prompt_digest, settings_key
+
+WINDOW = float(os.environ.get('SINGLEFLIGHT_WINDOW', '2'))
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error', 'finished_at')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.finished_at = None
+
+
+class SingleFlight:
+    """Coalesce calls by key: one runs, the rest share its outcome"""
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._recent = OrderedDict()  # key -> finished _Call, oldest first
+
+        self.leaders = 0
+        self.shared = 0
+        self.replayed = 0
+
+    def _expire(self, now):
+        while self._recent:
+            key, call = next(iter(self._recent.items()))
+            if now - call.finished_at < self.window:
+                break
+            del self._recent[key]
+
+    def do(self, key, fn):
+        """``(result, coalesced)`` - run ``fn()`` or share a matching run"""
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            call = self._recent.get(key)
+            if call is not None:
+                self.replayed += 1
+                return call.result, True
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self._in_flight[key] = _Call()
+                self.leaders += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+                call.finished_at = time.monotonic()
+                # Only successes are replayed; a failure (no credits, bad
+                # code) must be retried for real once the caller fixes it
+                if call.error is None and self.window > 0 and _succeeded(call.result):
+                    self._recent[key] = call
+            call.done.set()
+        return call.result, False
+
+    def stats(self):
+        """Coalescing counters"""
+        with self._lock:
+            return {
+                "leaders": self.leaders,
+                "shared": self.shared,
+                "replayed": self.replayed,
+                "in_flight": len(self._in_flight),
+                "window": self.window,
+            }
+
+
+def _succeeded(result):
+    return not isinstance(result, dict) or bool(result.get("success"))
+
+
+_flights = None
+_flights_lock = threading.Lock()
+
+
+def get_enhancement_flights():
+    """Process-wide singleflight for enhancements, recreated after a fork"""
+    global _flights
+    flights = _flights
+    if flights is None or flights.pid != os.getpid():
+        with _flights_lock:
+            if _flights is None or _flights.pid != os.getpid():
+                _flights = SingleFlight()
+            flights = _flights
+    return flights
+
+
+def coalesce_enhancement(code_id, prompt, settings, fn, email=None):
+    """Run one enhancement per (code, prompt, settings) at a time
+
+    ``fn`` debits and renders, returning the usual result dict.  Duplicates
+    get a copy of that dict marked ``"coalesced": True``.  Flows that also
+    check an email pass it, so it is part of the key too.  Calls inside an
+    open transaction (a /api/batch operation) run on their own: their
+    writes may still be rolled back, so nobody else may share them.
+    """
+    if (code_id is None or not isinstance(prompt, str) or not isinstance(settings, dict)
+            or get_pool().in_transaction()):
+        return fn()
+    # The flow's own name keeps differently shaped results apart
+    key = (fn.__qualname__, code_id, email, prompt_digest(prompt), settings_key(settings))
+    result, coalesced = get_enhancement_flights().do(key, fn)
+    if coalesced:
+        return {**result, "coalesced": True}
+    return result
+
+
+def singleflight_stats():
+    """Counters for the process-wide enhancement singleflight"""
+    return get_enhancement_flights().stats()
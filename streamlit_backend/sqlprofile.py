@@ -0,0 +1,306 @@
+"""
+Opt-in SQL statement profiler and slow-query log
+
+With SQL_PROFILE=1 every connection database.py opens is a
+ProfiledConnection.  Its cursors time each statement from execute() until
+its last row is fetched (or the cursor moves on / is dropped), and a
+progress handler counts the SQLite VM instructions it ran, which tells a
+statement that scans from one that waited on a lock.  Per normalized
+statement (literals and IN lists folded to placeholders) the profiler
+keeps:
+
+    calls, total / mean / max / p99 time, rows returned, VM instructions
+
+p99 is the upper bound of the histogram bucket holding it.  A statement
+slower than SQL_SLOW_MS goes to the "sqlprofile.slow" logger (appended to
+SQL_SLOW_LOG if set) and to the in-memory list the admin UI shows.  Only
+normalized text is logged, never bound values.
+
+Without SQL_PROFILE connections are plain sqlite3 ones: nothing is
+wrapped and the profiler costs nothing.  Counters are per process.
+
+Settings:
+    SQL_PROFILE          1 to profile (default off)
+    SQL_SLOW_MS          slow-query threshold in milliseconds (default 100)
+    SQL_SLOW_LOG         file the slow-query log is appended to (default: none)
+    SQL_PROFILE_MAX      distinct statements tracked before the rest are
+                         folded into one "(other)" row (default 500)
+"""
+
+import os
+import re
+import time
+import logging
+import sqlite3
+import threading
+from collections import deque
+
+from metrics import Histogram
+
+ENABLED = os.environ.get('SQL_PROFILE', '0') not in ('', '0')
+SLOW_MS = float(os.environ.get('SQL_SLOW_MS', '100'))
+SLOW_LOG = os.environ.get('SQL_SLOW_LOG')
+MAX_STATEMENTS = int(os.environ.get('SQL_PROFILE_MAX', '500'))
+
+OPS_PER_TICK = 1000  # VM instructions between progress handler calls
+TIME_BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+RECENT_SLOW = 100  # slow queries kept for the admin UI
+OTHER = '(other)'
+
+slow_logger = logging.getLogger('sqlprofile.slow')
+
+# String / blob / number literals; identifiers like t1 are left alone
+_LITERALS = re.compile(r"[xX]?'(?:[^']|'')*'|(?<![\w.])\d+(?:\.\d+)?(?![\w.])")
+_IN_LIST = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)+\s*\)", re.IGNORECASE)
+_normalized = {}
+
+
+def normalize(sql):
+    """Statement text with literals as ?, whitespace collapsed and IN lists folded"""
+    text = _normalized.get(sql)
+    if text is None:
+        text = _IN_LIST.sub('IN (?, ...)', ' '.join(_LITERALS.sub('?', sql).split()))
+        if len(_normalized) >= 4096:
+            _normalized.clear()  # statements are static in this codebase; this is a backstop
+        _normalized[sql] = text
+    return text
+
+
+class _Statement:
+    __slots__ = ('calls', 'seconds', 'max_seconds', 'rows', 'ops', 'times_ms')
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.rows = 0
+        self.ops = 0
+        self.times_ms = Histogram(TIME_BUCKETS_MS)
+
+
+class SqlProfiler:
+    """Per-statement counters plus the recent slow queries"""
+
+    def __init__(self, slow_ms=SLOW_MS, max_statements=MAX_STATEMENTS):
+        self.slow_ms = slow_ms
+        self.max_statements = max_statements
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._statements = {}
+        self.slow = deque(maxlen=RECENT_SLOW)
+        self.started = time.time()
+
+    def record(self, sql, seconds, rows=0, ops=0):
+        """Account one finished statement"""
+        text = normalize(sql)
+        with self._lock:
+            statement = self._statements.get(text)
+            if statement is None:
+                if len(self._statements) >= self.max_statements:
+                    text = OTHER
+                statement = self._statements.get(text)
+                if statement is None:
+                    statement = self._statements[text] = _Statement()
+            statement.calls += 1
+            statement.seconds += seconds
+            statement.max_seconds = max(statement.max_seconds, seconds)
+            statement.rows += rows
+            statement.ops += ops
+        statement.times_ms.observe(seconds * 1000)
+
+        if seconds * 1000 >= self.slow_ms:
+            self.slow.append({"at": time.time(), "ms": seconds * 1000, "rows": rows, "statement": text})
+            slow_logger.warning("%.1f ms, %d rows, ~%d VM ops: %s", seconds * 1000, rows, ops, text)
+
+    def top(self, n=20, key='total_ms'):
+        """The ``n`` statements with the highest ``key``, as dicts"""
+        with self._lock:
+            statements = list(self._statements.items())
+        rows = []
+        for text, statement in statements:
+            rows.append({
+                "statement": text,
+                "calls": statement.calls,
+                "total_ms": statement.seconds * 1000,
+                "mean_ms": statement.seconds * 1000 / statement.calls,
+                "p99_ms": statement.times_ms.quantile(0.99),
+                "max_ms": statement.max_seconds * 1000,
+                "rows": statement.rows,
+                "vm_ops": statement.ops,
+            })
+        rows.sort(key=lambda row: row[key], reverse=True)
+        return rows[:n]
+
+    def reset(self):
+        with self._lock:
+            self._statements = {}
+            self.slow.clear()
+            self.started = time.time()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": ENABLED,
+                "statements": len(self._statements),
+                "calls": sum(statement.calls for statement in self._statements.values()),
+                "slow": len(self.slow),
+                "slow_ms": self.slow_ms,
+                "since": self.started,
+            }
+
+
+_profiler = None
+_profiler_lock = threading.Lock()
+
+
+def get_sql_profiler():
+    """Process-wide profiler, recreated after a fork"""
+    global _profiler
+    profiler = _profiler
+    if profiler is None or profiler.pid != os.getpid():
+        with _profiler_lock:
+            if _profiler is None or _profiler.pid != os.getpid():
+                if SLOW_LOG and not slow_logger.handlers:
+                    handler = logging.FileHandler(SLOW_LOG)
+                    handler.setFormatter(logging.Formatter('%(asctime)s pid=%(process)d %(message)s'))
+                    slow_logger.addHandler(handler)
+                _profiler = SqlProfiler()
+            profiler = _profiler
+    return profiler
+
+
+def sql_profile_top(n=20, key='total_ms'):
+    """Top statements of the process-wide profiler"""
+    return get_sql_profiler().top(n, key)
+
+
+def sql_profile_stats():
+    """Counters for the process-wide profiler"""
+    return get_sql_profiler().stats()
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """Cursor that reports each statement once it is done with it"""
+
+    _sql = None
+
+    def _finish(self):
+        sql = self._sql
+        if sql is not None:
+            self._sql = None
+            self.connection.profiler.record(sql, self._elapsed, self._rows, self._ops)
+
+    def _timed(self, method, *args):
+        conn = self.connection
+        ops = conn.ops
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self._elapsed += time.perf_counter() - started
+            self._ops += conn.ops - ops
+
+    def _run(self, method, sql, *args):
+        self._finish()
+        self._sql, self._elapsed, self._rows, self._ops = sql, 0.0, 0, 0
+        try:
+            self._timed(method, sql, *args)
+        finally:
+            if self.description is None:  # no rows to fetch: done already
+                self._finish()
+        return self
+
+    def execute(self, sql, *args):
+        return self._run(super().execute, sql, *args)
+
+    def executemany(self, sql, *args):
+        return self._run(super().executemany, sql, *args)
+
+    def executescript(self, script):
+        return self._run(super().executescript, script)
+
+    def fetchone(self):
+        row = self._timed(super().fetchone)
+        if row is None:
+            self._finish()
+        else:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        rows = self._timed(super().fetchmany, size)
+        self._rows += len(rows)
+        if len(rows) < size:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(super().fetchall)
+        self._rows += len(rows)
+        self._finish()
+        return rows
+
+    def __next__(self):
+        try:
+            row = self._timed(super().__next__)
+        except StopIteration:
+            self._finish()
+            raise
+        self._rows += 1
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """sqlite3 connection whose statements, commits and rollbacks are profiled"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.profiler = get_sql_profiler()
+        self.ops = 0
+        self.set_progress_handler(self._tick, OPS_PER_TICK)
+
+    def _tick(self):
+        self.ops += OPS_PER_TICK
+        return 0  # never interrupt
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, *args):
+        return self.cursor().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        return self.cursor().executemany(sql, *args)
+
+    def executescript(self, script):
+        return self.cursor().executescript(script)
+
+    def _timed(self, sql, method):
+        ops = self.ops
+        started = time.perf_counter()
+        try:
+            method()
+        finally:
+            self.profiler.record(sql, time.perf_counter() - started, 0, self.ops - ops)
+
+    def commit(self):
+        self._timed('COMMIT', super().commit)
+
+    def rollback(self):
+        self._timed('ROLLBACK', super().rollback)
+
+
+def connection_factory():
+    """``factory=`` for sqlite3.connect: profiled only when SQL_PROFILE is on"""
+    return ProfiledConnection if ENABLED else sqlite3.Connection
@@ -11,6 +11,11 @@ from datetime import datetime
 import json
 import os
 
+from database import connection, transaction, ensure_schema
+from credits import debit_credit
+from usage_log import log_usage
+from codes import parse_code
+
 # Set page config first
 st.set_page_config(
     page_title="AI Prompt Enhancer API",
@@ -33,51 +38,8 @@ header {visibility: hidden;}
 # Handle API requests FIRST - before any UI elements
 query_params = st.query_params
 
-# Database helper function for API
-def get_db_connection():
-    db_path = os.path.join(os.path.dirname(__file__), 'users.db')
-    return sqlite3.connect(db_path)
-
-# Initialize database for API
-def init_db():
-    conn = get_db_connection()
-    c = conn.cursor()
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS waiting_list
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  name TEXT NOT NULL,
-                  email TEXT UNIQUE NOT NULL,
-                  reason TEXT,
-                  status TEXT DEFAULT 'pending',
-                  applied_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  approved_date TIMESTAMP,
-                  admin_notes TEXT)''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  name TEXT NOT NULL,
-                  email TEXT UNIQUE NOT NULL,
-                  redemption_code TEXT UNIQUE NOT NULL,
-                  credits INTEGER DEFAULT 100,
-                  used_credits INTEGER DEFAULT 0,
-                  status TEXT DEFAULT 'active',
-                  created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  last_used TIMESTAMP)''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS usage_logs
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_email TEXT,
-                  redemption_code TEXT,
-                  prompt_length INTEGER,
-                  response_length INTEGER,
-                  timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  ip_address TEXT)''')
-    
-    conn.commit()
-    conn.close()
-
-# Initialize database
-init_db()
+# Migrate the schema once per process (no DDL on later reruns)
+ensure_schema()
 
 # Check if this is an API request (has 'endpoint' parameter)
 if 'endpoint' in query_params:
@@ -100,18 +62,16 @@ if 'endpoint' in query_params:
             st.json({"success": False, "message": "Name and email are required"})
         else:
             try:
-                conn = get_db_connection()
-                c = conn.cursor()
+                with transaction() as conn:
+                    c = conn.cursor()
                 
-                c.execute("SELECT email FROM waiting_list WHERE email = ?", (email,))
-                if c.fetchone():
-                    st.json({"success": False, "message": "Email already registered"})
-                else:
-                    c.execute("INSERT INTO waiting_list (name, email, reason) VALUES (?, ?, ?)", 
-                             (name, email, reason))
-                    conn.commit()
-                    st.json({"success": True, "message": "Successfully added to waiting list"})
-                conn.close()
+                    c.execute("SELECT email FROM waiting_list WHERE email = ?", (email,))
+                    if c.fetchone():
+                        st.json({"success": False, "message": "Email already registered"})
+                    else:
+                        c.execute("INSERT INTO waiting_list (name, email, reason) VALUES (?, ?, ?)", 
+                                 (name, email, reason))
+                        st.json({"success": True, "message": "Successfully added to waiting list"})
             except Exception as e:
                 st.json({"success": False, "message": f"Database error: {str(e)}"})
         st.stop()
@@ -119,17 +79,19 @@ if 'endpoint' in query_params:
     elif endpoint == 'verify':
         email = query_params.get('email', '')
         code = query_params.get('code', '')
+        code_id = parse_code(code)
         
         if not email or not code:
             st.json({"success": False, "message": "Email and code are required"})
+        elif code_id is None:
+            st.json({"success": False, "message": "Invalid email or redemption code"})
         else:
             try:
-                conn = get_db_connection()
-                c = conn.cursor()
-                c.execute("SELECT redemption_code, credits, used_credits FROM users WHERE email = ? AND redemption_code = ?", 
-                         (email, code))
-                user = c.fetchone()
-                conn.close()
+                with connection() as conn:
+                    c = conn.cursor()
+                    c.execute("SELECT redemption_code, credits, used_credits FROM users WHERE email = ? AND code_id = ?", 
+                             (email, code_id))
+                    user = c.fetchone()
                 
                 if user:
                     st.json({
@@ -146,16 +108,18 @@ if 'endpoint' in query_params:
     
     elif endpoint == 'check_credits':
         redemption_code = query_params.get('redemption_code', '')
+        code_id = parse_code(redemption_code)
         
         if not redemption_code:
             st.json({"success": False, "message": "Redemption code is required"})
+        elif code_id is None:
+            st.json({"success": False, "message": "Invalid redemption code"})
         else:
             try:
-                conn = get_db_connection()
-                c = conn.cursor()
-                c.execute("SELECT credits, used_credits FROM users WHERE redemption_code = ?", (redemption_code,))
-                user = c.fetchone()
-                conn.close()
+                with connection() as conn:
+                    c = conn.cursor()
+                    c.execute("SELECT credits, used_credits FROM users WHERE code_id = ?", (code_id,))
+                    user = c.fetchone()
                 
                 if user:
                     st.json({
@@ -178,27 +142,6 @@ if 'endpoint' in query_params:
             st.json({"success": False, "message": "Prompt and redemption code are required"})
         else:
             try:
-                conn = get_db_connection()
-                c = conn.cursor()
-                
-                # Check user and credits
-                c.execute("SELECT id, credits, used_credits FROM users WHERE redemption_code = ? AND status = 'active'", 
-                         (redemption_code,))
-                user = c.fetchone()
-                
-                if not user:
-                    st.json({"success": False, "message": "Invalid or inactive redemption code"})
-                    conn.close()
-                    st.stop()
-                
-                user_id, credits, used_credits = user
-                remaining = credits - used_credits
-                
-                if remaining <= 0:
-                    st.json({"success": False, "message": "No credits remaining"})
-                    conn.close()
-                    st.stop()
-                
                 # Simple prompt enhancement
                 enhanced_prompt = f"""ROLE: You are an expert assistant specialized in the topic at hand.
 
@@ -216,19 +159,25 @@ FORMAT: Use proper formatting with headings and bullet points for readability.
 
 QUALITY STANDARDS: Ensure accuracy, completeness, and practical value in your response."""
 
-                # Update usage
-                c.execute("UPDATE users SET used_credits = used_credits + 1, last_used = CURRENT_TIMESTAMP WHERE id = ?", 
-                         (user_id,))
-                c.execute("INSERT INTO usage_logs (user_email, redemption_code, prompt_length, response_length) VALUES (?, ?, ?, ?)",
-                         (query_params.get('email', ''), redemption_code, len(prompt), len(enhanced_prompt)))
-                conn.commit()
-                conn.close()
+                with transaction() as conn:
+                    # Check and use one credit in a single statement
+                    debit = debit_credit(conn, redemption_code)
+                
+                if not debit["success"]:
+                    if debit["reason"] == 'no_credits':
+                        st.json({"success": False, "message": "No credits remaining"})
+                    else:
+                        st.json({"success": False, "message": "Invalid or inactive redemption code"})
+                    st.stop()
+                
+                # Log usage (queued, written in batches off the request path)
+                log_usage(query_params.get('email', ''), redemption_code, len(prompt), len(enhanced_prompt))
                 
                 st.json({
                     "success": True,
                     "enhanced_prompt": enhanced_prompt,
                     "credits_used": 1,
-                    "remaining_credits": remaining - 1
+                    "remaining_credits": debit["remaining_credits"]
                 })
             except Exception as e:
                 st.json({"success": False, "message": f"Error: {str(e)}"})
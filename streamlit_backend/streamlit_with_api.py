@@ -16,57 +16,28 @@ from flask import Flask, request, jsonify
 from flask_cors import CORS
 import requests
 import json
+import os
+
+from database import connection, transaction, ensure_schema, snapshot
+from migrations import rebuild_schema
+from credits import debit_credit
+from usage_log import log_usage
+from rollups import get_counters
+from codes import issue_code, parse_code
+from lookup_cache import lookup_user
+from ratelimit import install_rate_limits
+from admission import install_admission_control
+from idempotency import idempotent, valid_key
+from metrics import install_metrics
+from sqlprofile import get_sql_profiler, sql_profile_stats, sql_profile_top
 
 # Flask app for API endpoints (runs in background)
 flask_app = Flask(__name__)
 flask_app.secret_key = "your-secret-key-change-this"
 CORS(flask_app, origins=['*'])
-
-# Database initialization
-def init_db():
-    # Use absolute path for database like in other files
-    db_path = os.path.join(os.path.dirname(__file__), 'users.db')
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    
-    # Waiting list table
-    c.execute('''CREATE TABLE IF NOT EXISTS waiting_list
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  name TEXT NOT NULL,
-                  email TEXT UNIQUE NOT NULL,
-                  reason TEXT,
-                  status TEXT DEFAULT 'pending',
-                  applied_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  approved_date TIMESTAMP,
-                  admin_notes TEXT)''')
-    
-    # Active users table
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  name TEXT NOT NULL,
-                  email TEXT UNIQUE NOT NULL,
-                  redemption_code TEXT UNIQUE NOT NULL,
-                  credits INTEGER DEFAULT 100,
-                  used_credits INTEGER DEFAULT 0,
-                  status TEXT DEFAULT 'active',
-                  created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  last_used TIMESTAMP)''')
-    
-    # Usage logs
-    c.execute('''CREATE TABLE IF NOT EXISTS usage_logs
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  email TEXT NOT NULL,
-                  action TEXT NOT NULL,
-                  credits_used INTEGER DEFAULT 1,
-                  prompt_length INTEGER,
-                  timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
-    conn.commit()
-    conn.close()
-
-# Generate redemption code
-def generate_code():
-    return ''.join(secrets.choice(string.ascii_uppercase + string.digits) for _ in range(8))
+install_metrics(flask_app)  # also serves GET /metrics
+install_rate_limits(flask_app)
+install_admission_control(flask_app, {'/api/register', '/api/verify', '/api/use_credit', '/api/enhance-prompt'})
 
 # ==================== FLASK API ENDPOINTS ====================
 
@@ -81,19 +52,17 @@ def register():
         if not name or not email:
             return jsonify({'success': False, 'message': 'Name and email are required'}), 400
         
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
+        with transaction() as conn:
+            c = conn.cursor()
         
-        # Check if already registered
-        c.execute("SELECT * FROM waiting_list WHERE email = ?", (email,))
-        if c.fetchone():
-            return jsonify({'success': False, 'message': 'Email already registered'}), 400
+            # Check if already registered
+            c.execute("SELECT * FROM waiting_list WHERE email = ?", (email,))
+            if c.fetchone():
+                return jsonify({'success': False, 'message': 'Email already registered'}), 400
         
-        # Insert into waiting list
-        c.execute("""INSERT INTO waiting_list (name, email, reason) 
+            # Insert into waiting list
+            c.execute("""INSERT INTO waiting_list (name, email, reason) 
                      VALUES (?, ?, ?)""", (name, email, reason))
-        conn.commit()
-        conn.close()
         
         return jsonify({
             'success': True, 
@@ -113,20 +82,16 @@ def verify_code():
         if not email or not code:
             return jsonify({'success': False, 'message': 'Email and code are required'}), 400
         
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
+        code_id = parse_code(code)
+        if code_id is None:
+            return jsonify({'success': False, 'message': 'Invalid email or redemption code'}), 400
         
         # Check if user exists and code matches
-        c.execute("SELECT * FROM users WHERE email = ? AND redemption_code = ?", (email, code))
-        user = c.fetchone()
-        
-        if not user:
+        user = lookup_user(code_id)
+        if not user or user[1] != email:
             return jsonify({'success': False, 'message': 'Invalid email or redemption code'}), 400
         
-        credits = user[4]  # credits column
-        used_credits = user[5]  # used_credits column
-        
-        conn.close()
+        credits, used_credits = user[2], user[3]
         
         return jsonify({
             'success': True,
@@ -145,22 +110,20 @@ def check_credits():
         email = data.get('email', '').strip().lower()
         code = data.get('code', '').strip().upper()
         
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        
-        c.execute("SELECT credits, used_credits FROM users WHERE email = ? AND redemption_code = ?", 
-                  (email, code))
-        result = c.fetchone()
-        conn.close()
+        code_id = parse_code(code)
+        if code_id is None:
+            return jsonify({'success': False, 'message': 'Invalid credentials'}), 400
         
-        if not result:
+        user = lookup_user(code_id)
+        if not user or user[1] != email:
             return jsonify({'success': False, 'message': 'Invalid credentials'}), 400
         
-        credits, used_credits = result
+        credits, used_credits = user[2], user[3]
         return jsonify({
             'success': True,
             'credits': credits,
-            'used_credits': used_credits
+            'used_credits': used_credits,
+            'remaining_credits': credits - used_credits
         })
         
     except Exception as e:
@@ -174,46 +137,39 @@ def use_credit():
         code = data.get('code', '').strip().upper()
         prompt_length = data.get('prompt_length', 0)
         
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        
-        # Check current credits
-        c.execute("SELECT credits FROM users WHERE email = ? AND redemption_code = ?", 
-                  (email, code))
-        result = c.fetchone()
-        
-        if not result:
-            return jsonify({'success': False, 'message': 'Invalid credentials'}), 400
-        
-        credits = result[0]
-        if credits <= 0:
-            return jsonify({'success': False, 'message': 'No credits remaining'}), 400
-        
-        # Use credit
-        c.execute("""UPDATE users 
-                     SET credits = credits - 1, 
-                         used_credits = used_credits + 1,
-                         last_used = CURRENT_TIMESTAMP
-                     WHERE email = ? AND redemption_code = ?""", (email, code))
-        
-        # Log usage
-        c.execute("""INSERT INTO usage_logs (email, action, credits_used, prompt_length) 
-                     VALUES (?, ?, ?, ?)""", (email, 'enhance_prompt', 1, prompt_length))
-        
-        conn.commit()
-        
-        # Get updated credits
-        c.execute("SELECT credits, used_credits FROM users WHERE email = ? AND redemption_code = ?", 
-                  (email, code))
-        updated = c.fetchone()
-        conn.close()
-        
-        return jsonify({
-            'success': True,
-            'message': 'Credit used successfully',
-            'credits': updated[0],
-            'used_credits': updated[1]
-        })
+        key = request.headers.get('Idempotency-Key')
+        if key is not None and not valid_key(key):
+            return jsonify({'success': False, 'message': 'Idempotency-Key must be 1-255 printable characters'}), 400
+        
+        def debit_once():
+            with transaction() as conn:
+                # Check and use one credit in a single statement. Only used_credits
+                # moves; the remaining balance is credits - used_credits.
+                debit = debit_credit(conn, code, email=email)
+                if not debit['success']:
+                    if debit['reason'] == 'no_credits':
+                        return {'success': False, 'message': 'No credits remaining'}
+                    if debit['reason'] == 'inactive':
+                        return {'success': False, 'message': 'Account not active'}
+                    return {'success': False, 'message': 'Invalid credentials'}
+            
+            # Log usage (queued, written in batches off the request path)
+            log_usage(email, code, prompt_length, action='enhance_prompt', credits_used=1,
+                      ip_address=request.remote_addr)
+            
+            return {
+                'success': True,
+                'message': 'Credit used successfully',
+                'credits': debit['credits'],
+                'used_credits': debit['used_credits'],
+                'remaining_credits': debit['remaining_credits']
+            }
+        
+        # A retry with the same Idempotency-Key gets the first debit's response
+        result = idempotent(parse_code(code), key, 'use_credit', {'email': email}, debit_once)
+        if result.get('conflict'):
+            return jsonify(result), 422
+        return jsonify(result), 200 if result['success'] else 400
         
     except Exception as e:
         return jsonify({'success': False, 'message': f'Error: {str(e)}'}), 500
@@ -264,20 +220,31 @@ def health_check():
 
 # ==================== STREAMLIT ADMIN INTERFACE ====================
 
-def run_flask():
-    """Run Flask server in a separate thread"""
-    flask_app.run(host='0.0.0.0', port=8000, debug=False, use_reloader=False)
+# Embedded API server (one per process, shared by every Streamlit session).
+# For real traffic run api_service.py instead; set EMBEDDED_API=0 to skip this.
+_flask_server = None
+_flask_lock = threading.Lock()
+
+def start_flask():
+    """Bind the embedded Flask server, then serve it from a daemon thread
+
+    make_server() returns only once the port is bound, so the API is ready
+    when this returns - no sleep needed.
+    """
+    global _flask_server
+    with _flask_lock:
+        if _flask_server is None:
+            from werkzeug.serving import make_server
+            _flask_server = make_server('0.0.0.0', 8000, flask_app, threaded=True)
+            threading.Thread(target=_flask_server.serve_forever, daemon=True).start()
 
 def main():
-    # Initialize database
-    init_db()
+    # Migrate the schema once per process
+    ensure_schema()
     
-    # Start Flask server in background thread
-    if 'flask_started' not in st.session_state:
-        flask_thread = threading.Thread(target=run_flask, daemon=True)
-        flask_thread.start()
-        st.session_state.flask_started = True
-        time.sleep(2)  # Give Flask time to start
+    # Start the embedded Flask server (once per process)
+    if os.environ.get('EMBEDDED_API', '1') != '0':
+        start_flask()
     
     # Streamlit Admin Interface
     st.set_page_config(
@@ -317,18 +284,21 @@ def main():
                 st.error("Invalid password")
         return
     
+    # Read everything in one consistent snapshot, then render
+    with snapshot() as conn:
+        waiting_list = conn.execute("SELECT * FROM waiting_list ORDER BY applied_date DESC").fetchall()
+        users = conn.execute("SELECT * FROM users ORDER BY created_date DESC").fetchall()
+        # Trigger-maintained counters, see rollups.py
+        counters = get_counters(conn)
+        logs = conn.execute("""SELECT user_email, action, credits_used, timestamp 
+                               FROM usage_logs ORDER BY timestamp DESC LIMIT 10""").fetchall()
+    
     # Admin tabs
     tab1, tab2, tab3, tab4 = st.tabs(["📋 Waiting List", "👥 Users", "📊 Usage Stats", "⚙️ Admin Tools"])
     
     with tab1:
         st.header("Waiting List Management")
         
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        c.execute("SELECT * FROM waiting_list ORDER BY applied_date DESC")
-        waiting_list = c.fetchall()
-        conn.close()
-        
         if waiting_list:
             for user in waiting_list:
                 with st.expander(f"{user[1]} ({user[2]}) - {user[4]}"):
@@ -340,22 +310,20 @@ def main():
                     
                     if user[4] == 'pending':
                         if st.button(f"Approve {user[1]}", key=f"approve_{user[0]}"):
-                            # Generate redemption code and move to users table
-                            code = generate_code()
-                            conn = sqlite3.connect('users.db')
-                            c = conn.cursor()
+                            # Reserve a redemption code and move to users table
+                            with transaction() as conn:
+                                code = issue_code(conn)
+                                c = conn.cursor()
                             
-                            # Add to users table
-                            c.execute("""INSERT INTO users (name, email, redemption_code) 
-                                         VALUES (?, ?, ?)""", (user[1], user[2], code))
+                                # Add to users table
+                                c.execute("""INSERT INTO users (name, email, redemption_code, code_id) 
+                                         VALUES (?, ?, ?, ?)""", (user[1], user[2], code, parse_code(code)))
                             
-                            # Update waiting list status
-                            c.execute("""UPDATE waiting_list 
+                                # Update waiting list status
+                                c.execute("""UPDATE waiting_list 
                                          SET status = 'approved', approved_date = CURRENT_TIMESTAMP
                                          WHERE id = ?""", (user[0],))
                             
-                            conn.commit()
-                            conn.close()
                             st.success(f"Approved! Redemption code: {code}")
                             st.rerun()
         else:
@@ -364,12 +332,6 @@ def main():
     with tab2:
         st.header("Active Users")
         
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        c.execute("SELECT * FROM users ORDER BY created_date DESC")
-        users = c.fetchall()
-        conn.close()
-        
         if users:
             for user in users:
                 with st.expander(f"{user[1]} ({user[2]}) - {user[4]} credits"):
@@ -390,18 +352,10 @@ def main():
     with tab3:
         st.header("Usage Statistics")
         
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        
         # Total stats
-        c.execute("SELECT COUNT(*) FROM users")
-        total_users = c.fetchone()[0]
-        
-        c.execute("SELECT SUM(used_credits) FROM users")
-        total_usage = c.fetchone()[0] or 0
-        
-        c.execute("SELECT SUM(credits) FROM users")
-        remaining_credits = c.fetchone()[0] or 0
+        total_users = counters['users.total']
+        total_usage = counters['users.used_credits']
+        remaining_credits = counters['users.credits'] - total_usage
         
         col1, col2, col3 = st.columns(3)
         with col1:
@@ -411,18 +365,37 @@ def main():
         with col3:
             st.metric("💳 Credits Remaining", remaining_credits)
         
+        # SQL statement profile (SQL_PROFILE=1)
+        with st.expander("🐢 SQL Statement Profile"):
+            profile = sql_profile_stats()
+            if not profile['enabled']:
+                st.info("Start the app with SQL_PROFILE=1 to time every SQL statement")
+            else:
+                col1, col2, col3 = st.columns(3)
+                col1.metric("Statements", profile['statements'])
+                col2.metric("Calls", profile['calls'])
+                col3.metric(f"Slow (≥ {profile['slow_ms']:g} ms)", profile['slow'])
+                top_n = st.slider("Top statements", 5, 50, 15)
+                order = st.selectbox("Order by", ["total_ms", "p99_ms", "calls", "rows", "vm_ops"])
+                st.dataframe(sql_profile_top(top_n, order), use_container_width=True)
+                slow = list(get_sql_profiler().slow)
+                if slow:
+                    st.caption("Recent slow statements")
+                    st.dataframe([{"when": datetime.fromtimestamp(q['at']).strftime('%H:%M:%S'),
+                                   "ms": round(q['ms'], 1), "rows": q['rows'], "statement": q['statement']}
+                                  for q in reversed(slow)], use_container_width=True)
+                if st.button("Reset SQL profile"):
+                    get_sql_profiler().reset()
+                    st.rerun()
+        
         # Recent activity
         st.subheader("Recent Activity")
-        c.execute("SELECT * FROM usage_logs ORDER BY timestamp DESC LIMIT 10")
-        logs = c.fetchall()
         
         if logs:
             for log in logs:
-                st.write(f"**{log[1]}** - {log[2]} ({log[3]} credits) - {log[5]}")
+                st.write(f"**{log[0]}** - {log[1]} ({log[2]} credits) - {log[3]}")
         else:
             st.info("No usage logs yet")
-        
-        conn.close()
     
     with tab4:
         st.header("Admin Tools")
@@ -436,30 +409,21 @@ def main():
             
             if st.form_submit_button("Add User"):
                 if name and email:
-                    code = generate_code()
-                    conn = sqlite3.connect('users.db')
-                    c = conn.cursor()
                     try:
-                        c.execute("""INSERT INTO users (name, email, redemption_code, credits) 
-                                     VALUES (?, ?, ?, ?)""", (name, email.lower(), code, credits))
-                        conn.commit()
+                        with transaction() as conn:
+                            code = issue_code(conn)
+                            conn.execute("""INSERT INTO users (name, email, redemption_code, code_id, credits) 
+                                         VALUES (?, ?, ?, ?, ?)""", (name, email.lower(), code, parse_code(code), credits))
                         st.success(f"User added! Redemption code: {code}")
                     except sqlite3.IntegrityError:
                         st.error("Email already exists")
-                    conn.close()
         
         # Database reset
         st.subheader("⚠️ Danger Zone")
         if st.button("Reset Database", type="secondary"):
             if st.checkbox("I understand this will delete all data"):
-                conn = sqlite3.connect('users.db')
-                c = conn.cursor()
-                c.execute("DROP TABLE IF EXISTS waiting_list")
-                c.execute("DROP TABLE IF EXISTS users")
-                c.execute("DROP TABLE IF EXISTS usage_logs")
-                conn.commit()
-                conn.close()
-                init_db()
+                with connection() as conn:
+                    rebuild_schema(conn)
                 st.success("Database reset complete")
                 st.rerun()
 
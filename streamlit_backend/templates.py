@@ -0,0 +1,146 @@
+"""
+Precompiled prompt enhancement templates
+
+The settings space is small and fixed (description x length x format x
+tone), so every section after GOAL is rendered once per combination at
+import time.  A call only slots in the role and the prompt:
+
+    [ROLE section] + GOAL prefix + prompt + precompiled tail
+
+Two template families are served:
+
+* render_methodology - markdown **SECTION** layout (app.py API and
+  api_endpoints.py).  Unknown length/format/tone raise KeyError and an
+  unknown description drops the CONTEXT section, as before.
+* render_plain_methodology - plain SECTION: layout with a bullet list of
+  requirements (api_server.py).  Unknown values fall back to defaults.
+"""
+
+import itertools
+
+# ---- markdown methodology ----
+
+LENGTH_INSTRUCTIONS = {
+    'short': 'Keep the response concise and to the point',
+    'medium': 'Provide a comprehensive but focused response',
+    'long': 'Give a detailed, thorough explanation with examples'
+}
+
+FORMAT_INSTRUCTIONS = {
+    'structured': 'Use clear headings, bullet points, and logical organization',
+    'paragraph': 'Write in flowing paragraphs with smooth transitions',
+    'stepbystep': 'Break down into numbered steps or sequential instructions',
+    'creative': 'Use engaging, creative formatting with varied presentation styles'
+}
+
+TONE_INSTRUCTIONS = {
+    'helpful': 'Be supportive, encouraging, and solution-focused',
+    'professional': 'Maintain formal, business-appropriate language',
+    'casual': 'Use conversational, friendly, and approachable language',
+    'technical': 'Focus on precision, accuracy, and technical detail'
+}
+
+DESCRIPTION_CONTEXT = {
+    'detailed': 'Provide comprehensive information with relevant details',
+    'summary': 'Focus on key points and essential information',
+    'creative': 'Approach this with creativity and innovative thinking'
+}
+
+
+def _methodology_tail(description, length, format_style, tone):
+    sections = []
+    if description is not None:
+        sections.append(f"**CONTEXT**: {DESCRIPTION_CONTEXT[description]}")
+    sections.append(f"**REQUIREMENTS**: {LENGTH_INSTRUCTIONS[length]} | {TONE_INSTRUCTIONS[tone]}")
+    sections.append(f"**FORMAT**: {FORMAT_INSTRUCTIONS[format_style]}")
+    sections.append("**WARNINGS**: Ensure accuracy, avoid assumptions, and provide actionable insights")
+    return "\n\n" + "\n\n".join(sections)
+
+
+# (description or None, length, format, tone) -> everything after the prompt
+_METHODOLOGY = {
+    key: _methodology_tail(*key)
+    for key in itertools.product((*DESCRIPTION_CONTEXT, None), LENGTH_INSTRUCTIONS,
+                                 FORMAT_INSTRUCTIONS, TONE_INSTRUCTIONS)
+}
+
+
+def render_methodology(original_prompt, settings):
+    """Markdown ROLE / GOAL / CONTEXT / REQUIREMENTS / FORMAT / WARNINGS prompt"""
+    role = settings.get('role', '')
+    description = settings.get('description', 'detailed')
+    key = (description if description in DESCRIPTION_CONTEXT else None,
+           settings.get('length', 'medium'),
+           settings.get('format', 'structured'),
+           settings.get('tone', 'helpful'))
+    tail = _METHODOLOGY.get(key)
+    if tail is None:
+        # Unknown length/format/tone: the KeyError the per-call lookups raised
+        raise KeyError(next(value for value, table in zip(
+            key[1:], (LENGTH_INSTRUCTIONS, FORMAT_INSTRUCTIONS, TONE_INSTRUCTIONS)) if value not in table))
+    if role:
+        return f"**ROLE**: You are {role}\n\n**GOAL**: {original_prompt}{tail}"
+    return f"**GOAL**: {original_prompt}{tail}"
+
+
+# ---- plain methodology ----
+
+PLAIN_CONTEXT = {
+    'brief': "Provide a concise response.",
+    'detailed': "Provide a comprehensive and thorough response with examples where appropriate.",
+    'technical': "Focus on technical accuracy and implementation details.",
+    'beginner': "Explain concepts clearly for someone new to this topic."
+}
+
+PLAIN_LENGTH = {
+    'short': "Keep response under 200 words",
+    'medium': "Aim for 200-500 words",
+    'long': "Provide a detailed response of 500+ words"
+}
+
+PLAIN_FORMAT = {
+    'bullet': "Format as bullet points",
+    'numbered': "Use numbered steps",
+    'structured': "Use clear headings and sections",
+    'paragraph': "Write in paragraph form"
+}
+
+PLAIN_TONE = {
+    'helpful': "Use a helpful and supportive tone",
+    'professional': "Maintain a professional tone",
+    'casual': "Use a conversational, casual tone",
+    'technical': "Use precise, technical language"
+}
+
+
+def _plain_tail(description, length, format_type, tone):
+    requirements = (PLAIN_LENGTH[length], PLAIN_FORMAT[format_type], PLAIN_TONE[tone])
+    return "\n\n".join([
+        "",
+        f"CONTEXT: {PLAIN_CONTEXT[description]}",
+        "REQUIREMENTS:\n" + "\n".join(f"- {req}" for req in requirements),
+        "FORMAT: Structure your response clearly with appropriate headings or organization.",
+        "WARNINGS: Ensure accuracy and provide sources when making factual claims.",
+    ])
+
+
+_PLAIN = {
+    key: _plain_tail(*key)
+    for key in itertools.product(PLAIN_CONTEXT, PLAIN_LENGTH, PLAIN_FORMAT, PLAIN_TONE)
+}
+
+
+def render_plain_methodology(original_prompt, settings):
+    """Plain ROLE: / GOAL: / CONTEXT: / REQUIREMENTS: ... prompt"""
+    role = settings.get('role', '').strip()
+    description = settings.get('description', 'detailed')
+    length = settings.get('length', 'medium')
+    format_type = settings.get('format', 'structured')
+    tone = settings.get('tone', 'helpful')
+    tail = _PLAIN[(description if description in PLAIN_CONTEXT else 'detailed',
+                   length if length in PLAIN_LENGTH else 'medium',
+                   format_type if format_type in PLAIN_FORMAT else 'structured',
+                   tone if tone in PLAIN_TONE else 'helpful')]
+    if role:
+        return f"ROLE: You are {role}.\n\nGOAL: {original_prompt}{tail}"
+    return f"GOAL: {original_prompt}{tail}"
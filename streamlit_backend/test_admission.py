@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Admission control: bounded writers, bounded waits, shed past the deadline
+
+Run: python -m pytest -q streamlit_backend/test_admission.py
+"""
+
+import math
+import threading
+import time
+
+from admission import AdmissionController, Histogram
+
+
+def test_free_slots_admit_immediately():
+    controller = AdmissionController(slots=2, max_queue=4, max_wait=1)
+    assert controller.acquire() and controller.acquire()
+    assert controller.stats()["active"] == 2
+    controller.release()
+    controller.release()
+    assert controller.stats()["wait_ms"]["count"] == 2
+
+
+def test_waiters_get_a_released_slot():
+    controller = AdmissionController(slots=1, max_queue=4, max_wait=5)
+    controller.acquire()
+    admitted = []
+    waiter = threading.Thread(target=lambda: admitted.append(controller.acquire()))
+    waiter.start()
+    while controller.stats()["queued"] == 0:
+        time.sleep(0.001)
+    time.sleep(0.02)
+    controller.release()
+    waiter.join()
+
+    assert admitted == [True]
+    assert controller.wait_ms.quantile(1.0) >= 25  # the waiter's ~20 ms lands in the 25 ms bucket
+
+
+def test_shed_past_the_deadline():
+    controller = AdmissionController(slots=1, max_queue=4, max_wait=0.03)
+    controller.acquire()
+    started = time.monotonic()
+    assert not controller.acquire()
+    assert 0.03 <= time.monotonic() - started < 0.5
+    assert controller.stats()["shed_timeout"] == 1
+    assert controller.stats()["queued"] == 0
+
+
+def test_shed_at_once_when_the_queue_is_full():
+    controller = AdmissionController(slots=1, max_queue=0, max_wait=10)
+    controller.acquire()
+    started = time.monotonic()
+    assert not controller.acquire()
+    assert time.monotonic() - started < 0.1
+    assert controller.stats()["shed_queue_full"] == 1
+
+
+def test_histogram_is_cumulative():
+    histogram = Histogram((1, 10, 100))
+    for value in (0.5, 5, 5, 50, 500):
+        histogram.observe(value)
+    snapshot = histogram.snapshot()
+    assert snapshot["buckets"] == [(1, 1), (10, 3), (100, 4), (math.inf, 5)]
+    assert snapshot["count"] == 5 and snapshot["sum"] == 560.5
+    assert histogram.quantile(0.5) == 10
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Standalone API: the routes background.js calls, with the shapes it reads
+
+Run: python -m pytest -q streamlit_backend/test_api_service.py
+"""
+
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import database
+import lookup_cache
+import usage_log
+import singleflight
+import ratelimit
+import admission
+import sessions
+import balances
+import api_endpoints
+import metrics
+from usage_log import UsageLogWriter
+from api_service import create_app
+from conftest import add_user
+
+
+@pytest.fixture
+def client(pool, monkeypatch):
+    add_user(pool, credits=2)
+    writer = UsageLogWriter(pool=pool)
+    monkeypatch.setattr(database, '_pool', pool)
+    monkeypatch.setattr(lookup_cache, '_cache', None)
+    monkeypatch.setattr(usage_log, '_writer', writer)
+    monkeypatch.setattr(singleflight, '_flights', None)
+    monkeypatch.setattr(ratelimit, '_limiter', None)
+    monkeypatch.setattr(admission, '_controller', None)
+    monkeypatch.setattr(sessions, '_epochs', None)
+    monkeypatch.setattr(balances, '_hub', None)
+    yield create_app().test_client()
+    writer.close()
+
+
+def test_check_credits(client):
+    result = client.get('/api/check_credits?redemption_code=CODE0001').get_json()
+    assert result["success"] and result["remaining_credits"] == 2
+
+    assert not client.get('/api/check_credits?redemption_code=NOPE0000').get_json()["success"]
+    assert client.get('/api/check_credits').status_code == 400
+
+
+def test_use_credit_until_empty(client):
+    remaining = [client.post('/api/use_credit', json={"redemption_code": "CODE0001"}).get_json()
+                 for _ in range(3)]
+    assert [r.get("remaining_credits") for r in remaining] == [1, 0, None]
+    assert remaining[2]["message"] == "No credits remaining"
+
+    # The cached balance follows the debits
+    result = client.get('/api/check_credits?redemption_code=CODE0001').get_json()
+    assert result["remaining_credits"] == 0
+
+    assert client.post('/api/use_credit', data="not json").status_code == 400
+
+
+def test_admission_covers_only_served_write_routes(client):
+    posts = {rule.rule for rule in client.application.url_map.iter_rules() if 'POST' in rule.methods}
+    assert admission.WRITE_PATHS == posts  # every POST here writes
+
+
+def test_health_and_readiness(client):
+    assert client.get('/api/health').status_code == 200
+    assert client.get('/api/ready').get_json()["ready"]
+
+
+def test_batch_runs_in_order_in_one_round_trip(client):
+    result = client.post('/api/batch', json={"operations": [
+        {"op": "verify", "email": "a@example.com", "code": "CODE0001"},
+        {"op": "use_credit", "redemption_code": "CODE0001"},
+        {"op": "check_credits", "redemption_code": "CODE0001"},
+        {"op": "enhance_prompt", "redemption_code": "CODE0001", "prompt": "Hi", "settings": {}},
+        {"op": "enhance_prompt", "redemption_code": "CODE0001", "prompt": "Hi", "settings": {}},
+        {"op": "drop_tables"},
+    ]}).get_json()
+
+    verify, debit, check, enhance, empty, unknown = result["results"]
+    assert verify["success"] and verify["user"]["credits"] == 2
+    assert debit["remaining_credits"] == 1
+    assert check["remaining_credits"] == 1  # sees the debit from the same batch
+    assert enhance["remaining_credits"] == 0 and "**GOAL**: Hi" in enhance["enhanced_prompt"]
+    assert empty["message"] == "No credits remaining"
+    assert unknown["message"] == "Unknown operation"
+
+    after = client.get('/api/check_credits?redemption_code=CODE0001').get_json()
+    assert after["remaining_credits"] == 0
+
+
+def test_failed_batch_operation_leaves_no_writes(client):
+    # The credit is debited, then rendering fails on an unknown length
+    result = client.post('/api/batch', json={"operations": [
+        {"op": "enhance_prompt", "redemption_code": "CODE0001", "prompt": "Hi", "settings": {"length": "huge"}},
+    ]}).get_json()
+    assert not result["results"][0]["success"]
+
+    after = client.get('/api/check_credits?redemption_code=CODE0001').get_json()
+    assert after["remaining_credits"] == 2
+
+
+def test_batch_logs_and_notifies_only_after_it_commits(client, monkeypatch):
+    calls = []
+    in_transaction = database.get_pool().in_transaction
+    monkeypatch.setattr(api_endpoints, 'log_usage', lambda *a, **kw: calls.append(('log', in_transaction())))
+    monkeypatch.setattr(api_endpoints, 'balance_changed', lambda: calls.append(('poke', in_transaction())))
+
+    result = client.post('/api/batch', json={"operations": [
+        {"op": "use_credit", "redemption_code": "CODE0001"},
+        {"op": "enhance_prompt", "redemption_code": "CODE0001", "prompt": "Hi", "settings": {"length": "huge"}},
+    ]}).get_json()
+    assert [r["success"] for r in result["results"]] == [True, False]
+
+    # One row and one poke for the debit that stuck, none for the one rolled back
+    assert sorted(calls) == [('log', False), ('poke', False)]
+
+
+def test_batch_rejects_bad_shapes(client, monkeypatch):
+    # An oversized batch spends a whole IP burst; keep the limiter out of this one
+    monkeypatch.setattr(ratelimit, 'ENABLED', False)
+    assert client.post('/api/batch', json={"operations": [{"op": "verify"}] * 100}).status_code == 400
+    assert client.post('/api/batch', json={"operations": []}).status_code == 400
+
+
+def test_duplicate_enhancements_are_charged_once(client):
+    request = {"redemption_code": "CODE0001", "prompt": "Hi", "settings": {"tone": "casual"}}
+    first = client.post('/api/enhance', json=request).get_json()
+    double_click = client.post('/api/enhance', json=request).get_json()
+
+    assert first["remaining_credits"] == 1 and "coalesced" not in first
+    assert double_click["coalesced"] and double_click["enhanced_prompt"] == first["enhanced_prompt"]
+
+    after = client.get('/api/check_credits?redemption_code=CODE0001').get_json()
+    assert after["remaining_credits"] == 1
+    assert client.get('/api/stats').get_json()["singleflight"]["replayed"] >= 1
+
+
+def test_excess_requests_get_429_before_any_db_work(client, monkeypatch):
+    monkeypatch.setattr(ratelimit, '_limiter', ratelimit.RateLimiter(code_rate=0.001, code_burst=3))
+    statuses = [client.post('/api/use_credit', json={"redemption_code": "CODE0001"}).status_code
+                for _ in range(4)]
+    assert statuses == [200, 200, 200, 429]
+
+    limited = client.post('/api/use_credit', json={"redemption_code": "CODE0001"})
+    assert int(limited.headers['Retry-After']) >= 1
+    # The code's bucket covers every route that names it
+    assert client.get('/api/check_credits?redemption_code=CODE0001').status_code == 429
+
+
+def test_usage_logs_record_the_client_ip(client):
+    client.post('/api/use_credit', json={"redemption_code": "CODE0001"},
+                environ_base={'REMOTE_ADDR': '203.0.113.7'})
+    usage_log._writer.flush()
+    with database._pool.connection() as conn:
+        assert conn.execute("SELECT ip_address FROM usage_logs").fetchall() == [('203.0.113.7',)]
+
+
+def test_writes_are_shed_with_503_when_no_slot_frees(client, monkeypatch):
+    controller = admission.AdmissionController(slots=1, max_queue=4, max_wait=0.02)
+    monkeypatch.setattr(admission, '_controller', controller)
+    controller.acquire()  # another request holds the only writer slot
+
+    response = client.post('/api/use_credit', json={"redemption_code": "CODE0001"})
+    assert response.status_code == 503 and response.headers['Retry-After'] == '1'
+    # Reads don't queue for the writer
+    assert client.get('/api/check_credits?redemption_code=CODE0001').status_code == 200
+
+    controller.release()
+    assert client.post('/api/use_credit', json={"redemption_code": "CODE0001"}).status_code == 200
+    assert controller.stats()["active"] == 0
+
+
+def test_locked_database_is_reported_as_busy(client, monkeypatch):
+    def locked(*args, **kwargs):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(api_endpoints, 'transaction', locked)
+    response = client.post('/api/use_credit', json={"redemption_code": "CODE0001"})
+    assert response.status_code == 503
+    assert response.get_json()["busy"]
+
+
+def test_busy_credit_checks_get_503_by_code_or_session(client, monkeypatch):
+    session = client.post('/api/verify', json={"email": "a@example.com", "code": "CODE0001"}).get_json()["session"]
+
+    def locked(*args, **kwargs):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(api_endpoints, 'lookup_user', locked)
+    by_code = client.get('/api/check_credits?redemption_code=CODE0001')
+    by_session = client.get('/api/check_credits', headers={"Authorization": f"Bearer {session}"})
+    for response in (by_code, by_session):
+        assert response.status_code == 503 and response.headers['Retry-After']
+
+
+def test_idempotency_key_retries_replay_the_first_debit(client):
+    headers = {'Idempotency-Key': 'retry-me'}
+    first = client.post('/api/use_credit', json={"redemption_code": "CODE0001"}, headers=headers)
+    retry = client.post('/api/use_credit', json={"redemption_code": "CODE0001"}, headers=headers)
+    assert first.get_json()["remaining_credits"] == retry.get_json()["remaining_credits"] == 1
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+
+    enhance = {"redemption_code": "CODE0001", "prompt": "Hi", "settings": {}}
+    assert client.post('/api/enhance', json=enhance, headers=headers).status_code == 422
+    assert client.post('/api/use_credit', json={"redemption_code": "CODE0001"},
+                       headers={'Idempotency-Key': 'x' * 300}).status_code == 400
+
+
+def test_lease_reserve_and_settle_over_http(client):
+    lease = client.post('/api/lease', json={"redemption_code": "CODE0001", "credits": 5}).get_json()
+    assert lease["credits"] == 2 and lease["remaining_credits"] == 0  # capped at the balance
+
+    # Renewing settles the old lease in the same call
+    renewed = client.post('/api/lease', json={"redemption_code": "CODE0001",
+                                              "previous": {"lease": lease["lease"], "spent": 1}}).get_json()
+    assert renewed["settled"]["refunded"] == 1 and renewed["credits"] == 1
+
+    settled = client.post('/api/lease/settle', json={"redemption_code": "CODE0001",
+                                                     "lease": renewed["lease"], "spent": 0}).get_json()
+    assert settled["remaining_credits"] == 1
+    assert client.post('/api/lease', json={"redemption_code": "CODE0001", "credits": 0}).get_json()["success"] is False
+
+
+def test_a_credit_check_returns_a_lapsed_lease(client, pool):
+    lease = client.post('/api/lease', json={"redemption_code": "CODE0001"}).get_json()
+    assert client.get('/api/check_credits?redemption_code=CODE0001').get_json()["remaining_credits"] == 0
+
+    with pool.transaction() as conn:
+        conn.execute("UPDATE credit_leases SET expires_at = 0")
+    assert client.get('/api/check_credits?redemption_code=CODE0001').get_json()["remaining_credits"] == 2
+
+    # Reported afterwards, the one credit used is still billed
+    settled = client.post('/api/lease/settle', json={"redemption_code": "CODE0001",
+                                                     "lease": lease["lease"], "spent": 1}).get_json()
+    assert settled["late"] and settled["remaining_credits"] == 1
+
+
+def test_session_token_from_verify_authorizes_reads(client):
+    verified = client.post('/api/verify', json={"email": "a@example.com", "code": "code0001"}).get_json()
+    bearer = {'Authorization': f'Bearer {verified["session"]}'}
+
+    assert client.get('/api/check_credits', headers=bearer).get_json()["remaining_credits"] == 2
+    assert "tone" in client.get('/api/templates', headers=bearer).get_json()["templates"]
+    assert client.get('/api/templates').status_code == 401
+    assert client.get('/api/check_credits', headers={'Authorization': 'Bearer 1.2.3.4.x'}).status_code == 401
+
+
+def test_long_poll_wakes_on_a_debit(client):
+    polled = []
+    poller = threading.Thread(target=lambda: polled.append(
+        client.get('/api/balance/poll?redemption_code=CODE0001&known=2').get_json()))
+    poller.start()
+    while not balances.balance_stats()["subscribers"]:
+        time.sleep(0.001)
+
+    client.post('/api/use_credit', json={"redemption_code": "CODE0001"})
+    poller.join(5)
+    assert polled[0]["remaining_credits"] == 1
+
+    assert client.get('/api/balance/poll?redemption_code=CODE0001&known=5').get_json()["remaining_credits"] == 1
+    assert client.get('/api/balance/poll?redemption_code=NOPE0000').status_code == 404
+
+
+def test_balance_stream_is_server_sent_events(client):
+    response = client.get('/api/balance/stream?redemption_code=CODE0001', buffered=False)
+    assert response.mimetype == 'text/event-stream'
+    chunks = response.iter_encoded()
+    assert next(chunks).startswith(b"retry:")
+    assert b'"remaining_credits": 2' in next(chunks)
+    response.close()
+
+
+def test_metrics_count_requests_per_route_and_debits(client):
+    before = metrics.HTTP_REQUESTS.value('/api/use_credit', 'POST', '200')
+    for _ in range(3):
+        client.post('/api/use_credit', json={"redemption_code": "CODE0001"})
+    client.get('/api/nowhere')
+
+    response = client.get('/metrics')
+    assert response.status_code == 200 and response.content_type.startswith('text/plain')
+    text = response.get_data(as_text=True)
+    assert metrics.HTTP_REQUESTS.value('/api/use_credit', 'POST', '200') == before + 3
+    assert 'http_requests_total{route="unmatched",method="GET",status="404"}' in text
+    assert 'http_request_duration_seconds_bucket{route="/api/use_credit",method="POST",le="+Inf"}' in text
+    assert 'credit_debits_total{result="no_credits"}' in text
+    assert 'db_transaction_duration_seconds_count{kind="write"}' in text
+    assert 'lookup_cache_hit_rate ' in text and 'rate_limit_allowed_total{limit="ip"}' in text
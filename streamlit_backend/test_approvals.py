@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Bulk waiting-list approval
+
+Run: python -m pytest -q streamlit_backend/test_approvals.py
+"""
+
+import csv
+import io
+
+import pytest
+
+from approvals import bulk_approve, approved_codes_csv
+
+
+@pytest.fixture
+def pool(pool):
+    with pool.transaction() as conn:
+        conn.executemany("INSERT INTO waiting_list (name, email) VALUES (?, ?)",
+                         [(f"User {i}", f"user{i}@example.com") for i in range(500)])
+    return pool
+
+
+def statuses(pool):
+    with pool.connection() as conn:
+        return dict(conn.execute("SELECT status, COUNT(*) FROM waiting_list GROUP BY status").fetchall())
+
+
+def test_approve_all_in_one_transaction(pool):
+    with pool.transaction() as conn:
+        result = bulk_approve(conn)
+
+    assert len(result["approved"]) == 500
+    assert len({code for _, _, code in result["approved"]}) == 500
+    assert statuses(pool) == {"approved": 500}
+
+    with pool.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM users WHERE status = 'active' AND credits = 100"
+                            ).fetchone()[0] == 500
+
+    rows = list(csv.reader(io.StringIO(approved_codes_csv(result["approved"]))))
+    assert rows[0] == ["name", "email", "redemption_code"]
+    assert len(rows) == 501
+
+
+def test_approve_selected_and_search(pool):
+    with pool.transaction() as conn:
+        selected = bulk_approve(conn, ids=[1, 2, 3])
+        searched = bulk_approve(conn, search="user49")
+
+    assert [email for _, email, _ in selected["approved"]] == [
+        "user0@example.com", "user1@example.com", "user2@example.com"]
+    # user49 and user490..user499
+    assert len(searched["approved"]) == 11
+    assert statuses(pool) == {"approved": 14, "pending": 486}
+
+
+def test_existing_accounts_are_skipped(pool):
+    with pool.transaction() as conn:
+        conn.execute("INSERT INTO users (name, email, redemption_code) VALUES ('Old', 'user7@example.com', 'OLD00007')")
+        result = bulk_approve(conn, ids=[8, 9, 10])
+
+    assert result["skipped"] == ["user7@example.com"]
+    assert [email for _, email, _ in result["approved"]] == ["user8@example.com", "user9@example.com"]
+
+
+def test_rollback_leaves_nothing_behind(pool):
+    with pytest.raises(RuntimeError):
+        with pool.transaction() as conn:
+            bulk_approve(conn)
+            raise RuntimeError("admin closed the tab")
+
+    assert statuses(pool) == {"pending": 500}
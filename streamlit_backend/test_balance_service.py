@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Balance service: many streams on one thread, changes pushed as they commit
+
+Run: python -m pytest -q streamlit_backend/test_balance_service.py
+"""
+
+import asyncio
+import http.client
+import json
+import socket
+import threading
+
+import pytest
+
+import database
+import lookup_cache
+import sessions
+from credits import debit_credit
+from balances import BalanceHub
+from balance_service import BalanceService
+from conftest import add_user
+
+
+@pytest.fixture
+def service(pool, monkeypatch):
+    add_user(pool, credits=5)
+    monkeypatch.setattr(database, '_pool', pool)
+    monkeypatch.setattr(lookup_cache, '_cache', None)
+    monkeypatch.setattr(sessions, '_epochs', None)
+
+    service = BalanceService(BalanceHub(poll_interval=0.02, pool=pool), max_connections=40,
+                             auth_threads=2, heartbeat=0.2)
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        service.server = loop.run_until_complete(service.start('127.0.0.1', 0))
+        started.set()
+        loop.run_forever()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    started.wait(5)
+    service.port = service.server.sockets[0].getsockname()[1]
+    yield service
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(5)
+    service.close()
+
+
+def get(service, path):
+    conn = http.client.HTTPConnection('127.0.0.1', service.port, timeout=5)
+    conn.request('GET', path)
+    response = conn.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def open_stream(service):
+    sock = socket.create_connection(('127.0.0.1', service.port), timeout=5)
+    sock.sendall(b"GET /api/balance/stream?redemption_code=CODE0001 HTTP/1.1\r\nHost: x\r\n\r\n")
+    return sock, sock.makefile('rb')
+
+
+def next_balance(stream):
+    for line in stream:
+        if line.startswith(b'data: '):
+            return json.loads(line[6:])['remaining_credits']
+
+
+def debit(pool):
+    with pool.transaction() as conn:
+        debit_credit(conn, 'CODE0001')
+
+
+def test_streams_push_each_committed_change_from_one_thread(service, pool):
+    threads = threading.active_count()
+    streams = [open_stream(service) for _ in range(30)]
+    assert [next_balance(stream) for _, stream in streams] == [5] * 30
+    # At most the hub's watcher and the two auth threads: none per connection
+    assert threading.active_count() <= threads + 3
+
+    debit(pool)  # as another process would: no poke, the watcher notices
+    assert [next_balance(stream) for _, stream in streams] == [4] * 30
+
+    for sock, stream in streams:
+        stream.close()
+        sock.close()
+
+
+def test_long_poll_answers_when_behind_or_changed(service, pool):
+    assert get(service, '/api/balance/poll?redemption_code=CODE0001&known=9') == \
+        (200, {"success": True, "remaining_credits": 5})
+    assert get(service, '/api/balance/poll?redemption_code=CODE0001&known=5&timeout=0.05')[1]["remaining_credits"] == 5
+
+    threading.Timer(0.1, debit, (pool,)).start()
+    assert get(service, '/api/balance/poll?redemption_code=CODE0001&known=5&timeout=5')[1]["remaining_credits"] == 4
+
+
+def test_bad_requests_and_the_connection_cap(service):
+    assert get(service, '/api/balance/poll')[0] == 400
+    assert get(service, '/api/balance/poll?redemption_code=NOPE0000')[0] == 404
+    assert get(service, '/api/balance/stream?session=forged')[0] == 401
+
+    service.max_connections = 1
+    sock, stream = open_stream(service)
+    assert next_balance(stream) == 5
+    assert get(service, '/api/balance/poll?redemption_code=CODE0001')[0] == 503
+    stream.close()
+    sock.close()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Balance push: subscribers hear about committed balance changes, once each
+
+Run: python -m pytest -q streamlit_backend/test_balances.py
+"""
+
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from credits import debit_credit
+from codes import parse_code
+from balances import BalanceHub
+from conftest import add_user
+
+CODE_ID = parse_code('CODE0001')
+
+
+@pytest.fixture
+def pool(pool):
+    add_user(pool)
+    return pool
+
+
+def in_thread(fn):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(fn()))
+    thread.start()
+    return thread, result
+
+
+def test_long_poll_returns_at_once_when_behind_and_waits_when_current(pool):
+    hub = BalanceHub(poll_interval=60, pool=pool)
+    assert hub.poll(CODE_ID, 10, known=12, timeout=5) == 10
+    assert hub.poll(CODE_ID, 10, known=10, timeout=0.05) == 10  # timed out, unchanged
+
+    thread, result = in_thread(lambda: hub.poll(CODE_ID, 10, known=10, timeout=5))
+    while not hub.stats()["subscribers"]:
+        time.sleep(0.001)
+    hub.publish(CODE_ID, 10)  # not a change: nobody wakes
+    hub.publish(CODE_ID, 8)
+    thread.join()
+    assert result == [8]
+    assert hub.stats()["topics"] == 0  # the last subscriber left
+
+
+def test_committed_debits_reach_subscribers(pool):
+    # The poll interval is long: only the poke after commit can deliver in time
+    hub = BalanceHub(poll_interval=60, pool=pool)
+    thread, result = in_thread(lambda: hub.poll(CODE_ID, 10, known=10, timeout=5))
+    while not hub.stats()["subscribers"]:
+        time.sleep(0.001)
+    time.sleep(0.1)  # let the watcher take its first look
+
+    with pool.transaction() as conn:
+        debit_credit(conn, 'CODE0001', amount=3)
+    hub.poke()
+    thread.join()
+    assert result == [7]
+
+
+def test_stream_sends_the_balance_then_each_change(pool):
+    hub = BalanceHub(poll_interval=60, pool=pool, max_streams=1)
+    events = hub.stream(CODE_ID, 10, heartbeat=0.01)
+    assert next(events).startswith("retry:")
+    assert '"remaining_credits": 10' in next(events)
+    assert hub.stream(CODE_ID, 10) is None  # over the stream limit
+
+    hub.publish(CODE_ID, 9)
+    assert '"remaining_credits": 9' in next(events)
+    assert next(events) == ": keep-alive\n\n"
+
+    events.close()
+    assert hub.stats()["streams"] == 0 and hub.stats()["topics"] == 0
+
+
+def test_streams_and_polls_share_one_thread_budget(pool):
+    hub = BalanceHub(poll_interval=60, pool=pool, max_streams=2)
+    first, second = hub.stream(CODE_ID, 10), hub.stream(CODE_ID, 10)
+    # Slots are taken when the stream is handed out, not when it first runs
+    assert hub.stream(CODE_ID, 10) is None
+    assert hub.poll(CODE_ID, 10, known=10, timeout=0) is None
+    assert hub.poll(CODE_ID, 10, known=12) == 10  # already behind: no slot needed
+
+    first.close()  # never iterated, still gives its slot back
+    assert hub.poll(CODE_ID, 10, known=10, timeout=0) == 10
+    second.close()
+    stats = hub.stats()
+    assert stats["streams"] == 0 and stats["polls"] == 0 and stats["topics"] == 0
+    assert stats["rejected_streams"] == 1 and stats["rejected_polls"] == 1
+
+
+def test_a_broken_watcher_connection_is_reopened(pool):
+    hub = BalanceHub(poll_interval=0.02, pool=pool)
+    heard = []
+    hub.listen(lambda code_id, version, remaining: heard.append(remaining))
+    hub.subscribe(CODE_ID, 10)
+    while hub._watcher is None:
+        time.sleep(0.001)
+    # Every read on it raises (closing the live one under the watcher's
+    # feet would not be safe from this thread)
+    broken = sqlite3.connect(':memory:')
+    broken.close()
+    hub._watcher = broken
+
+    with pool.transaction() as conn:
+        debit_credit(conn, 'CODE0001', amount=2)
+    version, _ = hub.current(CODE_ID)
+    assert hub.wait(CODE_ID, version, timeout=5)[1] == 8
+    assert heard == [8]
+    hub.unsubscribe(CODE_ID)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Redemption code issuance: unique against issued and reserved codes, pool first
+
+Run: python -m pytest -q streamlit_backend/test_codes.py
+"""
+
+import pytest
+
+import codes
+from codes import (issue_codes, issue_code, refill_pool, pool_size, generate_unique_codes,
+                   parse_code, encode_code, generate_code)
+
+
+def test_pool_is_used_first_then_generation(pool):
+    with pool.transaction() as conn:
+        assert refill_pool(conn, 100) == 100
+        reserved = [row[0] for row in conn.execute("SELECT code FROM code_pool ORDER BY id")]
+
+        issued = issue_codes(conn, 150)
+        assert set(issued[:100]) == set(reserved)
+        assert len(set(issued)) == 150
+        assert pool_size(conn) == 0
+
+
+def test_rollback_returns_popped_codes(pool):
+    with pool.transaction() as conn:
+        refill_pool(conn, 10)
+
+    with pytest.raises(RuntimeError):
+        with pool.transaction() as conn:
+            issue_code(conn)
+            raise RuntimeError("insert failed")
+
+    with pool.connection() as conn:
+        assert pool_size(conn) == 10
+
+
+def test_collisions_are_regenerated(pool, monkeypatch):
+    with pool.transaction() as conn:
+        conn.execute("INSERT INTO users (name, email, redemption_code, code_id) VALUES ('A', 'a@example.com', 'AAAAAAAA', ?)",
+                     (parse_code('AAAAAAAA'),))
+        conn.execute("INSERT INTO code_pool (code) VALUES ('BBBBBBBB')")
+
+        # Force the first candidates onto the issued and reserved codes
+        candidates = iter(['AAAAAAAA', 'BBBBBBBB', 'AAAAAAAA', 'CCCCCCCC', 'DDDDDDDD'])
+        monkeypatch.setattr(codes, 'generate_code', lambda: next(candidates))
+
+        assert generate_unique_codes(conn, 2) == ['CCCCCCCC', 'DDDDDDDD']
+
+
+def test_codec_round_trip():
+    for _ in range(1000):
+        code = generate_code()
+        assert len(code) == 9
+        assert encode_code(parse_code(code)) == code
+
+    # Codes issued before the check character keep their own id range
+    assert parse_code("ABCD1234") == int("ABCD1234", 36)
+    assert parse_code("ABCD1234") < parse_code(generate_code())
+    assert parse_code("  abcd1234 ") == parse_code("ABCD1234")
+
+
+@pytest.mark.parametrize("code", [
+    None, 12345678, "", "ABC", "ABCD12345678", "ABCD_123", "+BCD1234", "ABCD-1234", "ÄBCD1234",
+])
+def test_malformed_codes_are_rejected(code):
+    assert parse_code(code) is None
+
+
+def test_check_character_catches_typos():
+    code = generate_code()
+    for i in range(len(code)):
+        for char in codes.CODE_ALPHABET:
+            if char != code[i]:
+                assert parse_code(code[:i] + char + code[i + 1:]) is None
+
+
+def test_malformed_codes_never_reach_the_database():
+    from credits import debit_credit
+
+    class NoQueries:
+        def execute(self, *args):
+            raise AssertionError("queried the database")
+
+    assert debit_credit(NoQueries(), "NOT A CODE") == {"success": False, "reason": "invalid"}
+
+
+def test_code_lookups_use_the_integer_index(pool):
+    with pool.connection() as conn:
+        indexes = {row[1]: row[2] for row in conn.execute("PRAGMA index_list(users)")}
+        columns = {index: [row[2] for row in conn.execute(f"PRAGMA index_info({index})")]
+                   for index in indexes}
+    assert columns["idx_users_code_id"] == ["code_id"]
+    assert ["redemption_code"] not in columns.values()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Credit debits: concurrent spenders never overspend, failures say why
+
+Run: python -m pytest -q streamlit_backend/test_credits.py
+"""
+
+import threading
+
+import pytest
+
+from credits import debit_credit, DEBITS
+from conftest import migrated_pool, add_user
+
+CODE = 'CODE0001'
+
+
+@pytest.fixture
+def pool(db_path):
+    pool = migrated_pool(db_path, max_size=8)
+    add_user(pool, CODE, credits=25)
+    yield pool
+    pool.close()
+
+
+def debit(pool, code=CODE, **kwargs):
+    with pool.transaction() as conn:
+        return debit_credit(conn, code, **kwargs)
+
+
+def test_concurrent_debits_never_overspend(pool):
+    results = []
+    start = threading.Barrier(8)
+
+    def spender():
+        start.wait()
+        for _ in range(10):
+            results.append(debit(pool))
+
+    threads = [threading.Thread(target=spender) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    succeeded = [r for r in results if r["success"]]
+    assert len(succeeded) == 25
+    assert sorted(r["remaining_credits"] for r in succeeded) == list(range(25))
+    assert {r["reason"] for r in results if not r["success"]} == {'no_credits'}
+    with pool.connection() as conn:
+        assert conn.execute("SELECT used_credits FROM users").fetchone()[0] == 25
+
+
+def test_failures_say_why(pool):
+    assert debit(pool, 'not a code') == {"success": False, "reason": 'invalid'}
+    assert debit(pool, 'NOPE0000')["reason"] == 'invalid'
+    assert debit(pool, email='b@example.com')["reason"] == 'invalid'
+    assert debit(pool, amount=26)["reason"] == 'no_credits'
+
+    ok = debit(pool, email='a@example.com', amount=5)
+    assert ok["success"] and ok["remaining_credits"] == 20 and ok["email"] == 'a@example.com'
+
+    with pool.transaction() as conn:
+        conn.execute("UPDATE users SET status = 'revoked'")
+    assert debit(pool)["reason"] == 'inactive'
+
+
+def test_debits_are_counted_by_result(pool):
+    before = {result: DEBITS.value(result) for result in ('ok', 'invalid', 'inactive', 'no_credits')}
+    debit(pool)
+    debit(pool, 'NOPE0000')
+    debit(pool, amount=100)
+    with pool.transaction() as conn:
+        conn.execute("UPDATE users SET status = 'revoked'")
+    debit(pool)
+
+    assert {result: DEBITS.value(result) - count for result, count in before.items()} == \
+        {'ok': 1, 'invalid': 1, 'inactive': 1, 'no_credits': 1}
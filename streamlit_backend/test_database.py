@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Connection pool: LIFO reuse, nested borrows, bounded checkout, leak reclaim
+
+Run: python -m pytest -q streamlit_backend/test_database.py
+"""
+
+import functools
+import threading
+
+import pytest
+
+import database
+import api_service
+from database import ConnectionPool, PoolTimeout, get_pool
+
+
+@pytest.fixture
+def small_pool(db_path):
+    pool = ConnectionPool(db_path=db_path, max_size=2, acquire_timeout=0.05)
+    yield pool
+    pool.close()
+
+
+def test_released_connections_are_reused_last_in_first_out(small_pool):
+    first, second = small_pool.acquire(), small_pool.acquire()
+    small_pool.release(first)
+    small_pool.release(second)
+    assert small_pool.acquire() is second
+    assert small_pool.acquire() is first
+    assert small_pool.stats()["opened"] == 2 and small_pool.stats()["reused"] == 2
+
+
+def test_nested_borrows_on_one_thread_share_the_connection(small_pool):
+    with small_pool.connection() as outer:
+        with small_pool.connection() as inner:
+            assert inner is outer
+        with small_pool.transaction() as conn:
+            assert conn is outer
+        assert small_pool.stats()["checked_out"] == 1
+    assert small_pool.stats()["checked_out"] == 0
+
+
+def test_exhausted_pool_times_out(small_pool):
+    held = [small_pool.acquire(), small_pool.acquire()]
+    with pytest.raises(PoolTimeout):
+        small_pool.acquire()
+    small_pool.release(held.pop())
+    assert small_pool.acquire() is not None
+
+
+def test_release_rolls_back_an_open_transaction(small_pool):
+    conn = small_pool.acquire()
+    conn.execute("CREATE TABLE t (x INTEGER)")
+    conn.execute("BEGIN")
+    conn.execute("INSERT INTO t VALUES (1)")
+    small_pool.release(conn)
+
+    with small_pool.connection() as conn:
+        assert not conn.in_transaction
+        assert conn.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 0
+
+
+def test_after_commit_waits_for_the_outermost_commit(small_pool):
+    ran = []
+    small_pool.after_commit(lambda: ran.append('now'))  # no transaction: runs at once
+    with small_pool.transaction():
+        with small_pool.transaction():
+            small_pool.after_commit(lambda: ran.append('inner'))
+        with small_pool.savepoint('op') as rollback:
+            small_pool.after_commit(lambda: ran.append('undone'))
+            rollback()
+        assert ran == ['now']
+    assert ran == ['now', 'inner']
+
+    with pytest.raises(RuntimeError):
+        with small_pool.transaction():
+            small_pool.after_commit(lambda: ran.append('rolled back'))
+            raise RuntimeError
+    assert ran == ['now', 'inner']
+
+
+def test_connections_of_dead_threads_are_reclaimed(small_pool):
+    thread = threading.Thread(target=small_pool.acquire)
+    thread.start()
+    thread.join()
+
+    assert [entry[1] for entry in small_pool.find_leaks()] == [thread]
+    assert small_pool.reclaim_leaks() == 1
+    assert small_pool.find_leaks() == [] and small_pool.stats()["leaks_reclaimed"] == 1
+
+    # The slot came back: both can be checked out again
+    small_pool.acquire()
+    small_pool.acquire()
+
+
+def test_live_holders_are_reported_but_not_reclaimed(small_pool):
+    small_pool.leak_timeout = 0
+    small_pool.acquire()
+    assert len(small_pool.find_leaks()) == 1
+    assert small_pool.reclaim_leaks() == 0
+    assert small_pool.stats()["checked_out"] == 1
+
+
+def test_get_pool_is_rebuilt_after_a_fork(db_path, monkeypatch):
+    monkeypatch.setattr(database, 'ConnectionPool', functools.partial(ConnectionPool, db_path=db_path))
+    monkeypatch.setattr(database, '_pool', None)
+    parent = get_pool()
+    assert get_pool() is parent
+
+    monkeypatch.setattr(parent, 'pid', parent.pid + 1)  # as a forked child sees it
+    child = get_pool()
+    assert child is not parent and child.db_path == db_path
+    with child.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM schema_version").fetchone()[0] > 0
+    child.close()
+    parent.close()
+
+
+def test_the_master_forks_with_no_open_connections(db_path, monkeypatch):
+    monkeypatch.setattr(database, 'ConnectionPool', functools.partial(ConnectionPool, db_path=db_path))
+    monkeypatch.setattr(database, '_pool', None)
+    monkeypatch.setattr(database, '_snapshot_pool', None)
+
+    api_service.on_starting(None)  # gunicorn's master hook: migrate, then let go
+    assert database._pool is None and database._snapshot_pool is None
+
+    pool = get_pool()  # a worker's first use opens a fresh pool
+    with pool.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM schema_version").fetchone()[0] > 0
+    database.close_pools()
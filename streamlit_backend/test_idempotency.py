@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Idempotency keys: a retried debit is charged once and answered from storage
+
+Run: python -m pytest -q streamlit_backend/test_idempotency.py
+"""
+
+import threading
+
+import pytest
+
+import database
+import lookup_cache
+import usage_log
+import singleflight
+import idempotency
+from usage_log import UsageLogWriter
+from api_endpoints import use_credit, enhance_prompt
+from conftest import migrated_pool, add_user
+
+CODE = 'CODE0001'
+
+
+@pytest.fixture
+def pool(db_path, monkeypatch):
+    pool = migrated_pool(db_path, max_size=8)
+    add_user(pool, CODE, credits=5)
+    writer = UsageLogWriter(pool=pool)
+    monkeypatch.setattr(database, '_pool', pool)
+    monkeypatch.setattr(lookup_cache, '_cache', None)
+    monkeypatch.setattr(usage_log, '_writer', writer)
+    monkeypatch.setattr(singleflight, '_flights', None)
+    yield pool
+    writer.close()
+    pool.close()
+
+
+def used_credits(pool):
+    with pool.connection() as conn:
+        return conn.execute("SELECT used_credits FROM users").fetchone()[0]
+
+
+def test_retry_with_the_same_key_is_charged_once(pool):
+    first = use_credit(CODE, idempotency_key='attempt-1')
+    retry = use_credit(CODE, idempotency_key='attempt-1')
+    assert first["remaining_credits"] == retry["remaining_credits"] == 4
+    assert retry["replayed"] and "replayed" not in first
+    assert used_credits(pool) == 1
+
+    # A new key is a new debit; no key at all is never deduplicated
+    assert use_credit(CODE, idempotency_key='attempt-2')["remaining_credits"] == 3
+    assert use_credit(CODE)["remaining_credits"] == 2
+    assert used_credits(pool) == 3
+
+
+def test_a_key_reused_for_another_request_conflicts(pool):
+    enhanced = enhance_prompt(CODE, "Hi", {}, idempotency_key='k')
+    assert enhance_prompt(CODE, "Hi", {}, idempotency_key='k')["enhanced_prompt"] == enhanced["enhanced_prompt"]
+
+    conflict = enhance_prompt(CODE, "Something else", {}, idempotency_key='k')
+    assert conflict["conflict"] and not conflict["success"]
+    assert used_credits(pool) == 1
+
+
+def test_failures_are_not_stored(pool):
+    with pool.transaction() as conn:
+        conn.execute("UPDATE users SET used_credits = credits")
+    assert use_credit(CODE, idempotency_key='k')["message"] == "No credits remaining"
+
+    with pool.transaction() as conn:
+        conn.execute("UPDATE users SET credits = credits + 1")
+    assert use_credit(CODE, idempotency_key='k')["success"]
+
+
+def test_expired_keys_run_again_and_are_purged(pool, monkeypatch):
+    use_credit(CODE, idempotency_key='old')
+    monkeypatch.setattr(idempotency, 'TTL', 0)
+    assert "replayed" not in use_credit(CODE, idempotency_key='old')
+    assert used_credits(pool) == 2
+
+    with pool.transaction() as conn:
+        assert idempotency.purge_expired(conn, ttl=0) == 1
+
+
+def test_concurrent_retries_debit_once(pool):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(use_credit(CODE, idempotency_key='same')))
+               for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert {r["remaining_credits"] for r in results} == {4}
+    assert sum(1 for r in results if r.get("replayed")) == 5
+    assert used_credits(pool) == 1
+
+
+def test_key_validation():
+    assert idempotency.valid_key('3f6c1f0e-9b7d-4c1a-8f55-0e2b7d1c9a10')
+    assert not idempotency.valid_key('')
+    assert not idempotency.valid_key('x' * 256)
+    assert not idempotency.valid_key('new\nline')
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Credit leases: reserved credits are debited up front and the unspent rest
+comes back on settlement or expiry
+
+Run: python -m pytest -q streamlit_backend/test_leases.py
+"""
+
+import pytest
+
+import database
+from codes import parse_code
+from leases import reserve_lease, settle_lease, expire_leases, LEASE_TTL
+from conftest import add_user
+
+CODE = 'CODE0001'
+
+
+@pytest.fixture
+def pool(pool, monkeypatch):
+    add_user(pool, CODE, credits=25)
+    monkeypatch.setattr(database, '_pool', pool)  # signing.py reads its key from here
+    return pool
+
+
+def balance(pool):
+    with pool.connection() as conn:
+        return conn.execute("SELECT credits - used_credits FROM users").fetchone()[0]
+
+
+def test_reserve_then_settle_refunds_the_unspent_rest(pool):
+    with pool.transaction() as conn:
+        lease = reserve_lease(conn, CODE, 10)
+    assert lease["credits"] == 10 and lease["remaining_credits"] == 15
+    assert balance(pool) == 15  # held while the lease is open
+
+    with pool.transaction() as conn:
+        settled = settle_lease(conn, CODE, lease["lease"], 3)
+    assert settled["refunded"] == 7 and settled["remaining_credits"] == 22
+
+    # Settling again is a replay with the same count, refused with another
+    with pool.transaction() as conn:
+        assert settle_lease(conn, CODE, lease["lease"], 3)["replayed"]
+        assert settle_lease(conn, CODE, lease["lease"], 4)["reason"] == 'settled'
+    assert balance(pool) == 22
+
+
+def test_a_lease_never_exceeds_the_balance(pool):
+    with pool.transaction() as conn:
+        assert reserve_lease(conn, CODE, 20)["credits"] == 20
+        assert reserve_lease(conn, CODE, 20)["credits"] == 5
+        assert reserve_lease(conn, CODE, 20)["reason"] == 'no_credits'
+        assert reserve_lease(conn, 'NOPE0000', 20)["reason"] == 'invalid'
+    assert balance(pool) == 0
+
+
+def test_expired_leases_give_their_credits_back(pool):
+    with pool.transaction() as conn:
+        reserve_lease(conn, CODE, 10, now=1000)
+        assert expire_leases(conn, now=1000 + LEASE_TTL - 1) == 0
+        assert expire_leases(conn, now=1000 + LEASE_TTL) == 1
+    assert balance(pool) == 25
+
+
+def test_a_late_settlement_still_bills_what_was_spent(pool):
+    with pool.transaction() as conn:
+        lease = reserve_lease(conn, CODE, 10, now=1000)
+
+    # Left idle past expiry: the settle path sweeps it first, then charges
+    with pool.transaction() as conn:
+        late = settle_lease(conn, CODE, lease["lease"], 2, now=1000 + LEASE_TTL + 60)
+    assert late["late"] and late["spent"] == 2 and late["remaining_credits"] == 23
+    assert balance(pool) == 23
+
+    with pool.transaction() as conn:
+        assert settle_lease(conn, CODE, lease["lease"], 2)["replayed"]
+        assert settle_lease(conn, CODE, lease["lease"], 3)["reason"] == 'settled'
+    assert balance(pool) == 23
+
+
+def test_forged_or_foreign_tokens_are_refused(pool):
+    with pool.transaction() as conn:
+        conn.execute("INSERT INTO users (name, email, redemption_code, code_id, credits) "
+                     "VALUES ('B', 'b@example.com', 'CODE0002', ?, 5)", (parse_code('CODE0002'),))
+        token = reserve_lease(conn, CODE, 10)["lease"]
+        lease_id, expires_at, signature = token.split('.')
+
+        assert settle_lease(conn, 'CODE0002', token, 0)["reason"] == 'invalid'
+        assert settle_lease(conn, CODE, f"{lease_id}.{int(expires_at) + 3600}.{signature}", 0)["reason"] == 'invalid'
+        assert settle_lease(conn, CODE, token, 11)["reason"] == 'bad_spent'
+        assert settle_lease(conn, CODE, token, "3")["reason"] == 'bad_spent'
+        assert settle_lease(conn, CODE, token, 10)["success"]
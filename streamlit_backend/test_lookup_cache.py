@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Code lookup cache: hits until the row changes, in this process or another
+
+Run: python -m pytest -q streamlit_backend/test_lookup_cache.py
+"""
+
+import sqlite3
+from contextlib import contextmanager
+import time
+
+import pytest
+
+from credits import debit_credit
+from codes import parse_code
+from lookup_cache import UserLookupCache
+from conftest import add_user
+
+CODE = 'CODE0001'
+CODE_ID = parse_code(CODE)
+
+
+@pytest.fixture
+def pool(pool):
+    for i in range(1, 6):
+        add_user(pool, f"CODE{i:04d}", email=f"user{i}@example.com", name=f"User {i}")
+    return pool
+
+
+def test_repeat_lookups_hit(pool):
+    cache = UserLookupCache(pool=pool)
+    assert cache.get(CODE_ID) == ("User 1", "user1@example.com", 10, 0, "active")
+    assert cache.get(CODE_ID) == ("User 1", "user1@example.com", 10, 0, "active")
+    assert cache.get(parse_code('NOPE0000')) is None
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["size"]) == (1, 2, 1)
+
+
+def test_debit_and_revoke_invalidate_immediately(pool):
+    cache = UserLookupCache(pool=pool)
+    cache.get(CODE_ID)
+    cache.get(parse_code('CODE0002'))
+
+    with pool.transaction() as conn:
+        debit_credit(conn, CODE)
+    assert cache.get(CODE_ID)[3] == 1
+
+    with pool.transaction() as conn:
+        conn.execute("UPDATE users SET status = 'revoked' WHERE code_id = ?", (CODE_ID,))
+    assert cache.get(CODE_ID)[4] == "revoked"
+
+    # The untouched code stayed cached throughout
+    assert cache.stats()["invalidations"] == 2
+    assert cache.get(parse_code('CODE0002')) is not None
+    assert cache.stats()["hits"] == 1
+
+
+def test_commits_from_another_process_invalidate(pool):
+    cache = UserLookupCache(pool=pool)
+    cache.get(CODE_ID)
+
+    # A plain connection stands in for another worker process
+    other = sqlite3.connect(pool.db_path)
+    with other:
+        other.execute("UPDATE users SET credits = 50 WHERE code_id = ?", (CODE_ID,))
+    other.close()
+
+    assert cache.get(CODE_ID)[2] == 50
+
+
+def test_unrelated_writes_keep_entries(pool):
+    cache = UserLookupCache(pool=pool)
+    cache.get(CODE_ID)
+    with pool.transaction() as conn:
+        conn.execute("UPDATE users SET last_used = CURRENT_TIMESTAMP WHERE code_id = ?", (CODE_ID,))
+        conn.execute("INSERT INTO waiting_list (name, email) VALUES ('W', 'w@example.com')")
+
+    cache.get(CODE_ID)
+    assert cache.stats()["hits"] == 1
+
+
+def test_entries_expire_and_are_bounded(pool):
+    cache = UserLookupCache(pool=pool, max_entries=3, ttl=0.05)
+    for i in range(1, 6):
+        cache.get(parse_code(f"CODE{i:04d}"))
+    assert cache.stats()["size"] == 3
+    assert cache.stats()["evictions"] == 2
+
+    time.sleep(0.06)
+    cache.get(parse_code("CODE0005"))
+    assert cache.stats()["hits"] == 0
+
+
+def test_log_gap_flushes_everything(pool):
+    cache = UserLookupCache(pool=pool)
+    cache.get(CODE_ID)
+    with pool.transaction() as conn:
+        conn.execute("UPDATE users SET credits = 20 WHERE code_id = ?", (parse_code('CODE0002'),))
+        # As if the trim ran past entries this cache never saw
+        conn.execute("DELETE FROM user_changes")
+        conn.execute("INSERT INTO user_changes (seq, code_id) VALUES (100000, NULL)")
+
+    assert cache.get(CODE_ID) is not None
+    stats = cache.stats()
+    assert stats["flushes"] == 1
+    assert stats["hits"] == 0
+
+
+def test_a_commit_racing_a_miss_is_not_cached(pool, monkeypatch):
+    cache = UserLookupCache(pool=pool)
+    cache.get(parse_code('CODE0002'))  # the watcher is up
+    borrow = pool.connection
+
+    @contextmanager
+    def read_then_revoke():
+        with borrow() as conn:
+            yield conn
+        # After the miss has read the row, before it caches it: a revoke
+        # commits and another thread's lookup consumes its change
+        monkeypatch.setattr(pool, 'connection', borrow)
+        with pool.transaction() as conn:
+            conn.execute("UPDATE users SET status = 'revoked' WHERE code_id = ?", (CODE_ID,))
+        with cache._lock:
+            cache._sync()
+
+    monkeypatch.setattr(pool, 'connection', read_then_revoke)
+    assert cache.get(CODE_ID)[4] == "active"  # read before the revoke
+    assert cache.get(CODE_ID)[4] == "revoked"
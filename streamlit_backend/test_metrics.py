@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Metrics registry: labelled counters and histograms rendered as Prometheus text
+
+Run: python -m pytest -q streamlit_backend/test_metrics.py
+"""
+
+import metrics
+from metrics import Counter, LabeledHistogram, counter, timed_action, render, ACTIONS, ACTION_SECONDS
+
+
+def test_counters_and_histograms_render_per_label_set():
+    requests = Counter('test_requests_total', 'Requests', ('route',))
+    requests.inc('/a')
+    requests.inc('/a')
+    requests.inc('/b', amount=5)
+    assert requests.value('/a') == 2 and requests.value('/c') == 0
+
+    latency = LabeledHistogram('test_seconds', 'Latency', ('route',), bounds=(0.1, 1))
+    latency.observe(0.05, '/a')
+    latency.observe(0.5, '/a')
+    latency.observe(5, '/a')
+    assert [sample[2] for sample in latency.samples()] == [1, 2, 3, 5.55, 3]
+    assert latency.samples()[2][1] == {"route": '/a', "le": float('inf')}
+
+
+def test_render_is_prometheus_text(monkeypatch):
+    monkeypatch.setattr(metrics, 'STATS_EXPORTS', ())  # pool_stats() would open the default database
+    escaped = counter('test_escaped_total', 'Label escaping', ('value',))
+    escaped.inc('say "hi"\n')
+    assert counter('test_escaped_total', 'Looked up again') is escaped
+
+    text = render()
+    assert '# TYPE test_escaped_total counter' in text
+    assert 'test_escaped_total{value="say \\"hi\\"\\n"} 1' in text
+    assert '# TYPE http_request_duration_seconds histogram' in text
+    assert text.endswith('\n')
+
+
+def test_timed_action_labels_outcomes_and_caps_actions():
+    @timed_action(('known',))
+    def handle(action):
+        if action == 'boom':
+            raise ValueError(action)
+        return {"success": action == 'known'}
+
+    before = ACTION_SECONDS.child('unknown').count
+    handle('known')
+    handle('made-up')
+    try:
+        handle('boom')
+    except ValueError:
+        pass
+    assert ACTIONS.value('known', 'success') >= 1
+    assert ACTIONS.value('unknown', 'failure') >= 1 and ACTIONS.value('unknown', 'error') >= 1
+    assert ACTION_SECONDS.child('unknown').count == before + 2
+    assert ACTIONS.value('made-up', 'failure') == 0
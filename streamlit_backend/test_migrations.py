@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Migrations from the legacy schemas: data survives, a second run is a no-op
+
+Run: python -m pytest -q streamlit_backend/test_migrations.py
+"""
+
+import sqlite3
+
+import pytest
+
+from migrations import migrate, MIGRATIONS, MigrationError
+from codes import parse_code
+from rollups import get_counters
+
+LEGACY_TABLES = '''
+CREATE TABLE waiting_list (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL,
+                           email TEXT UNIQUE NOT NULL, reason TEXT, status TEXT DEFAULT 'pending',
+                           applied_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP, approved_date TIMESTAMP,
+                           admin_notes TEXT);
+CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, email TEXT UNIQUE NOT NULL,
+                    redemption_code TEXT UNIQUE NOT NULL, credits INTEGER DEFAULT 100,
+                    used_credits INTEGER DEFAULT 0, status TEXT DEFAULT 'active',
+                    created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP, last_used TIMESTAMP);
+INSERT INTO waiting_list (name, email) VALUES ('W', 'w@example.com');
+INSERT INTO users (name, email, redemption_code, credits, used_credits)
+VALUES ('A', 'a@example.com', 'ABCD1234', 100, 3);
+'''
+
+# streamlit_with_api.py's old init_db()
+FLASK_USAGE_LOGS = '''
+CREATE TABLE usage_logs (id INTEGER PRIMARY KEY AUTOINCREMENT, email TEXT NOT NULL, action TEXT NOT NULL,
+                         credits_used INTEGER DEFAULT 1, prompt_length INTEGER,
+                         timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+INSERT INTO usage_logs (email, action, credits_used, prompt_length, timestamp)
+VALUES ('a@example.com', 'enhance_prompt', 2, 40, '2026-01-02 10:00:00');
+'''
+
+# app.py / streamlit_app.py's old init_db()
+APP_USAGE_LOGS = '''
+CREATE TABLE usage_logs (id INTEGER PRIMARY KEY AUTOINCREMENT, user_email TEXT, redemption_code TEXT,
+                         prompt_length INTEGER, response_length INTEGER,
+                         timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP, ip_address TEXT);
+INSERT INTO usage_logs (user_email, redemption_code, prompt_length, response_length, timestamp, ip_address)
+VALUES ('a@example.com', 'ABCD1234', 40, 400, '2026-01-02 10:00:00', '10.0.0.1');
+'''
+
+
+@pytest.fixture(params=['flask', 'app'])
+def legacy(request, db_path):
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    conn.executescript(LEGACY_TABLES + (FLASK_USAGE_LOGS if request.param == 'flask' else APP_USAGE_LOGS))
+    yield request.param, conn
+    conn.close()
+
+
+def schema(conn):
+    return sorted(conn.execute("SELECT type, name, sql FROM sqlite_master"))
+
+
+def test_legacy_data_survives_migration(legacy):
+    layout, conn = legacy
+    assert migrate(conn) == [version for version, _, _ in MIGRATIONS]
+
+    user = conn.execute("SELECT email, redemption_code, code_id, credits, used_credits FROM users").fetchall()
+    assert user == [('a@example.com', 'ABCD1234', parse_code('ABCD1234'), 100, 3)]
+    assert conn.execute("SELECT email FROM waiting_list").fetchall() == [('w@example.com',)]
+
+    log = conn.execute("SELECT user_email, prompt_length, timestamp, action, credits_used, "
+                       "redemption_code, response_length FROM usage_logs").fetchone()
+    if layout == 'flask':
+        assert log == ('a@example.com', 40, '2026-01-02 10:00:00', 'enhance_prompt', 2, None, None)
+    else:
+        assert log == ('a@example.com', 40, '2026-01-02 10:00:00', 'enhance_prompt', 1, 'ABCD1234', 400)
+
+    # The rollups were folded in from the migrated rows
+    counters = get_counters(conn, ('users.total', 'usage_logs.total'))
+    assert counters == {'users.total': 1, 'usage_logs.total': 1}
+
+
+def test_second_migration_is_a_no_op(legacy):
+    _, conn = legacy
+    migrate(conn)
+    before = schema(conn), conn.execute("SELECT * FROM usage_logs").fetchall()
+
+    assert migrate(conn) == []
+    assert (schema(conn), conn.execute("SELECT * FROM usage_logs").fetchall()) == before
+    assert conn.execute("SELECT COUNT(*) FROM schema_version").fetchone()[0] == len(MIGRATIONS)
+
+
+def test_codes_that_cannot_be_keyed_stop_the_migration(legacy):
+    _, conn = legacy
+    conn.executescript("""
+        INSERT INTO users (name, email, redemption_code) VALUES ('B', 'b@example.com', 'abcd1234');
+        INSERT INTO users (name, email, redemption_code) VALUES ('C', 'c@example.com', 'OLD-CODE-7');
+    """)
+    with pytest.raises(MigrationError) as error:
+        migrate(conn)
+    assert "malformed redemption codes for user ids [3]" in str(error.value)
+    assert "differing only in case for user ids [[1, 2]]" in str(error.value)
+
+    # Nothing was keyed: every user still has the old TEXT key, none a NULL code_id
+    assert 'code_id' not in [row[1] for row in conn.execute("PRAGMA table_info(users)")]
+    assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 3
+
+    # Once the codes are reissued the migration completes
+    conn.execute("UPDATE users SET redemption_code = 'EFGH5678' WHERE id = 2")
+    conn.execute("UPDATE users SET redemption_code = 'IJKL9012' WHERE id = 3")
+    migrate(conn)
+    assert conn.execute("SELECT COUNT(*) FROM users WHERE code_id IS NULL").fetchone()[0] == 0
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Enhancement output cache: same prompt + settings renders once, bounded, persistent
+
+Run: python -m pytest -q streamlit_backend/test_output_cache.py
+"""
+
+import os
+import threading
+
+import pytest
+
+import output_cache
+from output_cache import OutputCache, memoized_enhancement, settings_key
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = OutputCache(max_bytes=1024 * 1024)
+    monkeypatch.setattr(output_cache, '_cache', cache)
+    return cache
+
+
+def counting_generator():
+    calls = []
+
+    @memoized_enhancement
+    def generate(original_prompt, settings):
+        calls.append(original_prompt)
+        return f"[{settings.get('tone', 'helpful')}] {original_prompt}"
+
+    return generate, calls
+
+
+def test_repeat_prompts_render_once(cache):
+    generate, calls = counting_generator()
+    assert generate("Write a poem", {"tone": "playful", "length": "short"}) == "[playful] Write a poem"
+    assert generate("Write a poem", {"length": "short", "tone": "playful"}) == "[playful] Write a poem"
+    assert generate("Write a poem", {"tone": "formal"}) == "[formal] Write a poem"
+
+    assert calls == ["Write a poem", "Write a poem"]
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 2)
+
+
+def test_settings_key_is_canonical():
+    assert settings_key({"b": 1, "a": 2}) == settings_key({"a": 2, "b": 1})
+    assert settings_key(None) == settings_key({})
+
+
+def test_bad_inputs_bypass_the_cache(cache):
+    generate, calls = counting_generator()
+    with pytest.raises(AttributeError):
+        generate("prompt", None)
+    assert cache.stats()["misses"] == 0
+
+
+def test_memory_is_bounded_lru():
+    cache = OutputCache(max_bytes=2000)
+    for i in range(10):
+        cache.put(("gen", str(i), "{}"), "x" * 500)
+        cache.get(("gen", "0", "{}"))  # keep the first entry hot
+
+    stats = cache.stats()
+    assert stats["bytes"] <= 2000
+    assert stats["evictions"] == 10 - stats["entries"]
+    assert cache.get(("gen", "0", "{}")) is not None
+    assert cache.get(("gen", "1", "{}")) is None
+
+
+def test_persists_across_restarts(tmp, caplog):
+    path = os.path.join(tmp, 'enhance_cache.jsonl.gz')
+    first = OutputCache(path=path)
+    first.put(("gen", "abc", "{}"), "enhanced ✨")
+    assert first.save() == 1
+    assert os.listdir(tmp) == ['enhance_cache.jsonl.gz']  # no temp file left behind
+
+    second = OutputCache(path=path)
+    assert second.get(("gen", "abc", "{}")) == "enhanced ✨"
+
+    with open(path, 'wb') as f:
+        f.write(b"not gzip")
+    assert OutputCache(path=path).stats()["entries"] == 0
+    assert "not fully loaded" in caplog.text
+
+
+def test_concurrent_saves_never_share_a_temp_file(tmp):
+    path = os.path.join(tmp, 'enhance_cache.jsonl.gz')
+    caches = []
+    for worker in range(4):
+        cache = OutputCache(path=path)
+        cache.put(("gen", str(worker), "{}"), "x" * 100000)
+        caches.append(cache)
+    threads = [threading.Thread(target=cache.save) for cache in caches]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert os.listdir(tmp) == ['enhance_cache.jsonl.gz']
+    assert OutputCache(path=path).stats()["entries"] == 1  # one worker's complete copy
+
+
+def test_changed_template_gets_new_keys():
+    def make(template):
+        namespace = {}
+        exec(f"def generate(original_prompt, settings):\n    return f'{template}'", namespace)
+        return output_cache._generator_id(namespace["generate"])
+
+    assert make("A {original_prompt}") == make("A {original_prompt}")
+    assert make("A {original_prompt}") != make("B {original_prompt}")
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+EXPLAIN QUERY PLAN regression suite for the hot queries in app.py,
+streamlit_app.py, credits.py, codes.py, rollups.py, retention.py, idempotency.py, leases.py and sessions.py
+
+Every query must be answered from an index: no full table scan and no
+temporary B-tree for ORDER BY.  Queries that list a whole table on purpose
+(the admin "Active Users" tab) may walk an index in order, but never sort.
+
+Run: python -m pytest -q streamlit_backend/test_query_plans.py
+"""
+
+import sqlite3
+
+import pytest
+
+from codes import parse_code
+from conftest import migrated_pool
+
+CODE_ID = parse_code("ABCD1234")
+
+# name -> (sql, params, whole-table listing allowed)
+HOT_QUERIES = {
+    # app.py registration / approval
+    "waiting_list by email": (
+        "SELECT email FROM waiting_list WHERE email = ?", ("a@example.com",), False),
+    "pending application by email": (
+        "SELECT name, email FROM waiting_list WHERE email = ? AND status = 'pending'",
+        ("a@example.com",), False),
+    "users by email": (
+        "SELECT email FROM users WHERE email = ?", ("a@example.com",), False),
+    "issued/reserved code probe": (
+        """SELECT redemption_code FROM users WHERE code_id IN (?, ?)
+           UNION ALL
+           SELECT code FROM code_pool WHERE code IN (?, ?)""",
+        (CODE_ID, CODE_ID + 1, "ABCD1234K", "WXYZ9876A"), False),
+
+    # verify / check_credits (app.py api_* and streamlit_app.py endpoints)
+    "verify email + code": (
+        """SELECT name, credits, used_credits, status FROM users
+           WHERE email = ? AND code_id = ? AND status = 'active'""",
+        ("a@example.com", CODE_ID), False),
+    "check credits by code": (
+        """SELECT name, email, credits, used_credits, status FROM users
+           WHERE code_id = ? AND status = 'active'""", (CODE_ID,), False),
+    "streamlit check credits": (
+        "SELECT credits, used_credits FROM users WHERE code_id = ?", (CODE_ID,), False),
+
+    # credits.py debit
+    "debit by code": (
+        """UPDATE users SET used_credits = used_credits + 1, last_used = CURRENT_TIMESTAMP
+           WHERE code_id = ? AND status = 'active' AND credits - used_credits >= 1
+           RETURNING id, email, credits, used_credits""", (CODE_ID,), False),
+    "debit by email + code": (
+        """UPDATE users SET used_credits = used_credits + 1, last_used = CURRENT_TIMESTAMP
+           WHERE email = ? AND code_id = ? AND status = 'active'
+             AND credits - used_credits >= 1
+           RETURNING id, email, credits, used_credits""", ("a@example.com", CODE_ID), False),
+
+    # admin dashboard
+    "pending applications": (
+        """SELECT id, name, email, reason, applied_date FROM waiting_list
+           WHERE status = 'pending' ORDER BY applied_date DESC""", (), False),
+    "dashboard counters": (
+        "SELECT name, value FROM stat_counters WHERE name IN (?, ?, ?)",
+        ("users.total", "users.credits", "users.used_credits"), False),
+    "daily usage": (
+        """SELECT day, calls, credits_used, prompt_chars, response_chars
+           FROM usage_daily ORDER BY day DESC LIMIT ?""", (14,), True),
+    "active users tab": (
+        """SELECT name, email, redemption_code, credits, used_credits, created_date, last_used, status
+           FROM users ORDER BY created_date DESC""", (), True),
+    "recent usage": (
+        """SELECT ul.user_email, ul.timestamp, ul.prompt_length, ul.response_length
+           FROM usage_logs ul ORDER BY ul.timestamp DESC LIMIT 10""", (), True),
+
+    # retention.py archive batches
+    "expired usage batch": (
+        """SELECT id, user_email, redemption_code, prompt_length, response_length,
+                  timestamp, ip_address, action, credits_used
+           FROM usage_logs WHERE timestamp < ? ORDER BY timestamp LIMIT ?""",
+        ("2026-01-01 00:00:00", 500), False),
+
+    # idempotency.py retries and purge
+    "stored idempotent response": (
+        """SELECT request_hash, response FROM idempotency_keys
+           WHERE code_id = ? AND key = ? AND created_at > ?""", (CODE_ID, "key", 0.0), False),
+    "expired idempotency keys": (
+        "DELETE FROM idempotency_keys WHERE created_at <= ?", (0.0,), False),
+
+    # leases.py reserve / settle / expiry sweep / credit check
+    "lease balance": (
+        "SELECT credits - used_credits FROM users WHERE code_id = ? AND status = 'active'", (CODE_ID,), False),
+    "lease by id": (
+        "SELECT reserved, spent, status FROM credit_leases WHERE id = ? AND code_id = ?", (1, CODE_ID), False),
+    "expired leases": (
+        """UPDATE credit_leases SET status = 'expired', settled_at = ?
+           WHERE status = 'open' AND expires_at <= ?
+           RETURNING code_id, reserved - spent""", (0.0, 0.0), False),
+    "due leases of a user": (
+        """SELECT 1 FROM credit_leases
+           WHERE status = 'open' AND expires_at <= ? AND code_id = ? LIMIT 1""", (0.0, CODE_ID), False),
+
+    # sessions.py token issue / validation
+    "session code by user id": (
+        "SELECT code_id FROM users WHERE id = ?", (1,), False),
+    "start session": (
+        """UPDATE users SET last_used = CURRENT_TIMESTAMP
+           WHERE email = ? AND code_id = ? AND status = 'active'
+           RETURNING id, COALESCE((SELECT epoch FROM session_epochs
+                                   WHERE user_id = users.id), 0)""", ("a@example.com", CODE_ID), False),
+}
+
+
+@pytest.fixture(scope="module")
+def conn(tmp_path_factory):
+    pool = migrated_pool(str(tmp_path_factory.mktemp('plans') / 'plans.db'), max_size=1)
+    with pool.connection() as connection:
+        yield connection
+    pool.close()
+
+
+def clustered_tables(conn):
+    """WITHOUT ROWID tables: a scan walks the primary key in order"""
+    return {row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND sql LIKE '%WITHOUT ROWID%'"
+    )}
+
+
+def query_plan(conn, sql, params):
+    """EXPLAIN QUERY PLAN detail strings, one per plan node"""
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+
+@pytest.mark.parametrize("name", sorted(HOT_QUERIES))
+def test_hot_query_uses_index(conn, name):
+    sql, params, whole_table = HOT_QUERIES[name]
+    plan = query_plan(conn, sql, params)
+    clustered = clustered_tables(conn)
+
+    for step in plan:
+        assert "TEMP B-TREE" not in step, f"{name}: sorts in a temp B-tree: {plan}"
+
+        if step.startswith("SCAN"):
+            assert whole_table, f"{name}: full scan: {plan}"
+            indexed = ("USING" in step and "INDEX" in step) or step.split()[1] in clustered
+            assert indexed, f"{name}: unindexed scan: {plan}"
+
+
+def test_every_migration_index_is_used(conn):
+    """Catch indexes nothing reads any more (pure write overhead)"""
+    indexes = {row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'"
+    )}
+    used = set()
+    for sql, params, _ in HOT_QUERIES.values():
+        for step in query_plan(conn, sql, params):
+            used.update(index for index in indexes if index in step)
+
+    assert indexes <= used, f"unused indexes: {sorted(indexes - used)}"
+
+
+def test_sqlite_supports_returning():
+    # credits.debit_credit relies on UPDATE ... RETURNING (SQLite 3.35+)
+    assert sqlite3.sqlite_version_info >= (3, 35, 0)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Token buckets: bursts, refill, per-key isolation and batch costs
+
+Run: python -m pytest -q streamlit_backend/test_ratelimit.py
+"""
+
+import threading
+import time
+
+from codes import parse_code
+from ratelimit import TokenBucketLimiter, RateLimiter, request_codes
+
+
+def test_burst_then_refill():
+    limiter = TokenBucketLimiter(rate=100, burst=3, shards=4)
+    assert [limiter.acquire("ip") for _ in range(3)] == [0, 0, 0]
+    assert limiter.acquire("ip") > 0
+    assert limiter.acquire("other") == 0
+
+    time.sleep(0.02)
+    assert limiter.acquire("ip") == 0
+
+
+def test_concurrent_threads_never_overspend():
+    limiter = TokenBucketLimiter(rate=0.001, burst=50, shards=4)
+    admitted = []
+
+    def hammer():
+        admitted.extend(1 for _ in range(100) if limiter.acquire("ip") == 0)
+
+    threads = [threading.Thread(target=hammer) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(admitted) == 50
+    assert limiter.stats()["rejected"] == 750
+
+
+def test_shards_are_bounded():
+    limiter = TokenBucketLimiter(rate=1, burst=1, shards=2, max_keys=10)
+    for i in range(100):
+        limiter.acquire(f"ip{i}")
+    assert limiter.stats()["keys"] <= 20
+
+
+def test_ip_limit_holds_across_codes():
+    limiter = RateLimiter(ip_rate=0.001, ip_burst=2, code_rate=0.001, code_burst=100)
+    assert limiter.check("1.2.3.4", {1: 1}) == 0
+    assert limiter.check("1.2.3.4", {2: 1}) == 0
+    assert limiter.check("1.2.3.4", {3: 1}) > 0
+
+
+def test_batches_charge_every_code_they_name():
+    assert request_codes({"operations": [
+        {"op": "use_credit", "redemption_code": "CODE0001"},
+        {"op": "verify", "code": "code0001"},
+        {"op": "check_credits", "redemption_code": "not a code"},
+    ]}) == {parse_code("CODE0001"): 2}
+    assert request_codes(None, {"redemption_code": "CODE0002"}) == {parse_code("CODE0002"): 1}
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Usage log retention: archived rows round-trip, recent rows stay, space comes back
+
+Run: python -m pytest -q streamlit_backend/test_retention.py
+"""
+
+import os
+import gzip
+import json
+
+
+from retention import archive_usage_logs, archive_path, auto_vacuum_mode
+
+
+def test_archives_old_rows_and_keeps_recent_ones(pool, tmp):
+    old = [(f"user{i}@example.com", "CODE0001", i, 2 * i, f"2020-01-0{1 + i % 2} 12:00:00")
+           for i in range(1200)]
+    with pool.transaction() as conn:
+        conn.executemany('''INSERT INTO usage_logs
+                                (user_email, redemption_code, prompt_length, response_length, timestamp)
+                            VALUES (?, ?, ?, ?, ?)''', old)
+        conn.execute("INSERT INTO usage_logs (user_email, redemption_code) VALUES ('new@example.com', 'CODE0002')")
+
+    archive_dir = os.path.join(tmp, 'archive')
+    result = archive_usage_logs(days=30, archive_dir=archive_dir, batch_size=500, pool=pool)
+
+    assert result["archived"] == 1200
+    assert result["batches"] == 3
+    assert result["days"] == ["2020-01-01", "2020-01-02"]
+
+    archived = []
+    for day in result["days"]:
+        with gzip.open(archive_path(day, archive_dir), 'rt') as archive:
+            archived.extend(json.loads(line) for line in archive)
+    assert sorted(row["prompt_length"] for row in archived) == list(range(1200))
+    assert len({row["id"] for row in archived}) == 1200
+
+    with pool.connection() as conn:
+        remaining = conn.execute("SELECT user_email FROM usage_logs").fetchall()
+        assert remaining == [("new@example.com",)]
+        # Archived usage still counts on the dashboard
+        total = conn.execute("SELECT value FROM stat_counters WHERE name = 'usage_logs.total'").fetchone()
+        assert total == (1201,)
+
+
+def test_new_databases_reclaim_space_incrementally(pool, tmp):
+    with pool.transaction() as conn:
+        conn.executemany("INSERT INTO usage_logs (user_email, timestamp) VALUES (?, '2020-01-01 00:00:00')",
+                         [("x" * 200,)] * 2000)
+
+    archive_usage_logs(days=30, archive_dir=os.path.join(tmp, 'archive'), pool=pool)
+
+    with pool.connection() as conn:
+        assert auto_vacuum_mode(conn) == 2
+        assert conn.execute("PRAGMA freelist_count").fetchone()[0] == 0
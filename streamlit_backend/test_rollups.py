@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+The trigger-maintained rollups must always equal a full recompute
+
+Run: python -m pytest -q streamlit_backend/test_rollups.py
+"""
+
+from credits import debit_credit
+from codes import parse_code
+from rollups import recompute_rollups, get_counters
+
+ROLLUP_TABLES = ("usage_daily", "user_usage_totals", "stat_counters")
+
+
+def snapshot(conn):
+    """Every rollup row, ignoring counters that have drifted to zero"""
+    return {table: sorted(row for row in conn.execute(f"SELECT * FROM {table}")
+                          if table != "stat_counters" or row[1] != 0)
+            for table in ROLLUP_TABLES}
+
+
+def test_triggers_match_recompute(pool):
+    with pool.transaction() as conn:
+        conn.executemany("INSERT INTO waiting_list (name, email) VALUES (?, ?)",
+                         [(f"User {i}", f"user{i}@example.com") for i in range(5)])
+        conn.execute("UPDATE waiting_list SET status = 'approved' WHERE id <= 3")
+        conn.execute("DELETE FROM waiting_list WHERE id = 5")
+        conn.executemany("INSERT INTO users (name, email, redemption_code, code_id, credits) VALUES (?, ?, ?, ?, ?)",
+                         [(f"User {i}", f"user{i}@example.com", f"CODE{i:04d}", parse_code(f"CODE{i:04d}"), 10)
+                          for i in range(3)])
+        for _ in range(4):
+            debit_credit(conn, "CODE0000")
+        conn.execute("UPDATE users SET status = 'revoked' WHERE redemption_code = 'CODE0002'")
+        conn.execute("UPDATE users SET credits = credits + 50 WHERE redemption_code = 'CODE0001'")
+        conn.executemany(
+            '''INSERT INTO usage_logs (user_email, redemption_code, prompt_length, response_length,
+                                       timestamp, action, credits_used)
+               VALUES (?, ?, ?, ?, ?, 'enhance_prompt', 1)''',
+            [("user0@example.com", "CODE0000", 10, 200, "2026-01-01 10:00:00"),
+             ("user0@example.com", "CODE0000", 20, 300, "2026-01-02 09:00:00"),
+             ("user1@example.com", "CODE0001", 30, 400, "2026-01-02 11:00:00")])
+
+    with pool.connection() as conn:
+        incremental = snapshot(conn)
+        counters = get_counters(conn)
+
+    with pool.transaction() as conn:
+        recompute_rollups(conn)
+        assert snapshot(conn) == incremental
+
+    assert counters['waiting_list.total'] == 4
+    assert counters['waiting_list.status.pending'] == 1
+    assert counters['users.status.active'] == 2
+    assert counters['users.credits'] == 80
+    assert counters['users.used_credits'] == 4
+    assert counters['usage_logs.total'] == 3
+
+
+def test_missing_counters_read_as_zero(pool):
+    with pool.connection() as conn:
+        assert set(get_counters(conn).values()) == {0}
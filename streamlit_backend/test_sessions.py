@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Session tokens: validated from memory, dead once expired, tampered with or revoked
+
+Run: python -m pytest -q streamlit_backend/test_sessions.py
+"""
+
+import pytest
+
+import database
+import lookup_cache
+import sessions
+from codes import parse_code
+from sessions import SessionEpochs, start_session, validate_session, revoke_sessions, get_session_epochs
+from api_endpoints import verify_code, check_credits
+from conftest import add_user
+
+CODE_ID = parse_code('CODE0001')
+
+
+@pytest.fixture
+def pool(pool, monkeypatch):
+    add_user(pool, credits=7)
+    monkeypatch.setattr(database, '_pool', pool)
+    monkeypatch.setattr(lookup_cache, '_cache', None)
+    monkeypatch.setattr(sessions, '_epochs', None)
+    return pool
+
+
+def start(pool, email='a@example.com'):
+    with pool.transaction() as conn:
+        return start_session(conn, email, CODE_ID)
+
+
+def test_verification_issues_a_token_that_checks_credits(pool):
+    verified = verify_code('a@example.com', 'CODE0001')
+    claims = validate_session(verified["session"])
+    assert claims["code_id"] == CODE_ID and claims["expires_at"] == verified["session_expires_at"]
+
+    assert check_credits(session=verified["session"])["remaining_credits"] == 7
+    assert start(pool, email='b@example.com') is None
+
+
+def test_tokens_name_the_user_but_not_their_code(pool):
+    token = start(pool)["session"]
+    user_id = token.split('.')[0]
+    assert len(token.split('.')) == 4 and str(CODE_ID) not in token.split('.')
+
+    # The code is looked up once per user, then kept in memory
+    assert validate_session(token)["code_id"] == CODE_ID
+    assert validate_session(token)["user_id"] == int(user_id)
+    assert get_session_epochs().stats()["known_codes"] == 1
+
+
+def test_expired_or_tampered_tokens_fail(pool):
+    token = start(pool)["session"]
+    user_id, epoch, expires_at, signature = token.split('.')
+
+    assert validate_session(token, now=int(expires_at)) is None
+    assert validate_session(f"{user_id}.{epoch}.{int(expires_at) + 3600}.{signature}") is None
+    assert validate_session(f"{int(user_id) + 1}.{epoch}.{expires_at}.{signature}") is None
+    assert validate_session("not a token") is None
+    assert check_credits(session=token[:-1])["unauthorized"]
+
+
+def test_revoking_a_user_kills_their_tokens(pool):
+    token = start(pool)["session"]
+    assert validate_session(token)
+
+    with pool.transaction() as conn:
+        conn.execute("UPDATE users SET status = 'revoked' WHERE code_id = ?", (CODE_ID,))
+    get_session_epochs().invalidate()
+    assert validate_session(token) is None
+
+    # Reactivating bumps the epoch again; old tokens stay dead, new ones work
+    with pool.transaction() as conn:
+        conn.execute("UPDATE users SET status = 'active' WHERE code_id = ?", (CODE_ID,))
+    get_session_epochs().invalidate()
+    assert validate_session(token) is None
+    assert validate_session(start(pool)["session"])
+
+
+def test_other_processes_see_revocations_after_the_refresh_interval(pool):
+    token = start(pool)["session"]
+    user_id = int(token.split('.')[0])
+    elsewhere = SessionEpochs(refresh=0, pool=pool)
+    slow = SessionEpochs(refresh=3600, pool=pool)
+    assert elsewhere.epoch(user_id) == slow.epoch(user_id) == 0
+
+    with pool.transaction() as conn:
+        revoke_sessions(conn, user_id)
+    assert elsewhere.epoch(user_id) == 1
+    assert slow.epoch(user_id) == 0  # not rechecked yet
+    slow.invalidate()
+    assert slow.epoch(user_id) == 1
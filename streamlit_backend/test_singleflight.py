@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Singleflight: identical concurrent enhancements are charged and rendered once
+
+Run: python -m pytest -q streamlit_backend/test_singleflight.py
+"""
+
+import threading
+import time
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_run():
+    flights = SingleFlight(window=0)
+    calls = []
+    release = threading.Event()
+
+    def slow():
+        calls.append(1)
+        release.wait(5)
+        return {"success": True, "remaining_credits": 9}
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flights.do("key", slow)))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    while flights.stats()["shared"] < 4:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert sorted(coalesced for _, coalesced in results) == [False, True, True, True, True]
+    assert {r["remaining_credits"] for r, _ in results} == {9}
+    assert flights.stats()["in_flight"] == 0
+
+
+def test_successes_are_replayed_within_the_window():
+    flights = SingleFlight(window=0.05)
+    assert flights.do("key", lambda: {"success": True}) == ({"success": True}, False)
+    assert flights.do("key", lambda: {"success": True}) == ({"success": True}, True)
+    assert flights.do("other", lambda: {"success": True})[1] is False
+
+    time.sleep(0.06)
+    assert flights.do("key", lambda: {"success": True})[1] is False
+
+
+def test_failures_are_not_replayed():
+    flights = SingleFlight(window=10)
+    assert flights.do("key", lambda: {"success": False})[1] is False
+    assert flights.do("key", lambda: {"success": False})[1] is False
+
+    with pytest.raises(ValueError):
+        flights.do("boom", lambda: (_ for _ in ()).throw(ValueError("render failed")))
+    assert flights.do("boom", lambda: {"success": True})[1] is False
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Read-only dashboard snapshots: consistent across queries, never block writers
+
+Run: python -m pytest -q streamlit_backend/test_snapshot.py
+"""
+
+import sqlite3
+
+import pytest
+
+from database import ConnectionPool
+from credits import debit_credit
+from conftest import migrated_pool, add_user
+
+
+@pytest.fixture
+def pools(db_path):
+    writer = migrated_pool(db_path, max_size=2, acquire_timeout=1)
+    add_user(writer)
+    reader = ConnectionPool(db_path=db_path, max_size=1, read_only=True)
+    yield writer, reader
+    reader.close()
+    writer.close()
+
+
+def test_snapshot_is_consistent_while_writers_commit(pools):
+    writer, reader = pools
+    with reader.snapshot() as snap:
+        before = snap.execute("SELECT used_credits FROM users").fetchone()[0]
+
+        # The debit path neither waits for nor is seen by the open snapshot
+        with writer.transaction() as conn:
+            assert debit_credit(conn, 'CODE0001')["success"]
+
+        assert snap.execute("SELECT used_credits FROM users").fetchone()[0] == before
+        assert snap.execute("SELECT value FROM stat_counters WHERE name = 'users.used_credits'"
+                            ).fetchone()[0] == before
+
+    with reader.snapshot() as snap:
+        assert snap.execute("SELECT used_credits FROM users").fetchone()[0] == before + 1
+
+
+def test_snapshot_connections_cannot_write(pools):
+    _, reader = pools
+    with reader.snapshot() as snap:
+        with pytest.raises(sqlite3.OperationalError):
+            snap.execute("UPDATE users SET credits = 0")
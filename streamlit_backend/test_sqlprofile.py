@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+SQL profiler: statements grouped by normalized text, timed until their last
+row, and slow ones logged
+
+Run: python -m pytest -q streamlit_backend/test_sqlprofile.py
+"""
+
+import logging
+import sqlite3
+
+import pytest
+
+from sqlprofile import ProfiledConnection, SqlProfiler, normalize
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:', isolation_level=None, factory=ProfiledConnection)
+    conn.profiler = SqlProfiler(slow_ms=1000)
+    conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, name TEXT)")
+    conn.executemany("INSERT INTO t (name) VALUES (?)", [(str(i),) for i in range(100)])
+    conn.profiler.reset()
+    yield conn
+    conn.close()
+
+
+def by_statement(profiler):
+    return {row["statement"]: row for row in profiler.top(50)}
+
+
+def test_normalize_folds_literals_and_in_lists():
+    assert normalize("SELECT * FROM t1 WHERE a = 'it''s' AND b IN (?,?, ?)\n  AND c = 2.5") == \
+        "SELECT * FROM t1 WHERE a = ? AND b IN (?, ...) AND c = ?"
+    assert normalize("INSERT INTO t (a, b) VALUES (?, ?)") == "INSERT INTO t (a, b) VALUES (?, ?)"
+
+
+def test_statements_are_counted_with_rows_once_each(conn):
+    for i in range(3):
+        assert conn.execute(f"SELECT name FROM t WHERE id = {i + 1}").fetchone() == (str(i),)
+    assert len(list(conn.execute("SELECT * FROM t"))) == 100
+    assert len(conn.execute("SELECT * FROM t WHERE id < 20").fetchmany(50)) == 19
+    conn.execute("UPDATE t SET name = 'x' WHERE id = 1")
+
+    statements = by_statement(conn.profiler)
+    point = statements["SELECT name FROM t WHERE id = ?"]
+    assert point["calls"] == 3 and point["rows"] == 3
+    assert statements["SELECT * FROM t"]["rows"] == 100
+    assert statements["SELECT * FROM t WHERE id < ?"]["rows"] == 19
+    assert statements["UPDATE t SET name = ? WHERE id = ?"]["calls"] == 1
+    scan = statements["SELECT * FROM t"]
+    assert scan["p99_ms"] >= scan["max_ms"] > 0 and scan["vm_ops"] >= point["vm_ops"]
+
+
+def test_slow_statements_are_logged_without_values(conn, caplog):
+    conn.profiler.slow_ms = 0
+    with caplog.at_level(logging.WARNING, logger='sqlprofile.slow'):
+        conn.execute("SELECT * FROM t WHERE name = 'secret'").fetchall()
+    assert conn.profiler.slow[-1]["statement"] == "SELECT * FROM t WHERE name = ?"
+    assert "secret" not in caplog.text and "WHERE name = ?" in caplog.text
+
+
+def test_commits_and_failed_statements_are_recorded(conn):
+    conn.execute("BEGIN")
+    conn.execute("INSERT INTO t (name) VALUES ('y')")
+    conn.commit()
+    with pytest.raises(sqlite3.OperationalError):
+        conn.execute("SELECT nope FROM t")
+
+    statements = by_statement(conn.profiler)
+    assert statements["COMMIT"]["calls"] == 1
+    assert statements["SELECT nope FROM t"]["calls"] == 1
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Precompiled templates render exactly what the per-call builders did
+
+Every combination is compared against the old builders in
+benchmarks/bench_templates.py; these pin the layout and the edge cases.
+
+Run: python -m pytest -q streamlit_backend/test_templates.py
+"""
+
+import pytest
+
+from templates import render_methodology, render_plain_methodology
+
+
+def test_methodology_layout():
+    assert render_methodology("Plan a trip", {"role": "a travel agent", "length": "short", "tone": "casual"}) == (
+        "**ROLE**: You are a travel agent\n\n"
+        "**GOAL**: Plan a trip\n\n"
+        "**CONTEXT**: Provide comprehensive information with relevant details\n\n"
+        "**REQUIREMENTS**: Keep the response concise and to the point | "
+        "Use conversational, friendly, and approachable language\n\n"
+        "**FORMAT**: Use clear headings, bullet points, and logical organization\n\n"
+        "**WARNINGS**: Ensure accuracy, avoid assumptions, and provide actionable insights")
+
+
+def test_methodology_unknown_settings():
+    # An unknown description drops CONTEXT; other unknown values are errors
+    assert "**CONTEXT**" not in render_methodology("Plan a trip", {"description": "other"})
+    with pytest.raises(KeyError, match="huge"):
+        render_methodology("Plan a trip", {"length": "huge"})
+
+
+def test_plain_methodology_layout():
+    assert render_plain_methodology("Plan a trip", {"role": " a travel agent ", "format": "bullet",
+                                                    "tone": "unknown"}) == (
+        "ROLE: You are a travel agent.\n\n"
+        "GOAL: Plan a trip\n\n"
+        "CONTEXT: Provide a comprehensive and thorough response with examples where appropriate.\n\n"
+        "REQUIREMENTS:\n"
+        "- Aim for 200-500 words\n"
+        "- Format as bullet points\n"
+        "- Use a helpful and supportive tone\n\n"
+        "FORMAT: Structure your response clearly with appropriate headings or organization.\n\n"
+        "WARNINGS: Ensure accuracy and provide sources when making factual claims.")
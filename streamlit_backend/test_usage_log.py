@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Usage log writer: rows are group-committed, overflow is dropped and counted,
+close() writes out the backlog
+
+Run: python -m pytest -q streamlit_backend/test_usage_log.py
+"""
+
+import pytest
+
+from usage_log import UsageLogWriter
+
+
+@pytest.fixture
+def stalled(monkeypatch):
+    """Writers whose background thread never starts, so the queue only fills"""
+    monkeypatch.setattr(UsageLogWriter, '_ensure_started', lambda self: None)
+
+
+def logged(pool):
+    with pool.connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM usage_logs").fetchone()[0]
+
+
+def log_rows(writer, n):
+    return [writer.log(f"user{i}@example.com", 'CODE0001', prompt_length=i) for i in range(n)]
+
+
+def test_rows_are_written_in_batches(pool):
+    writer = UsageLogWriter(batch_size=50, flush_interval=0.05, pool=pool)
+    log_rows(writer, 120)
+    assert writer.flush()
+    assert logged(pool) == 120
+    stats = writer.stats()
+    assert stats["written"] == 120 and stats["queue_depth"] == 0
+    assert 3 <= stats["batches"] < 120  # grouped, never one commit per row
+    writer.close()
+
+
+def test_close_writes_the_backlog_in_full_batches(pool, stalled):
+    writer = UsageLogWriter(batch_size=50, pool=pool)
+    log_rows(writer, 120)
+    assert logged(pool) == 0
+
+    writer.close()
+    assert logged(pool) == 120
+    assert writer.stats()["batches"] == 3
+    assert writer.log('late@example.com', 'CODE0001') is False  # closed
+
+
+def test_close_drains_a_running_writer(pool):
+    writer = UsageLogWriter(batch_size=500, flush_interval=30, pool=pool)
+    log_rows(writer, 10)
+    writer.close()  # does not wait out the 30s flush interval
+    assert logged(pool) == 10 and writer.stats()["written"] == 10
+
+
+def test_a_full_queue_drops_and_counts(pool, stalled):
+    writer = UsageLogWriter(max_queue=5, pool=pool)
+    assert log_rows(writer, 8) == [True] * 5 + [False] * 3
+    assert writer.stats()["dropped"] == 3 and writer.stats()["enqueued"] == 5
+
+    writer.close()
+    assert logged(pool) == 5
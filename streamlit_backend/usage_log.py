@@ -0,0 +1,212 @@
+"""
+Asynchronous, batched usage-log writer
+Request handlers enqueue usage events and return; a background thread
+group-commits them with executemany so the credit debit transaction never
+holds the write lock for the log insert.
+"""
+
+import os
+import queue
+import atexit
+import threading
+import time
+import logging
+from datetime import datetime, timezone
+
+from database import get_pool
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = int(os.environ.get('USAGE_LOG_BATCH_SIZE', '200'))
+FLUSH_INTERVAL = float(os.environ.get('USAGE_LOG_FLUSH_INTERVAL', '0.5'))
+QUEUE_SIZE = int(os.environ.get('USAGE_LOG_QUEUE_SIZE', '10000'))
+WRITE_RETRIES = 3
+
+_INSERT = '''INSERT INTO usage_logs
+                 (user_email, redemption_code, prompt_length, response_length,
+                  timestamp, ip_address, action, credits_used)
+             VALUES (?, ?, ?, ?, ?, ?, ?, ?)'''
+
+_STOP = object()
+
+
+def _now():
+    """Same format as SQLite's CURRENT_TIMESTAMP, taken when the event happens"""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class UsageLogWriter:
+    """Bounded queue of usage events drained by one background writer thread
+
+    ``log()`` never blocks: when the queue is full the event is dropped and
+    counted, because losing a log row is better than stalling a paid request.
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 max_queue=QUEUE_SIZE, pool=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pool = pool
+        self.pid = os.getpid()
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._closed = False
+
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.errors = 0
+
+    # ---- producer side ----
+
+    def log(self, user_email, redemption_code, prompt_length=0, response_length=0,
+            action='enhance_prompt', credits_used=1, ip_address=None):
+        """Queue one usage event; returns False if it had to be dropped"""
+        if self._closed:
+            self.dropped += 1
+            return False
+        self._ensure_started()
+
+        row = (user_email, redemption_code, prompt_length, response_length,
+               _now(), ip_address, action, credits_used)
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.enqueued += 1
+        return True
+
+    def flush(self, timeout=10.0):
+        """Block until everything queued so far is committed (or timeout)"""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self._queue.unfinished_tasks == 0
+
+    def close(self, timeout=10.0):
+        """Stop accepting events, write out the backlog and stop the thread"""
+        if self._closed:
+            return
+        self._closed = True
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            # Nothing running (never started, or forked): drain inline
+            rows = self._drain(block=False)
+            while rows:
+                self._write_batch(rows)
+                rows = self._drain(block=False)
+            return
+        self._queue.put(_STOP)
+        thread.join(timeout)
+
+    # ---- consumer side ----
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="usage-log-writer", daemon=True)
+                self._thread.start()
+
+    def _drain(self, block=True):
+        """Collect up to batch_size rows, waiting at most flush_interval"""
+        rows = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(rows) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if block and remaining > 0:
+                    item = self._queue.get(timeout=remaining)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                self._queue.task_done()
+                self._closed = True
+                block = False
+                continue
+            rows.append(item)
+        return rows
+
+    def _write_batch(self, rows):
+        if not rows:
+            return
+        pool = self.pool or get_pool()
+        for attempt in range(WRITE_RETRIES):
+            try:
+                with pool.transaction() as conn:
+                    conn.executemany(_INSERT, rows)
+                self.written += len(rows)
+                self.batches += 1
+                break
+            except Exception as e:
+                self.errors += 1
+                if attempt == WRITE_RETRIES - 1:
+                    logger.warning("Dropping %d usage log rows after %d attempts: %s",
+                                   len(rows), WRITE_RETRIES, e)
+                    self.dropped += len(rows)
+                else:
+                    time.sleep(0.05 * (attempt + 1))
+        for _ in rows:
+            self._queue.task_done()
+
+    def _run(self):
+        while True:
+            rows = self._drain(block=not self._closed)
+            self._write_batch(rows)
+            if self._closed and self._queue.empty():
+                return
+
+    # ---- metrics ----
+
+    def stats(self):
+        """Queue depth plus lifetime counters"""
+        return {
+            "queue_depth": self._queue.qsize(),
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "batches": self.batches,
+            "errors": self.errors,
+        }
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_usage_writer():
+    """Process-wide writer, recreated after a fork (threads do not survive fork)"""
+    global _writer
+    writer = _writer
+    if writer is None or writer.pid != os.getpid():
+        with _writer_lock:
+            if _writer is None or _writer.pid != os.getpid():
+                _writer = UsageLogWriter()
+            writer = _writer
+    return writer
+
+
+def log_usage(user_email, redemption_code, prompt_length=0, response_length=0,
+              action='enhance_prompt', credits_used=1, ip_address=None):
+    """Queue a usage_logs row on the process-wide writer"""
+    return get_usage_writer().log(user_email, redemption_code, prompt_length, response_length,
+                                  action=action, credits_used=credits_used, ip_address=ip_address)
+
+
+def usage_log_stats():
+    """Counters for the process-wide writer"""
+    return get_usage_writer().stats()
+
+
+@atexit.register
+def _flush_on_exit():
+    # Durable shutdown: whatever was accepted gets committed before exit
+    if _writer is not None and _writer.pid == os.getpid():
+        _writer.close()